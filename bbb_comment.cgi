@@ -14,43 +14,85 @@
 #--------------------------------------------------------------------------------------------------
 
 
-import cgi
+import collections
+import contextlib
 import datetime
 import dateutil.tz
+import email.utils
 import fcntl
 import hashlib
+import hmac
 import html
+import mmap
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
 import unicodedata
 import urllib
 import urllib.parse
 
+import bbb_web
+
 
 HTML_DIR = "."
 COMMENT_DIR = "."
 HISTORY_FILE = "__cmthst__.tsv"
+HISTORY_DIR = "__cmthst__"
+COUNT_FILE = "__cmtcnt__.tsv"
+RESOURCE_REGISTRY_FILE = "__resources__.tsv"
+STORAGE_BACKEND = "tsv"
+SQLITE_FILE = "__comments__.db"
+SQLITE_TIMEOUT = 10.0
 NONCE_SALT = "bbb"
 MAX_AUTHOR_LEN = 32
 MAX_TEXT_LEN = 3000
 MAX_COMMENT_FILE_SIZE = 1024 * 1024 * 1
-MAX_HISTORY_FILE_SIZE = 1024 * 256
+MAX_HISTORY_SEGMENT_SIZE = 1024 * 64
+MAX_HISTORY_SEGMENTS = 5
+MAX_HISTORY_RECORDS = 2000
+MAX_BATCH_RESOURCES = 1000
+MAX_FORM_SIZE = 1024 * 512
+COMPRESS_OUTPUT = False
+COMPRESS_MIN_SIZE = 1024 * 2
+TAIL_BLOCK_SIZE = 1024 * 8
+SERVER_CACHE_ENTRIES = 256
 CHECK_REFERRER = True
 CHECK_METHOD = True
 CHECK_NONCE = True
+SQLITE_SCHEMA = r"""
+CREATE TABLE IF NOT EXISTS comments (
+  id INTEGER PRIMARY KEY, resource TEXT NOT NULL, date TEXT NOT NULL,
+  addr TEXT NOT NULL, author TEXT NOT NULL, text TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS comments_resource_date ON comments(resource, date);
+CREATE TABLE IF NOT EXISTS counts (
+  resource TEXT PRIMARY KEY, count INTEGER NOT NULL, size INTEGER NOT NULL,
+  date TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS history (
+  id INTEGER PRIMARY KEY, date TEXT NOT NULL, resource TEXT NOT NULL, title TEXT NOT NULL,
+  addr TEXT NOT NULL, author TEXT NOT NULL, text TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS history_date ON history(date);
+"""
+cache_lock = threading.RLock()
+thread_cache = None
+resource_cache = None
+resource_locks = None
 
 
 def main():
-  request_method = os.environ.get("REQUEST_METHOD", "GET")
-  script_filename = os.environ.get("SCRIPT_FILENAME", "")
-  script_url = os.environ.get("REQUEST_SCHEME", "http") + "://"
-  script_url += os.environ.get("HTTP_HOST", "localhost")
-  script_url += os.environ.get("REQUEST_URI", "/bbb_comment.cgi")
-  script_url = re.sub(r"\?.*", "", script_url)
-  referrer_url = os.environ.get("HTTP_REFERER", "")
-  remote_addr = os.environ.get("REMOTE_ADDR", "")
+  if len(sys.argv) > 1 and not os.environ.get("GATEWAY_INTERFACE"):
+    return RunCommand(sys.argv[1:])
+  bbb_web.RunCGI(HandleRequest)
+
+
+def HandleRequest(request):
+  script_filename = request.get("SCRIPT_FILENAME")
+  script_url = request.script_url("/bbb_comment.cgi")
+  referrer_url = request.header("Referer")
+  remote_addr = request.get("REMOTE_ADDR")
+  if_none_match = request.header("If-None-Match")
   if script_filename:
     resource_dir = os.path.join(os.path.dirname(script_filename), HTML_DIR)
     comment_dir = os.path.join(os.path.dirname(script_filename), COMMENT_DIR)
@@ -64,35 +106,34 @@ def main():
     if referrer_parts.netloc != script_parts.netloc:
       PrintError(403, "Forbidden", "bad referrer")
       return
-  form = cgi.FieldStorage()
-  params = {}
-  for key in form.keys():
-    value = form[key]
-    if isinstance(value, list):
-      params[key] = value[0].value
-    else:
-      params[key] = value.value
+  params = bbb_web.ReadFormParams(request, MAX_FORM_SIZE)
+  if params is None:
+    PrintError(400, "Bad Request", "invalid form data")
+    return
   action = params.get("action") or ""
   if action == "list-resources":
     DoListResources(resource_dir, params)
     return
   if action == "list-comments":
-    DoListComments(resource_dir, comment_dir, params)
+    DoListComments(resource_dir, comment_dir, params, request)
     return
   if action == "count-comments":
-    DoCountComments(resource_dir, comment_dir, params)
+    DoCountComments(resource_dir, comment_dir, params, if_none_match)
+    return
+  if action == "batch-count-comments":
+    DoBatchCountComments(resource_dir, comment_dir, params)
     return
   if action == "get-nonce":
     DoGetNonce(resource_dir, comment_dir, params)
     return
   if action == "post-comment":
-    if CHECK_METHOD and request_method != "POST":
+    if CHECK_METHOD and request.method != "POST":
       PrintError(403, "Forbidden", "bad method")
       return
     DoPostComment(resource_dir, comment_dir, params, remote_addr)
     return
   if action == "list-history":
-    DoListHistory(comment_dir, params)
+    DoListHistory(comment_dir, params, request)
     return
   PrintError(400, "Bad Request", "unknown action")
   return
@@ -105,6 +146,32 @@ def PrintError(code, name, message):
   print(message)
 
 
+def CheckNotModified(if_none_match, validator):
+  etag, mtime = validator
+  tags = [re.sub(r"^W/", "", x.strip()) for x in if_none_match.split(",")]
+  if re.sub(r"^W/", "", etag) not in tags and "*" not in tags:
+    return False
+  print("Status: 304 Not Modified")
+  print("ETag: " + etag)
+  print()
+  return True
+
+
+def PrintValidatorHeaders(validator):
+  etag, mtime = validator
+  print("ETag: " + etag)
+  if mtime is not None:
+    print("Last-Modified: " + email.utils.formatdate(mtime, usegmt=True))
+  print("Cache-Control: no-cache")
+
+
+def GetEncodedValidator(validator, request):
+  etag, mtime = validator
+  if COMPRESS_OUTPUT and bbb_web.AcceptsGzip(request) and not etag.startswith("W/"):
+    etag = "W/" + etag
+  return etag, mtime
+
+
 def TextToInt(text):
   try:
     return int(text)
@@ -116,6 +183,7 @@ def ReadResourceMeta(path):
   is_article = False
   title = ""
   date = ""
+  misc = ""
   try:
     with open(path) as input_file:
       num_lines = 0
@@ -130,13 +198,93 @@ def ReadResourceMeta(path):
         match = re.search('<meta .*name="x-bbb-date".*content="(.*?)".*/>', line)
         if match:
           date = html.unescape(match.group(1))
+        match = re.search('<meta .*name="x-bbb-misc".*content="(.*?)".*/>', line)
+        if match:
+          misc = html.unescape(match.group(1))
         num_lines += 1
         if num_lines >= 30 or line == "</head>": break
   except:
     return None
   if not is_article:
     return None
-  return (title, date)
+  flags = [x.strip() for x in misc.split(",") if x.strip()]
+  return (title, date, flags)
+
+
+def ParseRegistryLine(line):
+  fields = line.decode("UTF-8", "replace").split("\t")
+  if len(fields) != 4: return None
+  flags = [x for x in fields[3].split(",") if x]
+  return (fields[0], fields[1], fields[2], flags)
+
+
+def ReadResourceRegistry(path):
+  records = []
+  with open(path, "rb") as input_file:
+    for line in input_file:
+      record = ParseRegistryLine(line.rstrip(b"\n"))
+      if not record: continue
+      records.append(record)
+  return records
+
+
+def SearchResourceRegistry(path, resource):
+  with open(path, "rb") as input_file:
+    size = os.fstat(input_file.fileno()).st_size
+    if size < 1:
+      return None
+    with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      key = resource.encode("UTF-8")
+      low = 0
+      high = size
+      while low < high:
+        middle = (low + high) // 2
+        start = mm.rfind(b"\n", 0, middle) + 1
+        end = mm.find(b"\n", start)
+        if end < 0:
+          end = size
+        line = mm[start:end]
+        name = line.split(b"\t", 1)[0]
+        if name == key:
+          record = ParseRegistryLine(line)
+          return record[1:] if record else None
+        if name < key:
+          low = end + 1
+        else:
+          high = start
+  return None
+
+
+# Pages missing from the registry are read directly so that a registry written by an older
+# focused build does not hide them.
+def LookUpResource(resource_dir, resource):
+  registry_path = os.path.join(resource_dir, RESOURCE_REGISTRY_FILE)
+  if resource_cache is not None:
+    stamp = GetFileStamp(registry_path)
+    if stamp:
+      registry = GetCachedValue(resource_cache, registry_path, stamp)
+      if registry is None:
+        try:
+          registry = dict([(x[0], x[1:]) for x in ReadResourceRegistry(registry_path)])
+        except OSError:
+          registry = None
+        SetCachedValue(resource_cache, registry_path, stamp, registry)
+      if registry is not None and resource in registry:
+        return registry[resource]
+    res_path = os.path.join(resource_dir, resource + ".xhtml")
+    stamp = GetFileStamp(res_path)
+    meta = GetCachedValue(resource_cache, res_path, stamp)
+    if meta is None:
+      meta = ReadResourceMeta(res_path)
+      SetCachedValue(resource_cache, res_path, stamp, meta)
+    return meta
+  try:
+    meta = SearchResourceRegistry(registry_path, resource)
+    if meta:
+      return meta
+  except OSError:
+    pass
+  return ReadResourceMeta(os.path.join(resource_dir, resource + ".xhtml"))
 
 
 def EscapeCommentText(text):
@@ -146,92 +294,673 @@ def EscapeCommentText(text):
   return text
 
 
-def GetCurrentDate():
-  date = datetime.datetime.fromtimestamp(time.time(), dateutil.tz.tzlocal())
+def UnixTimeToDate(ts):
+  date = datetime.datetime.fromtimestamp(ts, dateutil.tz.tzlocal())
   return date.strftime("%Y/%m/%d %H:%M:%S")
 
 
-def ReadComments(path):
-  comments = []
-  try:
-    fd = os.open(path, os.O_RDONLY)
+def GetCurrentDate():
+  return UnixTimeToDate(time.time())
+
+
+def ReadLinesBackward(paths):
+  for path in paths:
+    try:
+      fd = os.open(path, os.O_RDONLY)
+    except OSError:
+      continue
     fcntl.flock(fd, fcntl.LOCK_SH)
-    input_file = os.fdopen(fd, "r")
-    for line in input_file:
+    with os.fdopen(fd, "rb") as input_file:
+      pos = input_file.seek(0, 2)
+      rest = b""
+      while pos > 0:
+        read_size = min(TAIL_BLOCK_SIZE, pos)
+        pos -= read_size
+        input_file.seek(pos)
+        lines = (input_file.read(read_size) + rest).split(b"\n")
+        rest = lines[0]
+        for line in reversed(lines[1:]):
+          yield line.decode("UTF-8", "replace")
+      yield rest.decode("UTF-8", "replace")
+
+
+def SelectRecentRecords(lines, num_fields, offset, limit, since):
+  records = []
+  try:
+    for line in lines:
       fields = line.strip().split("\t")
-      if len(fields) != 4: continue
-      del fields[1]
-      comments.append(fields)
-    input_file.close()
+      if len(fields) != num_fields: continue
+      if since and fields[0] < since: break
+      if offset > 0:
+        offset -= 1
+        continue
+      records.append(fields)
+      if limit > 0 and len(records) >= limit: break
   except:
     pass
+  return records
+
+
+def ReadRecentRecords(paths, num_fields, offset, limit, since):
+  return SelectRecentRecords(ReadLinesBackward(paths), num_fields, offset, limit, since)
+
+
+def CountLines(paths):
+  num_lines = 0
+  for path in paths:
+    try:
+      fd = os.open(path, os.O_RDONLY)
+      fcntl.flock(fd, fcntl.LOCK_SH)
+      with os.fdopen(fd, "rb") as input_file:
+        while True:
+          block = input_file.read(1024 * 64)
+          if not block: break
+          num_lines += block.count(b"\n")
+    except:
+      pass
+  return num_lines
+
+
+def ReadComments(path, offset, limit, since):
+  if thread_cache is None:
+    comments = ReadRecentRecords([path], 4, offset, limit, since)
+  else:
+    stamp = GetFileStamp(path)
+    lines = GetCachedValue(thread_cache, path, stamp)
+    if lines is None:
+      try:
+        lines = list(ReadLinesBackward([path]))
+      except OSError:
+        lines = []
+      SetCachedValue(thread_cache, path, stamp, lines)
+    comments = SelectRecentRecords(lines, 4, offset, limit, since)
+  for fields in comments:
+    del fields[1]
+  comments.reverse()
   return comments
 
 
-def WriteComment(path, date, addr, author, text):
+def WriteComment(path, resource_id, nonce, date, addr, author, text):
   esc_text = EscapeCommentText(text)
   fields = [date, addr, author, esc_text]
   serialized = "\t".join(fields) + "\n"
   fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
   fcntl.flock(fd, fcntl.LOCK_EX)
-  new_size = os.fstat(fd).st_size + len(serialized)
-  if new_size > MAX_COMMENT_FILE_SIZE:
-    return False
+  size = os.fstat(fd).st_size
+  if nonce is not None and not hmac.compare_digest(
+      nonce.encode("UTF-8"), CalculateNonce(resource_id, size).encode("UTF-8")):
+    os.close(fd)
+    return "conflict"
+  if size + len(serialized.encode("UTF-8")) > MAX_COMMENT_FILE_SIZE:
+    os.close(fd)
+    return "overflow"
   output_file = os.fdopen(fd, "a")
   output_file.write(serialized)
   output_file.close()
+  return "ok"
+
+
+def ScanCommentFile(path, offset):
+  try:
+    with open(path, "rb") as input_file:
+      size = os.fstat(input_file.fileno()).st_size
+      if offset > size:
+        return (0, b"", size)
+      input_file.seek(offset)
+      data = input_file.read(size - offset)
+  except:
+    return (0, b"", 0)
+  size = offset + len(data)
+  num_lines = data.count(b"\n")
+  last_line = b""
+  if num_lines > 0:
+    last_line = data[:data.rfind(b"\n")]
+    last_line = last_line[last_line.rfind(b"\n") + 1:]
+  return (num_lines, last_line, size)
+
+
+def LineToUnixTime(line):
+  date = line.decode("UTF-8", "replace").split("\t")[0]
+  try:
+    return DateToUnixTime(date)
+  except:
+    return -1
+
+
+def ReadCommentCounts(path):
+  counts = {}
+  try:
+    with open(path) as input_file:
+      for line in input_file:
+        fields = line.strip().split("\t")
+        if len(fields) != 4: continue
+        counts[fields[0]] = (TextToInt(fields[1]), TextToInt(fields[2]), TextToInt(fields[3]))
+  except:
+    pass
+  return counts
+
+
+def WriteCommentCounts(path, counts):
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  with open(tmp_path, "w") as output_file:
+    for name, count in sorted(counts.items()):
+      output_file.write("{}\t{}\t{}\t{}\n".format(name, count[0], count[1], count[2]))
+  os.chmod(tmp_path, 0o644)
+  os.replace(tmp_path, path)
+
+
+def GetCommentCount(comment_dir, counts, resource):
+  cmt_path = os.path.join(comment_dir, resource + ".cmt")
+  try:
+    size = os.stat(cmt_path).st_size
+  except:
+    return (0, -1)
+  count = counts.get(resource)
+  if count and count[2] == size:
+    return (count[0], count[1])
+  num_lines, last_line, size = ScanCommentFile(cmt_path, 0)
+  if num_lines < 1:
+    return (0, -1)
+  return (num_lines, LineToUnixTime(last_line))
+
+
+def ScanCommentCounts(comment_dir):
+  counts = {}
+  for name in os.listdir(comment_dir):
+    if not name.endswith(".cmt"): continue
+    num_lines, last_line, size = ScanCommentFile(os.path.join(comment_dir, name), 0)
+    if num_lines > 0:
+      counts[re.sub(r"\.cmt$", "", name)] = (num_lines, LineToUnixTime(last_line), size)
+  return counts
+
+
+# The snapshot is seeded from all comment files when it is missing so that a site upgraded
+# from a version without it lists every resource.
+def UpdateCommentCount(path, cmt_path, resource):
+  try:
+    lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+  except OSError:
+    return False
+  try:
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    if os.path.exists(path):
+      counts = ReadCommentCounts(path)
+    else:
+      counts = ScanCommentCounts(os.path.dirname(path))
+    old_count, old_date, old_size = counts.get(resource) or (0, -1, 0)
+    num_lines, last_line, size = ScanCommentFile(cmt_path, old_size)
+    if size < old_size or (size > old_size and num_lines < 1):
+      old_count, old_date = 0, -1
+      num_lines, last_line, size = ScanCommentFile(cmt_path, 0)
+    if num_lines > 0:
+      counts[resource] = (old_count + num_lines, LineToUnixTime(last_line), size)
+    WriteCommentCounts(path, counts)
+  except OSError:
+    return False
+  finally:
+    os.close(lock_fd)
   return True
 
 
-def WriteHistory(path, date, resource, title, addr, author, text):
+def ListHistorySegments(comment_dir):
+  segments = []
+  hist_dir = os.path.join(comment_dir, HISTORY_DIR)
+  try:
+    for name in os.listdir(hist_dir):
+      match = re.fullmatch(r"(\d+)\.tsv", name)
+      if not match: continue
+      segments.append((int(match.group(1)), os.path.join(hist_dir, name)))
+  except OSError:
+    pass
+  legacy_path = os.path.join(comment_dir, HISTORY_FILE)
+  if os.path.exists(legacy_path):
+    segments.append((0, legacy_path))
+  segments.sort()
+  return segments
+
+
+def GetHistorySegmentPath(comment_dir, number):
+  return os.path.join(comment_dir, HISTORY_DIR, "{:06d}.tsv".format(number))
+
+
+def TrimHistorySegments(comment_dir):
+  segments = ListHistorySegments(comment_dir)
+  for number, path in segments[:-MAX_HISTORY_SEGMENTS]:
+    for trim_path in [path, GetHistoryCountPath(path)]:
+      try:
+        os.remove(trim_path)
+      except OSError:
+        pass
+
+
+def GetHistoryCountPath(path):
+  return re.sub(r"\.tsv$", ".cnt", path)
+
+
+# A segment is not appended to once the next one exists.  Its number of lines is kept in a
+# sidecar with the size it was counted at, so that listing the history only scans the last one.
+def WriteHistoryCount(path, num_lines, size):
+  count_path = GetHistoryCountPath(path)
+  tmp_path = "{}.{}-{}.tmp".format(count_path, os.getpid(), threading.get_ident())
+  try:
+    with open(tmp_path, "w") as output_file:
+      output_file.write("{}\t{}\n".format(num_lines, size))
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, count_path)
+  except OSError:
+    pass
+
+
+def CountHistoryLines(segments):
+  total = 0
+  for index, (number, path) in enumerate(segments):
+    if index == len(segments) - 1:
+      total += CountLines([path])
+      continue
+    try:
+      size = os.stat(path).st_size
+    except OSError:
+      continue
+    try:
+      with open(GetHistoryCountPath(path)) as input_file:
+        fields = input_file.read().split("\t")
+      if len(fields) == 2 and TextToInt(fields[1]) == size:
+        total += TextToInt(fields[0])
+        continue
+    except OSError:
+      pass
+    num_lines = CountLines([path])
+    WriteHistoryCount(path, num_lines, size)
+    total += num_lines
+  return total
+
+
+def MakeHistoryFields(date, resource, title, addr, author, text):
   short_title = re.sub(r"\s+", " ", title).strip()
   if len(short_title) > 64:
     short_title = short_title[:64] + "..."
   short_text = re.sub(r"\s+", " ", text).strip()
   if len(short_text) > 64:
     short_text = short_text[:64] + "..."
-  fields = [date, resource, short_title, addr, author, short_text]
-  serialized = "\t".join(fields) + "\n"
-  limit_file_size = MAX_HISTORY_FILE_SIZE * 1.2 + 256
-  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
-  fcntl.flock(fd, fcntl.LOCK_EX)
-  new_size = os.fstat(fd).st_size + len(serialized)
-  output_file = os.fdopen(fd, "r+")
-  if new_size > limit_file_size:
-    lines = []
-    for line in output_file:
-      lines.append(line.strip())
-    lines.reverse()
-    total_size = 0
-    line_num = 0
-    for line in lines:
-      total_size += len(line) + 1
-      if total_size > MAX_HISTORY_FILE_SIZE: break
-      line_num += 1
-    lines = lines[:line_num]
-    lines.reverse()
-    output_file.seek(0)
-    output_file.truncate()
-    for line in lines:
-      output_file.write(line + "\n")
-  else:
-    output_file.seek(0, 2)
-  output_file.write(serialized)
-  output_file.close()
+  return [date, resource, short_title, addr, author, short_text]
+
+
+def WriteHistory(comment_dir, fields):
+  serialized = ("\t".join(fields) + "\n").encode("UTF-8")
+  os.makedirs(os.path.join(comment_dir, HISTORY_DIR), exist_ok=True)
+  while True:
+    segments = [x for x in ListHistorySegments(comment_dir) if x[0] > 0]
+    number = segments[-1][0] if segments else 1
+    fd = os.open(GetHistorySegmentPath(comment_dir, number),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    next_path = GetHistorySegmentPath(comment_dir, number + 1)
+    if os.path.exists(next_path):
+      os.close(fd)
+      continue
+    size = os.fstat(fd).st_size
+    if size > 0 and size + len(serialized) > MAX_HISTORY_SEGMENT_SIZE:
+      try:
+        with open(GetHistorySegmentPath(comment_dir, number), "rb") as input_file:
+          num_lines = input_file.read().count(b"\n")
+        WriteHistoryCount(GetHistorySegmentPath(comment_dir, number), num_lines, size)
+        os.close(os.open(next_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        TrimHistorySegments(comment_dir)
+      except FileExistsError:
+        pass
+      os.close(fd)
+      continue
+    os.write(fd, serialized)
+    os.close(fd)
+    return True
+
+
+# The journal mode is stored in the database file, so the schema and the journal mode are
+# only set up when the file is created.  A new file is prepared aside and linked into place so
+# that concurrent requests never see it without the schema.
+def CreateCommentDatabase(path):
+  tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+  conn = sqlite3.connect(tmp_path, isolation_level=None)
+  try:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SQLITE_SCHEMA)
+  finally:
+    conn.close()
+  try:
+    os.link(tmp_path, path)
+  except FileExistsError:
+    pass
+  finally:
+    os.remove(tmp_path)
+
+
+def OpenCommentDatabase(comment_dir, create=False):
+  path = os.path.join(comment_dir, SQLITE_FILE)
+  if not os.path.exists(path):
+    CreateCommentDatabase(path)
+  conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+  if create:
+    conn.executescript(SQLITE_SCHEMA)
+  conn.execute("PRAGMA synchronous=NORMAL")
+  return conn
+
+
+def MakeFileValidator(paths):
+  etag = []
+  mtime = None
+  for path in paths:
+    try:
+      stat = os.stat(path)
+    except OSError:
+      continue
+    etag.append("{:x}-{:x}".format(stat.st_size, stat.st_mtime_ns))
+    mtime = max(mtime or 0, int(stat.st_mtime))
+  return ('"' + (".".join(etag) or "0") + '"', mtime)
+
+
+def LoadCommentValidator(comment_dir, resource):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    row = conn.execute("SELECT count, size, date FROM counts WHERE resource = ?",
+                       (resource,)).fetchone()
+    conn.close()
+    if not row:
+      return ('"s0"', None)
+    return ('"s{:x}-{:x}"'.format(row[0], row[1]), DateToUnixTime(row[2]))
+  return MakeFileValidator([os.path.join(comment_dir, resource + ".cmt")])
+
+
+def LoadHistoryValidator(comment_dir):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    row = conn.execute("SELECT id, date FROM history ORDER BY id DESC LIMIT 1").fetchone()
+    conn.close()
+    if not row:
+      return ('"s0"', None)
+    return ('"s{:x}"'.format(row[0]), DateToUnixTime(row[1]))
+  segments = ListHistorySegments(comment_dir)
+  paths = [x[1] for x in segments[:1] + segments[1:][-1:]]
+  return MakeFileValidator(paths)
+
+
+def LoadCommentCounts(comment_dir, resources):
+  result = {}
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    for resource in resources:
+      row = conn.execute("SELECT count, date FROM counts WHERE resource = ?",
+                         (resource,)).fetchone()
+      result[resource] = (row[0], DateToUnixTime(row[1])) if row else (0, -1)
+    conn.close()
+    return result
+  counts = ReadCommentCounts(os.path.join(comment_dir, COUNT_FILE))
+  for resource in resources:
+    result[resource] = GetCommentCount(comment_dir, counts, resource)
+  return result
+
+
+def LoadComments(comment_dir, resource, offset, limit, since):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    rows = conn.execute(
+      "SELECT date, author, text FROM comments WHERE resource = ? AND date >= ?"
+      " ORDER BY date DESC, id DESC LIMIT ? OFFSET ?",
+      (resource, since, limit if limit > 0 else -1, max(offset, 0))).fetchall()
+    conn.close()
+    return [list(x) for x in reversed(rows)]
+  return ReadComments(os.path.join(comment_dir, resource + ".cmt"), offset, limit, since)
+
+
+def LoadNonce(comment_dir, resource):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    row = conn.execute("SELECT count FROM counts WHERE resource = ?", (resource,)).fetchone()
+    conn.close()
+    return CalculateNonce(resource, row[0] if row else 0)
+  cmt_path = os.path.join(comment_dir, resource + ".cmt")
+  return CalculateNonce(resource, GetCommentFileSize(cmt_path))
+
+
+def StoreComment(comment_dir, resource, nonce, date, addr, author, text, title):
+  with GetResourceLock(resource):
+    return StoreCommentUnlocked(comment_dir, resource, nonce, date, addr, author, text, title)
+
+
+def StoreCommentUnlocked(comment_dir, resource, nonce, date, addr, author, text, title):
+  hist_fields = MakeHistoryFields(date, resource, title, addr, author, text)
+  if STORAGE_BACKEND == "sqlite":
+    esc_text = EscapeCommentText(text)
+    record_size = len("\t".join([date, addr, author, esc_text]).encode("UTF-8")) + 1
+    conn = OpenCommentDatabase(comment_dir)
+    try:
+      conn.execute("BEGIN IMMEDIATE")
+      row = conn.execute("SELECT count, size FROM counts WHERE resource = ?",
+                         (resource,)).fetchone()
+      count, size = row or (0, 0)
+      if nonce is not None and not hmac.compare_digest(
+          nonce.encode("UTF-8"), CalculateNonce(resource, count).encode("UTF-8")):
+        conn.execute("ROLLBACK")
+        return "conflict"
+      if size + record_size > MAX_COMMENT_FILE_SIZE:
+        conn.execute("ROLLBACK")
+        return "overflow"
+      conn.execute("INSERT INTO comments (resource, date, addr, author, text)"
+                   " VALUES (?, ?, ?, ?, ?)", (resource, date, addr, author, esc_text))
+      conn.execute("INSERT OR REPLACE INTO counts (resource, count, size, date)"
+                   " VALUES (?, ?, ?, ?)", (resource, count + 1, size + record_size, date))
+      cursor = conn.execute("INSERT INTO history (date, resource, title, addr, author, text)"
+                            " VALUES (?, ?, ?, ?, ?, ?)", hist_fields)
+      conn.execute("DELETE FROM history WHERE id <= ?",
+                   (cursor.lastrowid - MAX_HISTORY_RECORDS,))
+      conn.execute("COMMIT")
+      if not WriteSqliteCommentCounts(conn, comment_dir):
+        return "error"
+    finally:
+      conn.close()
+    return "ok"
+  cmt_path = os.path.join(comment_dir, resource + ".cmt")
+  status = WriteComment(cmt_path, resource, nonce, date, addr, author, text)
+  if status != "ok":
+    return status
+  if not UpdateCommentCount(os.path.join(comment_dir, COUNT_FILE), cmt_path, resource):
+    return "error"
+  if not WriteHistory(comment_dir, hist_fields):
+    return "error"
+  return "ok"
+
+
+def LoadHistory(comment_dir, offset, limit, since):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    total = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+    rows = conn.execute(
+      "SELECT date, resource, title, author, text FROM history WHERE date >= ?"
+      " ORDER BY id DESC LIMIT ? OFFSET ?",
+      (since, limit if limit > 0 else -1, max(offset, 0))).fetchall()
+    conn.close()
+    return total, [list(x) for x in rows]
+  segments = ListHistorySegments(comment_dir)
+  hist_paths = [x[1] for x in reversed(segments)]
+  return CountHistoryLines(segments), ReadHistory(hist_paths, offset, limit, since)
+
+
+# The snapshot is written after the transaction is committed, so that the write lock of the
+# database is not held during file I/O.  The counts are read under the lock of the snapshot, so
+# the last writer always sees every committed comment.
+def WriteSqliteCommentCounts(conn, comment_dir):
+  path = os.path.join(comment_dir, COUNT_FILE)
+  try:
+    lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+  except OSError:
+    return False
+  try:
+    fcntl.flock(lock_fd, fcntl.LOCK_EX)
+    counts = {}
+    for resource, count, size, date in conn.execute(
+        "SELECT resource, count, size, date FROM counts"):
+      counts[resource] = (count, DateToUnixTime(date), size)
+    WriteCommentCounts(path, counts)
+  except OSError:
+    return False
+  finally:
+    os.close(lock_fd)
   return True
 
 
+# Run with --rebuild-counts once after upgrading a site whose snapshot was written before it was
+# seeded from all comment files.
+def RebuildCommentCounts(comment_dir):
+  if STORAGE_BACKEND == "sqlite":
+    conn = OpenCommentDatabase(comment_dir)
+    try:
+      WriteSqliteCommentCounts(conn, comment_dir)
+    finally:
+      conn.close()
+    return
+  path = os.path.join(comment_dir, COUNT_FILE)
+  lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+  fcntl.flock(lock_fd, fcntl.LOCK_EX)
+  try:
+    WriteCommentCounts(path, ScanCommentCounts(comment_dir))
+  finally:
+    os.close(lock_fd)
+
+
+def MigrateToSqlite(comment_dir):
+  conn = OpenCommentDatabase(comment_dir, True)
+  conn.execute("BEGIN IMMEDIATE")
+  conn.execute("DELETE FROM comments")
+  conn.execute("DELETE FROM counts")
+  conn.execute("DELETE FROM history")
+  num_resources = 0
+  num_comments = 0
+  for name in sorted(os.listdir(comment_dir)):
+    if not name.endswith(".cmt"): continue
+    resource = re.sub(r"\.cmt$", "", name)
+    count = 0
+    size = 0
+    date = ""
+    with open(os.path.join(comment_dir, name), "rb") as input_file:
+      fcntl.flock(input_file.fileno(), fcntl.LOCK_SH)
+      for line in input_file:
+        fields = line.decode("UTF-8", "replace").strip().split("\t")
+        if len(fields) != 4: continue
+        conn.execute("INSERT INTO comments (resource, date, addr, author, text)"
+                     " VALUES (?, ?, ?, ?, ?)", [resource] + fields)
+        count += 1
+        size += len(line)
+        date = fields[0]
+    if count > 0:
+      conn.execute("INSERT INTO counts (resource, count, size, date) VALUES (?, ?, ?, ?)",
+                   (resource, count, size, date))
+      num_resources += 1
+      num_comments += count
+  num_history = 0
+  for number, path in ListHistorySegments(comment_dir):
+    with open(path, "rb") as input_file:
+      fcntl.flock(input_file.fileno(), fcntl.LOCK_SH)
+      for line in input_file:
+        fields = line.decode("UTF-8", "replace").strip().split("\t")
+        if len(fields) != 6: continue
+        conn.execute("INSERT INTO history (date, resource, title, addr, author, text)"
+                     " VALUES (?, ?, ?, ?, ?, ?)", fields)
+        num_history += 1
+  conn.execute("COMMIT")
+  WriteSqliteCommentCounts(conn, comment_dir)
+  conn.close()
+  return num_resources, num_comments, num_history
+
+
+def GetFileStamp(path):
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def GetCachedValue(cache, key, stamp):
+  with cache_lock:
+    entry = cache.get(key)
+    if entry is None or entry[0] != stamp:
+      return None
+    cache.move_to_end(key)
+    return entry[1]
+
+
+def SetCachedValue(cache, key, stamp, value):
+  with cache_lock:
+    cache[key] = (stamp, value)
+    cache.move_to_end(key)
+    while len(cache) > SERVER_CACHE_ENTRIES:
+      cache.popitem(last=False)
+
+
+def GetResourceLock(resource):
+  if resource_locks is None:
+    return contextlib.nullcontext()
+  with cache_lock:
+    lock = resource_locks.get(resource)
+    if not lock:
+      lock = threading.Lock()
+      resource_locks[resource] = lock
+    return lock
+
+
+def EnableServerCaches():
+  global thread_cache, resource_cache, resource_locks
+  with cache_lock:
+    if thread_cache is None:
+      thread_cache = collections.OrderedDict()
+      resource_cache = collections.OrderedDict()
+      resource_locks = {}
+
+
+def application(environ, start_response):
+  EnableServerCaches()
+  forwarded_addr = environ.get("HTTP_X_FORWARDED_FOR", "").split(",")[-1].strip()
+  if forwarded_addr and environ.get("REMOTE_ADDR", "") in ("127.0.0.1", "::1"):
+    environ = dict(environ)
+    environ["REMOTE_ADDR"] = forwarded_addr
+  return bbb_web.RunApplication(HandleRequest, environ, start_response)
+
+
+def RunCommand(args):
+  if args[0] == "--serve" and len(args) in (2, 3):
+    return bbb_web.RunServer(args[1], args[2] if len(args) > 2 else ".", application)
+  if args[0] == "--migrate-sqlite" and len(args) <= 2:
+    comment_dir = args[1] if len(args) > 1 else COMMENT_DIR
+    num_resources, num_comments, num_history = MigrateToSqlite(comment_dir)
+    print("Imported {} comments on {} resources and {} history records into {}".format(
+      num_comments, num_resources, num_history, os.path.join(comment_dir, SQLITE_FILE)))
+    return 0
+  if args[0] == "--rebuild-counts" and len(args) <= 2:
+    comment_dir = args[1] if len(args) > 1 else COMMENT_DIR
+    RebuildCommentCounts(comment_dir)
+    print("Rebuilt {}".format(os.path.join(comment_dir, COUNT_FILE)))
+    return 0
+  print("usage: bbb_comment.cgi --migrate-sqlite [comment_dir]", file=sys.stderr)
+  print("       bbb_comment.cgi --rebuild-counts [comment_dir]", file=sys.stderr)
+  print("       bbb_comment.cgi --serve [host:]port [base_dir]", file=sys.stderr)
+  return 1
+
+
 def DoListResources(resource_dir, params):
-  names = []
-  for name in os.listdir(resource_dir):
-    if not name.endswith(".xhtml"): continue
-    names.append(re.sub(r"\.xhtml$", "", name))
   resources = []
-  for name in names:
-    path = os.path.join(resource_dir, name + ".xhtml")
-    meta = ReadResourceMeta(path)
-    if not meta: return
-    resources.append((name, meta[0], meta[1]))
+  try:
+    registry_path = os.path.join(resource_dir, RESOURCE_REGISTRY_FILE)
+    for record in ReadResourceRegistry(registry_path):
+      resources.append(record[:3])
+  except OSError:
+    names = []
+    for name in os.listdir(resource_dir):
+      if not name.endswith(".xhtml"): continue
+      names.append(re.sub(r"\.xhtml$", "", name))
+    for name in names:
+      path = os.path.join(resource_dir, name + ".xhtml")
+      meta = ReadResourceMeta(path)
+      if not meta: return
+      resources.append((name, meta[0], meta[1]))
   resources = sorted(resources, key=lambda x: x[0])
   print("Content-Type: text/plain; charset=UTF-8")
   print("")
@@ -255,52 +984,89 @@ def DateToUnixTime(date):
   return int(ts.timestamp())
 
 
-def DoCountComments(resource_dir, comment_dir, params):
+def DoCountComments(resource_dir, comment_dir, params, if_none_match):
   p_resource = params.get("resource") or ""
   if not CheckResourceName(p_resource):
     PrintError(400, "Bad Request", "bad resource name")
     return
-  res_path = os.path.join(resource_dir, p_resource + ".xhtml")
-  meta = ReadResourceMeta(res_path)
+  meta = LookUpResource(resource_dir, p_resource)
   if not meta:
     PrintError(403, "Forbidden", "not an article resource")
     return
-  cmt_path = os.path.join(comment_dir, p_resource + ".cmt")
-  comments = ReadComments(cmt_path)
-  count = len(comments)
-  date = -1
-  if comments:
-    date = DateToUnixTime(comments[-1][0])
+  validator = LoadCommentValidator(comment_dir, p_resource)
+  if CheckNotModified(if_none_match, validator):
+    return
+  count, date = LoadCommentCounts(comment_dir, [p_resource])[p_resource]
+  PrintValidatorHeaders(validator)
   print("Content-Type: text/plain; charset=UTF-8")
   print()
   print(count)
   print(date)
 
 
-def DoListComments(resource_dir, comment_dir, params):
+def DoBatchCountComments(resource_dir, comment_dir, params):
+  p_resources = params.get("resources") or ""
+  resources = []
+  for resource in p_resources.split("\n"):
+    resource = resource.strip()
+    if not CheckResourceName(resource) or resource in resources: continue
+    resources.append(resource)
+  if len(resources) > MAX_BATCH_RESOURCES:
+    PrintError(400, "Bad Request", "too many resources")
+    return
+  registry = None
+  try:
+    registry_path = os.path.join(resource_dir, RESOURCE_REGISTRY_FILE)
+    registry = set([x[0] for x in ReadResourceRegistry(registry_path)])
+  except OSError:
+    pass
+  if registry is None:
+    resources = [x for x in resources
+                 if ReadResourceMeta(os.path.join(resource_dir, x + ".xhtml"))]
+  else:
+    resources = [x for x in resources if x in registry]
+  counts = LoadCommentCounts(comment_dir, resources)
+  print("Content-Type: text/plain; charset=UTF-8")
+  print()
+  for resource in resources:
+    count, date = counts[resource]
+    print("{}\t{}\t{}".format(resource, count, date))
+
+
+def DoListComments(resource_dir, comment_dir, params, request):
   p_resource = params.get("resource") or ""
   if not CheckResourceName(p_resource):
     PrintError(400, "Bad Request", "bad resource name")
     return
-  res_path = os.path.join(resource_dir, p_resource + ".xhtml")
-  meta = ReadResourceMeta(res_path)
+  meta = LookUpResource(resource_dir, p_resource)
   if not meta:
     PrintError(403, "Forbidden", "not an article resource")
     return
-  cmt_path = os.path.join(comment_dir, p_resource + ".cmt")
-  comments = ReadComments(cmt_path)
+  p_offset = TextToInt(params.get("offset") or "0")
+  p_limit = TextToInt(params.get("limit") or "0")
+  p_since = TextToInt(params.get("since") or "0")
+  since = UnixTimeToDate(p_since) if p_since > 0 else ""
+  validator = GetEncodedValidator(LoadCommentValidator(comment_dir, p_resource), request)
+  if CheckNotModified(request.header("If-None-Match"), validator):
+    return
+  comments = LoadComments(comment_dir, p_resource, p_offset, p_limit, since)
+  PrintValidatorHeaders(validator)
   print("Content-Type: text/plain; charset=UTF-8")
-  print()
-  for comment in comments:
-    print("\t".join(comment))
+  with bbb_web.CompressOutput(request, COMPRESS_OUTPUT, COMPRESS_MIN_SIZE):
+    for comment in comments:
+      print("\t".join(comment))
+
 
+def CalculateNonce(resource_id, size):
+  message = "{}\t{}".format(resource_id, size).encode("UTF-8")
+  return hmac.new(NONCE_SALT.encode("UTF-8"), message, hashlib.md5).hexdigest()
 
-def CalculateNonce(resource_id, comments):
-  h = hashlib.new('md5')
-  h.update((NONCE_SALT + resource_id).encode())
-  for comment in comments:
-    h.update("".join(comment).encode("UTF-8"))
-  return h.hexdigest()
+
+def GetCommentFileSize(path):
+  try:
+    return os.stat(path).st_size
+  except:
+    return 0
 
 
 def DoGetNonce(resource_dir, comment_dir, params):
@@ -308,14 +1074,11 @@ def DoGetNonce(resource_dir, comment_dir, params):
   if not CheckResourceName(p_resource):
     PrintError(400, "Bad Request", "bad resource name")
     return
-  res_path = os.path.join(resource_dir, p_resource + ".xhtml")
-  meta = ReadResourceMeta(res_path)
+  meta = LookUpResource(resource_dir, p_resource)
   if not meta:
     PrintError(403, "Forbidden", "not an article resource")
     return
-  cmt_path = os.path.join(comment_dir, p_resource + ".cmt")
-  comments = ReadComments(cmt_path)
-  nonce = CalculateNonce(p_resource, comments)
+  nonce = LoadNonce(comment_dir, p_resource)
   print("Content-Type: text/plain; charset=UTF-8")
   print()
   print(nonce)
@@ -340,65 +1103,54 @@ def DoPostComment(resource_dir, comment_dir, params, remote_addr):
   if not p_text or len(p_text) > MAX_TEXT_LEN:
     PrintError(400, "Bad Request",  "text is empty or too long")
     return
-  res_path = os.path.join(resource_dir, p_resource + ".xhtml")
-  meta = ReadResourceMeta(res_path)
+  meta = LookUpResource(resource_dir, p_resource)
   if not meta:
     PrintError(403, "Forbidden", "not an article resource")
     return
+  if "nocomment" in meta[2]:
+    PrintError(403, "Forbidden", "comments are disabled")
+    return
   article_title = meta[0]
-  cmt_path = os.path.join(comment_dir, p_resource + ".cmt")
-  if CHECK_NONCE:
-    comments = ReadComments(cmt_path)
-    nonce = CalculateNonce(p_resource, comments)
-    if p_nonce != nonce:
-      PrintError(409, "Conflict", "nonce doesn't match")
-      return
   date = GetCurrentDate()
-  if not WriteComment(cmt_path, date, remote_addr, p_author, p_text):
-    PrintError(500, "Internal Server Error", "writing comment failed")
+  status = StoreComment(comment_dir, p_resource, p_nonce if CHECK_NONCE else None,
+                        date, remote_addr, p_author, p_text, article_title)
+  if status == "conflict":
+    PrintError(409, "Conflict", "nonce doesn't match")
     return
-  hist_path = os.path.join(comment_dir, HISTORY_FILE)
-  if not WriteHistory(hist_path, date, p_resource, article_title, remote_addr, p_author, p_text):
-    PrintError(500, "Internal Server Error", "writing history failed")
+  if status != "ok":
+    PrintError(500, "Internal Server Error", "writing comment failed")
     return
   print("Content-Type: text/plain; charset=UTF-8")
   print()
   print("Updated: " + p_resource)
 
 
-def ReadHistory(path):
-  comments = []
-  try:
-    fd = os.open(path, os.O_RDONLY)
-    fcntl.flock(fd, fcntl.LOCK_SH)
-    input_file = os.fdopen(fd, "r")
-    for line in input_file:
-      fields = line.strip().split("\t")
-      if len(fields) != 6: continue
-      del fields[3]
-      comments.append(fields)
-    input_file.close()
-  except:
-    pass
-  comments.reverse()
+def ReadHistory(paths, offset, limit, since):
+  comments = ReadRecentRecords(paths, 6, offset, limit, since)
+  for fields in comments:
+    del fields[3]
   return comments
 
 
-def DoListHistory(comment_dir, params):
-  p_max = TextToInt(params.get("max") or "0")
-  hist_path = os.path.join(comment_dir, HISTORY_FILE)
-  comments = ReadHistory(hist_path)
+def DoListHistory(comment_dir, params, request):
+  p_offset = TextToInt(params.get("offset") or "0")
+  p_limit = TextToInt(params.get("limit") or params.get("max") or "0")
+  p_since = TextToInt(params.get("since") or "0")
+  since = UnixTimeToDate(p_since) if p_since > 0 else ""
+  validator = GetEncodedValidator(LoadHistoryValidator(comment_dir), request)
+  if CheckNotModified(request.header("If-None-Match"), validator):
+    return
+  total, comments = LoadHistory(comment_dir, p_offset, p_limit, since)
+  PrintValidatorHeaders(validator)
   print("Content-Type: text/plain; charset=UTF-8")
-  print()
-  print("{}".format(len(comments)))
-  if p_max > 0 and len(comments) > p_max:
-    comments = comments[:p_max]
-  for comment in comments:
-    print("\t".join(comment))
+  with bbb_web.CompressOutput(request, COMPRESS_OUTPUT, COMPRESS_MIN_SIZE):
+    print("{}".format(total))
+    for comment in comments:
+      print("\t".join(comment))
 
 
 if __name__=="__main__":
-  main()
+  sys.exit(main())
 
 
 # END OF FILE
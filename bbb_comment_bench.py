@@ -0,0 +1,194 @@
+#! /usr/bin/python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Stress test of comment posting with concurrent processes
+#
+# Copyright 2024 Mikio Hirabayashi
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain a copy of the License at
+#     https://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the
+# License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.  See the License for the specific language governing permissions
+# and limitations under the License.
+#--------------------------------------------------------------------------------------------------
+
+import argparse
+import collections
+import importlib.machinery
+import importlib.util
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import types
+
+
+MAX_RETRIES = 100
+
+
+def main(argv):
+  ap = argparse.ArgumentParser(
+    prog="bbb_comment_bench.py", description="BBB comment stress test",
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  ap.add_argument("--script", default=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bbb_comment.cgi"))
+  ap.add_argument("--backend", default="tsv", choices=["tsv", "sqlite"])
+  ap.add_argument("--processes", type=int, default=8)
+  ap.add_argument("--posts", type=int, default=50)
+  ap.add_argument("--resources", type=int, default=1)
+  ap.add_argument("--segment-size", type=int, default=1024 * 8)
+  ap.add_argument("--max-p99", type=float, default=0)
+  args = ap.parse_args(argv)
+  with tempfile.TemporaryDirectory() as comment_dir:
+    resources = ["bench-{:03d}".format(i) for i in range(max(args.resources, 1))]
+    with open(os.path.join(comment_dir, "__resources__.tsv"), "w") as output_file:
+      for resource in resources:
+        print("{}\tBench {}\t2024/01/01\t".format(resource, resource), file=output_file)
+    tasks = []
+    start_time = time.time() + 0.5
+    for worker_id in range(args.processes):
+      tasks.append((args.script, args.backend, args.segment_size, comment_dir,
+                    resources, worker_id, args.posts, start_time))
+    with multiprocessing.Pool(args.processes) as pool:
+      results = pool.map(RunWorker, tasks)
+    end_time = max([x["end_time"] for x in results])
+    report = CheckStorage(args.script, args.backend, comment_dir, resources, results)
+  latencies = sorted(sum([x["latencies"] for x in results], []))
+  num_posts = len(latencies)
+  num_attempts = sum([x["attempts"] for x in results])
+  num_conflicts = sum([x["conflicts"] for x in results])
+  num_errors = sum([x["errors"] for x in results])
+  lock_wait = sum([x["lock_wait"] for x in results])
+  elapsed_time = max(end_time - start_time, 1e-9)
+  p50 = GetPercentile(latencies, 0.50) * 1000
+  p99 = GetPercentile(latencies, 0.99) * 1000
+  print("backend: {}".format(args.backend))
+  print("processes: {}".format(args.processes))
+  print("resources: {}".format(len(resources)))
+  print("posts: {}".format(num_posts))
+  print("elapsed_time: {:.3f}s".format(elapsed_time))
+  print("throughput: {:.1f} posts/s".format(num_posts / elapsed_time))
+  print("latency_p50: {:.3f}ms".format(p50))
+  print("latency_p99: {:.3f}ms".format(p99))
+  print("lock_wait_total: {:.3f}s".format(lock_wait))
+  print("lock_wait_per_post: {:.3f}ms".format(lock_wait / max(num_posts, 1) * 1000))
+  print("conflict_rate: {:.4f}".format(num_conflicts / max(num_attempts, 1)))
+  print("errors: {}".format(num_errors))
+  for name, value in report.items():
+    print("{}: {}".format(name, value))
+  failed = num_errors > 0 or any(report.values())
+  if args.max_p99 > 0 and p99 > args.max_p99:
+    print("p99 latency exceeds {:.3f}ms".format(args.max_p99))
+    failed = True
+  print("result: {}".format("FAILED" if failed else "OK"))
+  return 1 if failed else 0
+
+
+def LoadCommentModule(script, backend, segment_size):
+  loader = importlib.machinery.SourceFileLoader("bbb_comment", script)
+  spec = importlib.util.spec_from_loader("bbb_comment", loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  module.STORAGE_BACKEND = backend
+  module.MAX_HISTORY_SEGMENT_SIZE = segment_size
+  module.MAX_HISTORY_SEGMENTS = sys.maxsize
+  module.MAX_HISTORY_RECORDS = sys.maxsize
+  module.MAX_COMMENT_FILE_SIZE = sys.maxsize
+  module.CHECK_NONCE = True
+  return module
+
+
+def RunWorker(task):
+  script, backend, segment_size, comment_dir, resources, worker_id, num_posts, start_time = task
+  module = LoadCommentModule(script, backend, segment_size)
+  stats = {"latencies": [], "posted": [], "attempts": 0, "conflicts": 0, "errors": 0,
+           "lock_wait": 0.0}
+  real_fcntl = module.fcntl
+  def TimedFlock(fd, operation):
+    lock_start = time.perf_counter()
+    real_fcntl.flock(fd, operation)
+    stats["lock_wait"] += time.perf_counter() - lock_start
+  module.fcntl = types.SimpleNamespace(
+    flock=TimedFlock, LOCK_SH=real_fcntl.LOCK_SH, LOCK_EX=real_fcntl.LOCK_EX)
+  time.sleep(max(start_time - time.time(), 0))
+  for seq in range(num_posts):
+    resource = resources[(worker_id + seq) % len(resources)]
+    text = "w{}-{}".format(worker_id, seq)
+    post_start = time.perf_counter()
+    for retry in range(MAX_RETRIES):
+      stats["attempts"] += 1
+      nonce = module.LoadNonce(comment_dir, resource)
+      status = module.StoreComment(comment_dir, resource, nonce, module.GetCurrentDate(),
+                                   "10.0.0.{}".format(worker_id), "bench", text, "Bench")
+      if status != "conflict": break
+      stats["conflicts"] += 1
+    if status == "ok":
+      stats["latencies"].append(time.perf_counter() - post_start)
+      stats["posted"].append(text)
+    else:
+      stats["errors"] += 1
+  stats["end_time"] = time.time()
+  return stats
+
+
+def CheckStorage(script, backend, comment_dir, resources, results):
+  module = LoadCommentModule(script, backend, 0)
+  expected = set(sum([x["posted"] for x in results], []))
+  comment_counts = collections.Counter()
+  history_counts = collections.Counter()
+  num_corrupted = 0
+  num_bad_counts = 0
+  for resource in resources:
+    if backend == "tsv":
+      num_records = 0
+      with open(os.path.join(comment_dir, resource + ".cmt"), "rb") as input_file:
+        for line in input_file:
+          fields = line.decode("UTF-8", "replace").rstrip("\n").split("\t")
+          if (not line.endswith(b"\n") or len(fields) != 4 or
+              not re.fullmatch(r"\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}", fields[0])):
+            num_corrupted += 1
+            continue
+          comment_counts[fields[3]] += 1
+          num_records += 1
+    else:
+      comments = module.LoadComments(comment_dir, resource, 0, 0, "")
+      for comment in comments:
+        comment_counts[comment[2]] += 1
+      num_records = len(comments)
+    count = module.LoadCommentCounts(comment_dir, [resource])[resource][0]
+    if count != num_records:
+      num_bad_counts += 1
+  total, history = module.LoadHistory(comment_dir, 0, 0, "")
+  for record in history:
+    history_counts[record[4]] += 1
+  if backend == "tsv":
+    for number, path in module.ListHistorySegments(comment_dir):
+      with open(path, "rb") as input_file:
+        for line in input_file:
+          if not line.endswith(b"\n") or len(line.split(b"\t")) != 6:
+            num_corrupted += 1
+  report = collections.OrderedDict()
+  report["lost_comments"] = len(expected - set(comment_counts))
+  report["duplicated_comments"] = sum([x - 1 for x in comment_counts.values() if x > 1])
+  report["unexpected_comments"] = len(set(comment_counts) - expected)
+  report["lost_history"] = len(expected - set(history_counts))
+  report["duplicated_history"] = sum([x - 1 for x in history_counts.values() if x > 1])
+  report["corrupted_lines"] = num_corrupted
+  report["mismatched_counts"] = num_bad_counts
+  return report
+
+
+def GetPercentile(values, ratio):
+  if not values:
+    return 0.0
+  return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
+
+
+# END OF FILE
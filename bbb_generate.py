@@ -14,18 +14,27 @@
 #--------------------------------------------------------------------------------------------------
 
 import argparse
+import array
 import collections
+import gzip
+import hashlib
+import heapq
 import html
+import io
 import logging
 import os
 import re
 import shutil
+import struct
 import sys
+import threading
 import time
 import urllib
 import urllib.parse
 import urllib.request
 
+import bbb_text
+
 
 MAIN_HEADER_TEXT = r"""
 <?xml version="1.0" encoding="UTF-8"?>
@@ -70,6 +79,19 @@ HATENA_BUTTON_TEXT = r"""
 """
 MAX_DESCRIPTION_WIDTH = 160
 MAX_HOARD_FILE_SIZE = 1024 * 1024 * 256
+TEXT_STORE_DIR = "__text__"
+VERSION_FILE = "__version__.txt"
+FIELD_INDEX_FILE = "__fields__.tsv"
+TERM_DICT_FILE = "__terms__.dat"
+TERM_DICT_MAGIC = b"BBBTRM2\n"
+SUGGEST_PREFIX_LENGTH = 2
+MAX_SUGGESTIONS = 10
+MAX_TERM_LENGTH = 32
+STATIC_SEARCH_FILE = "__search__.tsv"
+STATIC_SEARCH_DIR = "__search__"
+STATIC_SHARD_SIZE = 1024 * 64
+STATIC_TITLE_WEIGHT = 10
+RESOURCE_REGISTRY_FILE = "__resources__.tsv"
 MIME_EXTS = {
   "application/octet-stream": "oct",
   "application/xhtml+xml": "xhtml",
@@ -118,38 +140,93 @@ def main(argv):
       focus_stem_set.add(stem)
   start_time = time.time()
   logger.info("Process started: conf={}".format(conf_path))
-  config = ReadConfig(conf_path, with_hoard)
-  logger.info("Config: {}".format(str(config)))
-  EnhanceConfig(config)
-  articles = ReadInputDir(config, focus_stem_set)
-  if not articles:
-    raise ValueError("no input files")
-  logger.info("Number of articles: {}".format(len(articles)))
-  index = {}
-  count_index = collections.defaultdict(int)
-  for article in articles:
-    esc_name = "filename:" + re.sub(r"\.art$", "", article["name"])
-    index[esc_name] = article
-    title = article.get("title")
-    if title:
-      title = title.lower()
-      count = count_index[title] + 1
-      if count > 1:
-        title = title + " ({:d})".format(count)
-      if title not in index:
-        index[title] = article
-      count_index[title] = count
-  MakeOutputDir(config, focus_stem_set)
-  if with_hoard:
-    for article in articles:
-      HoardDataAndRewriteArticle(config, article)
-  for article in articles:
-    MakeArticle(config, articles, index, article)
-  if not focus_stem_set:
-    MakeTocFile(config, articles)
+  site = Site(conf_path, with_hoard)
+  site.generate(focus_stem_set)
   logger.info("Process done: elapsed_time={:.3f}s".format(time.time() - start_time))
 
 
+# A site keeps the config and the metadata of articles in memory so that a host process like
+# the manager can render and regenerate articles without running this script each time.
+# Metadata of an article is read again only when the stat of the file changes.
+class Site:
+  def __init__(self, conf_path, with_hoard=False):
+    self.conf_path = conf_path
+    self.with_hoard = with_hoard
+    self.config = None
+    self.config_stamp = None
+    self.article_cache = {}
+    self.lock = threading.RLock()
+
+  def load(self):
+    with self.lock:
+      st = os.stat(self.conf_path)
+      stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+      if stamp != self.config_stamp:
+        config = ReadConfig(self.conf_path, self.with_hoard)
+        logger.info("Config: {}".format(str(config)))
+        EnhanceConfig(config)
+        self.config = config
+        self.config_stamp = stamp
+        self.article_cache = {}
+      return self.config
+
+  def read_articles(self, focus_stem_set=None):
+    with self.lock:
+      config = self.load()
+      return ReadInputDir(config, focus_stem_set or set(), self.article_cache)
+
+  def render_article(self, stem, text=None):
+    with self.lock:
+      config = self.load()
+      articles = self.read_articles()
+      index = MakeArticleIndex(articles)
+      name = stem + ".art"
+      path = os.path.join(config["input_dir"], name)
+      article = None
+      if text is None:
+        for candidate in articles:
+          if candidate["stem"] == stem:
+            article = candidate
+        with open(path) as input_file:
+          text = input_file.read()
+      lines = text.split("\n")
+      if article is None:
+        article = ParseArticleMetadata(path, lines)
+        article["name"] = name
+        article["stem"] = stem
+      return RenderArticle(config, articles, index, article, lines)
+
+  def generate(self, focus_stem_set=None):
+    with self.lock:
+      focus_stem_set = focus_stem_set or set()
+      config = self.load()
+      articles = self.read_articles(focus_stem_set)
+      if not articles:
+        raise ValueError("no input files")
+      logger.info("Number of articles: {}".format(len(articles)))
+      index = MakeArticleIndex(articles)
+      old_metas = []
+      if focus_stem_set:
+        old_metas = ReadTextStoreMetas(config, True, focus_stem_set)
+      MakeOutputDir(config, focus_stem_set)
+      if self.with_hoard:
+        for article in articles:
+          HoardDataAndRewriteArticle(config, article)
+      for article in articles:
+        MakeArticle(config, articles, index, article)
+      if not focus_stem_set:
+        MakeTocFile(config, articles)
+      site_articles = articles
+      if focus_stem_set:
+        site_articles = MergeSiteArticles(config, articles, focus_stem_set, self.article_cache)
+      MakeFieldIndex(config, site_articles)
+      MakeResourceRegistry(config, site_articles)
+      MakeTermDictionary(config, focus_stem_set, old_metas)
+      if config.get("search_mode") == "static":
+        MakeStaticSearchIndex(config, focus_stem_set)
+      MakeVersionFile(config)
+
+
 def ReadConfig(conf_path, with_hoard):
   config = {}
   with open(conf_path) as input_file:
@@ -209,6 +286,11 @@ def EnhanceConfig(config):
 
 
 def ReadArticleMetadata(path):
+  with open(path) as input_file:
+    return ParseArticleMetadata(path, input_file)
+
+
+def ParseArticleMetadata(path, lines):
   title = ""
   date = ""
   tags = ""
@@ -216,44 +298,43 @@ def ReadArticleMetadata(path):
   desc = ""
   top_image = ""
   images = []
-  with open(path) as input_file:
-    end_pre_line = ""
-    for line in input_file:
-      line = line.rstrip()
-      if end_pre_line:
-        if line == end_pre_line:
-          end_pre_line = ""
-        continue
-      else:
-        match = re.search(r"^(>+)\|([a-z]*)\|$", line)
-        if match:
-          end_pre_line = "||" + ("<" * len(match.group(1)))
-          continue
-      match = re.search(r"^@title +([^\s].*)$", line)
-      if match and not title:
-        title = match.group(1).strip()
-      match = re.search(r"^@date +([^\s].*)$", line)
-      if match and not date:
-        date = match.group(1).strip()
-      match = re.search(r"^@tags +([^\s].*)$", line)
-      if match and not tags:
-        tags = match.group(1).strip()
-      match = re.search(r"^@misc +(.*)$", line)
-      if match and not misc:
-        misc = match.group(1).strip()
-      match = re.search(r"^@desc +([^\s].*)$", line)
-      if match and not desc:
-        desc = match.group(1).strip()
-      match = re.search(r"^@image +(.*)$", line)
+  end_pre_line = ""
+  for line in lines:
+    line = line.rstrip()
+    if end_pre_line:
+      if line == end_pre_line:
+        end_pre_line = ""
+      continue
+    else:
+      match = re.search(r"^(>+)\|([a-z]*)\|$", line)
       if match:
-        columns = match.group(1).split("|")
-        for column in columns:
-          attrs = ParseMetaParams(column)
-          url = attrs[""]
-          if url:
-            images.append(url)
-            if attrs.get("top") and not top_image:
-              top_image = url
+        end_pre_line = "||" + ("<" * len(match.group(1)))
+        continue
+    match = re.search(r"^@title +([^\s].*)$", line)
+    if match and not title:
+      title = match.group(1).strip()
+    match = re.search(r"^@date +([^\s].*)$", line)
+    if match and not date:
+      date = match.group(1).strip()
+    match = re.search(r"^@tags +([^\s].*)$", line)
+    if match and not tags:
+      tags = match.group(1).strip()
+    match = re.search(r"^@misc +(.*)$", line)
+    if match and not misc:
+      misc = match.group(1).strip()
+    match = re.search(r"^@desc +([^\s].*)$", line)
+    if match and not desc:
+      desc = match.group(1).strip()
+    match = re.search(r"^@image +(.*)$", line)
+    if match:
+      columns = match.group(1).split("|")
+      for column in columns:
+        attrs = ParseMetaParams(column)
+        url = attrs[""]
+        if url:
+          images.append(url)
+          if attrs.get("top") and not top_image:
+            top_image = url
   if (date and not re.fullmatch(r"\d{4}/\d{2}/\d{2}", date) and
       not re.fullmatch(r"\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}", date)):
     logger.warning("invalid date format: {}: {}".format(path, date))
@@ -271,7 +352,7 @@ def ReadArticleMetadata(path):
   return article
 
 
-def ReadInputDir(config, focus_stem_set):
+def ReadInputDir(config, focus_stem_set, cache=None):
   input_dir = config["input_dir"]
   names = os.listdir(input_dir)
   articles = []
@@ -281,13 +362,45 @@ def ReadInputDir(config, focus_stem_set):
     stem = re.sub(r"\.art$", "", name)
     if focus_stem_set and stem not in focus_stem_set: continue
     path = os.path.join(input_dir, name)
-    article = ReadArticleMetadata(path)
+    if cache is None:
+      article = ReadArticleMetadata(path)
+    else:
+      st = os.stat(path)
+      stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+      cached = cache.get(name)
+      if cached and cached[0] == stamp:
+        article = dict(cached[1])
+      else:
+        article = ReadArticleMetadata(path)
+        cache[name] = (stamp, dict(article))
     article["name"] = name
     article["stem"] = stem
     articles.append(article)
+  if cache is not None and not focus_stem_set:
+    for name in list(cache):
+      if name not in names:
+        del cache[name]
   return sorted(articles, key=lambda x: x["path"])
 
 
+def MakeArticleIndex(articles):
+  index = {}
+  count_index = collections.defaultdict(int)
+  for article in articles:
+    esc_name = "filename:" + re.sub(r"\.art$", "", article["name"])
+    index[esc_name] = article
+    title = article.get("title")
+    if title:
+      title = title.lower()
+      count = count_index[title] + 1
+      if count > 1:
+        title = title + " ({:d})".format(count)
+      if title not in index:
+        index[title] = article
+      count_index[title] = count
+  return index
+
+
 def MakeOutputDir(config, focus_stem_set):
   output_dir = config["output_dir"]
   os.makedirs(output_dir, exist_ok=True)
@@ -313,6 +426,12 @@ def MakeOutputDir(config, focus_stem_set):
           is_article = True
     if is_article or is_empty:
       os.remove(path)
+  text_dir = os.path.join(output_dir, TEXT_STORE_DIR)
+  if os.path.isdir(text_dir):
+    for name in os.listdir(text_dir):
+      stem = re.sub(r"\.bbt$", "", name)
+      if focus_stem_set and stem not in focus_stem_set: continue
+      os.remove(os.path.join(text_dir, name))
 
 
 def OrganizeSections(lines):
@@ -596,14 +715,288 @@ def MakeArticle(config, articles, index, article):
   if os.path.exists(out_article_path):
     raise FileExistsError("cannot overwrite an article: " + out_article_path)
   logger.info("Creating article: {} -> {}".format(article_path, out_article_path))
-  input_lines = []
   with open(article_path) as input_file:
-    for line in input_file:
-      line = re.sub(r"\s", " ", line.rstrip())
-      input_lines.append(line)
-  sections = OrganizeSections(input_lines)
+    content = RenderArticle(config, articles, index, article, input_file)
   with open(out_article_path, "w") as output_file:
-    PrintArticle(config, articles, index, article, sections, output_file)
+    output_file.write(content)
+  MakeTextStore(config, article, content.split("\n"))
+
+
+def RenderArticle(config, articles, index, article, lines):
+  input_lines = []
+  for line in lines:
+    line = re.sub(r"\s", " ", line.rstrip())
+    input_lines.append(line)
+  sections = OrganizeSections(input_lines)
+  output_buffer = io.StringIO()
+  PrintArticle(config, articles, index, article, sections, output_buffer)
+  return output_buffer.getvalue()
+
+
+def MakeTextStore(config, article, lines):
+  texts = bbb_text.ExtractSearchTexts(lines)
+  text_dir = os.path.join(config["output_dir"], TEXT_STORE_DIR)
+  os.makedirs(text_dir, exist_ok=True)
+  fields = []
+  for name in bbb_text.TEXT_STORE_FIELDS:
+    fields.append(NormalizeMetaText(article.get(name) or ""))
+  store_path = os.path.join(text_dir, article["stem"] + ".bbt")
+  tmp_path = store_path + ".tmp"
+  with open(tmp_path, "wb") as output_file:
+    bbb_text.WriteTextStore(output_file, fields, texts)
+  os.replace(tmp_path, store_path)
+
+
+def ReadTextStoreMetas(config, with_texts=False, stem_set=None):
+  text_dir = os.path.join(config["output_dir"], TEXT_STORE_DIR)
+  metas = []
+  if not os.path.isdir(text_dir):
+    return metas
+  if stem_set is None:
+    names = os.listdir(text_dir)
+  else:
+    names = [x + ".bbt" for x in stem_set if os.path.exists(os.path.join(text_dir, x + ".bbt"))]
+  for name in sorted(names):
+    if not name.endswith(".bbt"): continue
+    try:
+      meta, texts, _, _ = bbb_text.ReadTextStore(
+        os.path.join(text_dir, name), with_texts, False)
+    except Exception as e:
+      logger.warning("broken text store: {}: {}".format(name, str(e)))
+      continue
+    if with_texts:
+      meta["texts"] = texts
+    meta["stem"] = re.sub(r"\.bbt$", "", name)
+    metas.append(meta)
+  return metas
+
+
+def ListGeneratedArticles(config, articles):
+  output_dir = config["output_dir"]
+  generated = []
+  for article in articles:
+    if os.path.exists(os.path.join(output_dir, GetOutputFilename(article["name"]))):
+      generated.append(article)
+  return generated
+
+
+def ReadFieldIndexDocs(path):
+  doc_stems = []
+  docs = {}
+  with open(path) as input_file:
+    for line in input_file:
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) != 3: continue
+      if fields[0] == "doc":
+        doc_stems.append(fields[1])
+        docs[fields[1]] = (fields[2], [])
+      elif fields[0] == "tag":
+        for doc_id in fields[2].split(","):
+          docs[doc_stems[int(doc_id)]][1].append(fields[1])
+  return docs
+
+
+def ReadResourceRegistry(path):
+  records = {}
+  with open(path) as input_file:
+    for line in input_file:
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) != 4: continue
+      records[fields[0]] = fields[1:]
+  return records
+
+
+# A focused build takes the metadata of the other articles from the existing registry and field
+# index instead of reading every input file.  Articles missing from them, as on the first build
+# after an upgrade, are read from the input files.
+def MergeSiteArticles(config, articles, focus_stem_set, cache=None):
+  output_dir = config["output_dir"]
+  try:
+    records = ReadResourceRegistry(os.path.join(output_dir, RESOURCE_REGISTRY_FILE))
+    docs = ReadFieldIndexDocs(os.path.join(output_dir, FIELD_INDEX_FILE))
+  except (OSError, ValueError, IndexError, KeyError):
+    records = {}
+    docs = {}
+  site_articles = list(articles)
+  missing_stems = set()
+  for name in os.listdir(config["input_dir"]):
+    if name.startswith(".") or not name.endswith(".art"): continue
+    stem = re.sub(r"\.art$", "", name)
+    if stem in focus_stem_set: continue
+    record = records.get(stem)
+    doc = docs.get(stem)
+    if not record or (not doc and "nosearch" not in ParseMisc(record[2])):
+      missing_stems.add(stem)
+      continue
+    site_articles.append({
+      "name": name,
+      "stem": stem,
+      "title": record[0],
+      "date": record[1],
+      "tags": ",".join(doc[1]) if doc else "",
+      "misc": record[2],
+    })
+  if missing_stems:
+    site_articles.extend(ListGeneratedArticles(config, ReadInputDir(config, missing_stems, cache)))
+  return site_articles
+
+
+# The field index is built from the metadata of all articles so that focused builds keep it
+# complete.  Documents are sorted by date and the postings of tags and misc flags refer to their
+# positions.
+def MakeFieldIndex(config, articles):
+  output_dir = config["output_dir"]
+  docs = []
+  for article in articles:
+    misc = ParseMisc(article.get("misc") or "")
+    if "nosearch" in misc: continue
+    docs.append((NormalizeMetaText(article.get("date") or ""), article["stem"],
+                 ParseMisc(article.get("tags") or ""), misc))
+  docs.sort()
+  tag_index = collections.defaultdict(list)
+  misc_index = collections.defaultdict(list)
+  for doc_id, (date, stem, tags, misc) in enumerate(docs):
+    for tag in tags:
+      tag_index[tag].append(doc_id)
+    for flag in misc:
+      misc_index[flag].append(doc_id)
+  index_path = os.path.join(output_dir, FIELD_INDEX_FILE)
+  tmp_path = index_path + ".tmp"
+  with open(tmp_path, "w") as output_file:
+    for doc_id, (date, stem, tags, misc) in enumerate(docs):
+      print("doc\t{}\t{}".format(stem, date), file=output_file)
+    for label, field_index in [("tag", tag_index), ("misc", misc_index)]:
+      for name, doc_ids in sorted(field_index.items()):
+        print("{}\t{}\t{}".format(label, name, ",".join([str(x) for x in doc_ids])),
+              file=output_file)
+  os.replace(tmp_path, index_path)
+
+
+# The resource registry lists every article sorted by the UTF-8 bytes of the stem so that
+# the comment script can bisect it instead of opening each page.
+def MakeResourceRegistry(config, articles):
+  output_dir = config["output_dir"]
+  records = []
+  for article in articles:
+    misc = ParseMisc(article.get("misc") or "")
+    fields = [article["stem"], NormalizeMetaText(article.get("title") or ""),
+              NormalizeMetaText(article.get("date") or ""), ",".join(misc)]
+    fields = [re.sub(r"\s", " ", x) for x in fields]
+    records.append(fields)
+  records.sort(key=lambda x: x[0].encode("UTF-8"))
+  registry_path = os.path.join(output_dir, RESOURCE_REGISTRY_FILE)
+  tmp_path = registry_path + ".tmp"
+  with open(tmp_path, "w") as output_file:
+    for fields in records:
+      print("\t".join(fields), file=output_file)
+  os.replace(tmp_path, registry_path)
+
+
+def GetDictionaryTerms(meta):
+  doc_terms = {}
+  if "nosearch" in ParseMisc(meta.get("misc") or ""):
+    return doc_terms
+  for text in meta["texts"]:
+    for word in re.findall(r"\w+", text.lower()):
+      if len(word) < 2 or len(word) > MAX_TERM_LENGTH: continue
+      doc_terms[(word, "word")] = word
+  title = meta.get("title")
+  if title:
+    doc_terms[(title.lower(), "title")] = title
+  for tag in ParseMisc(meta.get("tags") or ""):
+    doc_terms[(tag.lower(), "tag")] = tag
+  return doc_terms
+
+
+def ReadTermDictionary(path, term_counts, displays):
+  with open(path, "rb") as input_file:
+    if input_file.read(len(TERM_DICT_MAGIC)) != TERM_DICT_MAGIC:
+      raise ValueError("bad term dictionary: " + path)
+    num_records, num_tops = struct.unpack("<II", input_file.read(8))
+    offsets = array.array("I", input_file.read((num_records + 1) * 4))
+    if sys.byteorder != "little":
+      offsets.byteswap()
+    input_file.seek((num_tops + 1) * 4, os.SEEK_CUR)
+    for line in input_file.read(offsets[-1]).decode().split("\n"):
+      fields = line.split("\t")
+      if len(fields) != 4: continue
+      term = (fields[0], fields[2])
+      term_counts[term] = int(fields[1])
+      displays[term] = fields[3]
+
+
+def MakeTermRecordTable(records):
+  offsets = array.array("I", [0])
+  for record in records:
+    offsets.append(offsets[-1] + len(record))
+  if sys.byteorder != "little":
+    offsets.byteswap()
+  return offsets.tobytes()
+
+
+# The term dictionary is a sorted list of lowercased words, titles and tags with their
+# document frequencies.  The table of record offsets lets readers bisect a mapped file.
+# The best completions of every short prefix are listed in a second table so that readers do
+# not scan the long ranges of such prefixes.
+# A focused build updates the existing dictionary with the terms of the old and new stores of
+# the focused articles instead of reading every store.
+def MakeTermDictionary(config, focus_stem_set=None, old_metas=None):
+  output_dir = config["output_dir"]
+  dict_path = os.path.join(output_dir, TERM_DICT_FILE)
+  term_counts = collections.defaultdict(int)
+  displays = {}
+  metas = None
+  if focus_stem_set and os.path.exists(dict_path):
+    try:
+      ReadTermDictionary(dict_path, term_counts, displays)
+      metas = ReadTextStoreMetas(config, True, focus_stem_set)
+    except Exception as e:
+      logger.warning("rebuilding the term dictionary: {}".format(str(e)))
+      term_counts.clear()
+      displays.clear()
+  if metas is None:
+    metas = ReadTextStoreMetas(config, True)
+  else:
+    for meta in old_metas or []:
+      for term in GetDictionaryTerms(meta):
+        count = term_counts.get(term, 0) - 1
+        if count > 0:
+          term_counts[term] = count
+        else:
+          term_counts.pop(term, None)
+          displays.pop(term, None)
+  for meta in metas:
+    for term, display in GetDictionaryTerms(meta).items():
+      term_counts[term] += 1
+      if term[1] != "word":
+        displays[term] = display
+  kind_ranks = {"tag": 0, "title": 1}
+  records = []
+  candidates = collections.defaultdict(list)
+  for (key, kind), count in sorted(term_counts.items()):
+    display = displays.get((key, kind)) or key
+    record = "{}\t{:d}\t{}\t{}\n".format(key, count, kind, display)
+    records.append(record.encode())
+    for length in range(1, min(len(key), SUGGEST_PREFIX_LENGTH) + 1):
+      candidates[key[:length]].append((kind_ranks.get(kind, 2), -count, display, kind))
+  top_records = []
+  for prefix, entries in sorted(candidates.items()):
+    top_displays = set()
+    for rank, count, display, kind in heapq.nsmallest(MAX_SUGGESTIONS * 3, entries):
+      if display in top_displays: continue
+      top_displays.add(display)
+      record = "{}\t{:d}\t{}\t{}\n".format(prefix, -count, kind, display)
+      top_records.append(record.encode())
+      if len(top_displays) >= MAX_SUGGESTIONS: break
+  tmp_path = dict_path + ".tmp"
+  with open(tmp_path, "wb") as output_file:
+    output_file.write(TERM_DICT_MAGIC)
+    output_file.write(struct.pack("<II", len(records), len(top_records)))
+    output_file.write(MakeTermRecordTable(records))
+    output_file.write(MakeTermRecordTable(top_records))
+    for record in records + top_records:
+      output_file.write(record)
+  os.replace(tmp_path, dict_path)
 
 
 def esc(expr):
@@ -986,7 +1379,7 @@ def PrintArticle(config, articles, index, article, sections, output_file):
       elif name == "page-toc":
         PrintPageToc(P, sections, params)
       elif name == "site-toc":
-        PrintSiteToc(P, articles, params)
+        PrintSiteToc(config, P, articles, params)
       elif name == "comment-history":
         PrintCommentHistory(config, P, params)
       elif name == "search":
@@ -1465,8 +1858,11 @@ def PrintPageToc(P, sections, params):
   P('</ul>')
 
 
-def PrintSiteToc(P, articles, params):
-  P('<div class="site_toc_area">')
+def PrintSiteToc(config, P, articles, params):
+  comment_url = config.get("comment_url") or ""
+  comment_count_url = config.get("comment_count_url") or ""
+  P('<div class="site_toc_area" data-comment-url="{}" data-comment-count-url="{}">',
+    comment_url, comment_count_url)
   attrs = ParseMetaParams(params)
   order = attrs.get("order")
   reverse = ToBool(attrs.get("reverse"))
@@ -1490,7 +1886,7 @@ def PrintSiteToc(P, articles, params):
     if not title:
       title = article["stem"]
     date = article.get("date")
-    P('<li class="site_toc_item">', end="")
+    P('<li class="site_toc_item" data-resource="{}">', article["stem"], end="")
     P('<a href="{}">{}</a>', url, title, end="")
     if date:
       P(' <span class="attrdate">({})</span>', date, end="")
@@ -1517,16 +1913,21 @@ def PrintSearch(config, P, params):
   max_num = int(attrs.get("max") or 0)
   perpage = int(attrs.get("perpage") or 0)
   search_url = config.get("search_url") or ""
-  if not search_url:
+  search_index = ""
+  if config.get("search_mode") == "static":
+    search_url = ""
+    search_index = STATIC_SEARCH_FILE
+  elif not search_url:
     P('<div>(@search: search_url is not set)</div>')
     return
-  P('<div class="search_area" data-search-url="{}"'
+  P('<div class="search_area" data-search-url="{}" data-search-index="{}"'
     ' data-search-max="{}" data-search-perpage="{}">',
-    search_url, max_num, perpage)
+    search_url, search_index, max_num, perpage)
   P('<form class="search_form" onsubmit="search_fulltext(this); return false;">')
   P('<div class="search_line">')
   P('<span class="search_control">')
-  P('<input type="text" class="search_query" value=""/>')
+  P('<input type="text" class="search_query" value="" autocomplete="off"'
+    ' oninput="suggest_search(this);"/>')
   P('<select class="search_order">')
   P('<option value="score">order: score</option>')
   P('<option value="name">name asc</option>')
@@ -1590,7 +1991,10 @@ def PrintTags(config, P, article):
     P('<span onclick="search_tags(this);" class="tag">{}</span>', tag)
   P('</div>')
   stem = article["stem"]
-  P('<div id="tags_result" data-resource="{}"></div>', stem)
+  comment_url = config.get("comment_url") or ""
+  comment_count_url = config.get("comment_count_url") or ""
+  P('<div id="tags_result" data-resource="{}" data-comment-url="{}"'
+    ' data-comment-count-url="{}"></div>', stem, comment_url, comment_count_url)
   P('</div>')
 
 
@@ -1670,8 +2074,9 @@ def PrintComments(config, P, article):
   comment_url = config.get("comment_url") or ""
   if not comment_url: return
   stem = article["stem"]
-  P('<div class="comment_area" id="comment_area" data-comment-url="{}" data-resource="{}">',
-    comment_url, stem)
+  comment_count_url = config.get("comment_count_url") or ""
+  P('<div class="comment_area" id="comment_area" data-comment-url="{}"'
+    ' data-comment-count-url="{}" data-resource="{}">', comment_url, comment_count_url, stem)
   P('<span id="comment_banner" onclick="render_comments();">comments</span>')
   P('<div id="comment_list">----</div>')
   P('<form id="comment_form" onsubmit="return false;">')
@@ -1716,6 +2121,146 @@ def MakeTocFile(config, articles):
             file=output_file)
 
 
+# Wide characters are indexed as bigrams as they are not separated by spaces.
+# bbb.js implements the same tokenization in tokenize_static_text.
+def TokenizeStaticText(text):
+  tokens = []
+  for run in re.findall(r"\w+", text.lower()):
+    for segment in re.findall(r"[\u3000-\uffff]+|[^\u3000-\uffff]+", run):
+      if segment[0] >= "\u3000" and segment[0] <= "\uffff":
+        if len(segment) == 1:
+          tokens.append(segment)
+        for i in range(len(segment) - 1):
+          tokens.append(segment[i:i + 2])
+      elif len(segment) <= MAX_TERM_LENGTH:
+        tokens.append(segment)
+  return tokens
+
+
+def WriteStaticSearchFile(search_dir, suffix, lines):
+  data = gzip.compress("".join(lines).encode(), mtime=0)
+  filename = hashlib.md5(data).hexdigest()[:16] + suffix
+  path = os.path.join(search_dir, filename)
+  if not os.path.exists(path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as output_file:
+      output_file.write(data)
+    os.replace(tmp_path, path)
+  return STATIC_SEARCH_DIR + "/" + filename
+
+
+def ReadStaticSearchIndex(output_dir, manifest_path, docs, postings):
+  with open(manifest_path) as input_file:
+    manifest_lines = input_file.readlines()
+  doc_stems = []
+  for line in manifest_lines:
+    fields = line.rstrip("\n").split("\t")
+    if fields[0] != "docs": continue
+    with gzip.open(os.path.join(output_dir, fields[1]), "rt") as input_file:
+      for doc_line in input_file:
+        stem, title, date = doc_line.rstrip("\n").split("\t")
+        docs[stem] = (title, date)
+        doc_stems.append(stem)
+  for line in manifest_lines:
+    fields = line.rstrip("\n").split("\t")
+    if fields[0] != "shard": continue
+    with gzip.open(os.path.join(output_dir, fields[1]), "rt") as input_file:
+      for shard_line in input_file:
+        term, doc_counts = shard_line.rstrip("\n").split("\t")
+        term_postings = postings[term]
+        for doc_count in doc_counts.split(","):
+          doc_id, count = doc_count.split(":")
+          term_postings.append((doc_stems[int(doc_id)], int(count)))
+
+
+# The static search index is a small manifest and gzipped shards of sorted postings.
+# Shard files are named by their content digests so that they can be cached forever.
+# A focused build replaces the postings of the focused articles in the existing index.
+def MakeStaticSearchIndex(config, focus_stem_set=None):
+  output_dir = config["output_dir"]
+  search_dir = os.path.join(output_dir, STATIC_SEARCH_DIR)
+  os.makedirs(search_dir, exist_ok=True)
+  manifest_path = os.path.join(output_dir, STATIC_SEARCH_FILE)
+  docs = {}
+  postings = collections.defaultdict(list)
+  metas = None
+  if focus_stem_set and os.path.exists(manifest_path):
+    try:
+      ReadStaticSearchIndex(output_dir, manifest_path, docs, postings)
+      metas = ReadTextStoreMetas(config, True, focus_stem_set)
+    except Exception as e:
+      logger.warning("rebuilding the static search index: {}".format(str(e)))
+      docs.clear()
+      postings.clear()
+  if metas is None:
+    metas = ReadTextStoreMetas(config, True)
+  else:
+    for stem in focus_stem_set:
+      docs.pop(stem, None)
+    for term in list(postings):
+      term_postings = [x for x in postings[term] if x[0] not in focus_stem_set]
+      if term_postings:
+        postings[term] = term_postings
+      else:
+        del postings[term]
+  for meta in metas:
+    if "nosearch" in ParseMisc(meta.get("misc") or ""): continue
+    docs[meta["stem"]] = (meta.get("title") or "", meta.get("date") or "")
+    term_counts = collections.defaultdict(int)
+    for text in meta["texts"]:
+      for token in TokenizeStaticText(text):
+        term_counts[token] += 1
+    for text in [meta.get("title") or "", meta.get("tags") or ""]:
+      for token in TokenizeStaticText(text):
+        term_counts[token] += STATIC_TITLE_WEIGHT
+    for term, count in term_counts.items():
+      postings[term].append((meta["stem"], count))
+  doc_lines = []
+  doc_ids = {}
+  for stem in sorted(docs):
+    doc_ids[stem] = len(doc_lines)
+    doc_lines.append("{}\t{}\t{}\n".format(stem, docs[stem][0], docs[stem][1]))
+  manifest_lines = []
+  manifest_lines.append("docs\t{}\t{:d}\n".format(
+    WriteStaticSearchFile(search_dir, "-docs.gz", doc_lines), len(doc_lines)))
+  shard_lines = []
+  shard_size = 0
+  first_term = ""
+  for term in sorted(postings):
+    if not shard_lines:
+      first_term = term
+    term_postings = sorted([(doc_ids[x[0]], x[1]) for x in postings[term]])
+    line = "{}\t{}\n".format(term, ",".join(["{:d}:{:d}".format(*x) for x in term_postings]))
+    shard_lines.append(line)
+    shard_size += len(line)
+    if shard_size >= STATIC_SHARD_SIZE:
+      manifest_lines.append("shard\t{}\t{}\n".format(
+        WriteStaticSearchFile(search_dir, ".gz", shard_lines), first_term))
+      shard_lines = []
+      shard_size = 0
+  if shard_lines:
+    manifest_lines.append("shard\t{}\t{}\n".format(
+      WriteStaticSearchFile(search_dir, ".gz", shard_lines), first_term))
+  tmp_path = manifest_path + ".tmp"
+  with open(tmp_path, "w") as output_file:
+    for line in manifest_lines:
+      output_file.write(line)
+  os.replace(tmp_path, manifest_path)
+  used_names = set([x.split("\t")[1].split("/")[-1] for x in manifest_lines])
+  for name in os.listdir(search_dir):
+    if name not in used_names:
+      os.remove(os.path.join(search_dir, name))
+
+
+def MakeVersionFile(config):
+  output_dir = config["output_dir"]
+  version_path = os.path.join(output_dir, VERSION_FILE)
+  tmp_path = version_path + ".tmp"
+  with open(tmp_path, "w") as output_file:
+    print("{:d}-{:d}".format(time.time_ns(), os.getpid()), file=output_file)
+  os.replace(tmp_path, version_path)
+
+
 if __name__ == "__main__":
   sys.exit(main(sys.argv[1:]))
 
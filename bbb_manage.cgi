@@ -14,24 +14,32 @@
 #--------------------------------------------------------------------------------------------------
 
 
-import cgi
 import collections
 import datetime
 import dateutil.tz
+import email.utils
+import errno
 import fcntl
 import hashlib
 import html
+import importlib.machinery
+import importlib.util
+import logging
 import math
 import os
 import re
+import shutil
 import stat
 import subprocess
 import sys
 import time
+import traceback
 import unicodedata
 import urllib
 import urllib.parse
 
+import bbb_web
+
 
 DATA_DIRS = [
   # label, local path, URL path, bbb.conf path
@@ -39,12 +47,32 @@ DATA_DIRS = [
   ("data", "/home/mikio/myblog/data", "/bikibikibob/myblog/data", ""),
 ]
 BBB_GENERATE_COMMAND = "bbb_generate.py"
+BBB_GENERATE_MODULE = ""
 NUM_FILES_IN_PAGE = 100
 MAX_FILE_SIZE = 1024 * 1024 * 256
 MAX_TOTAL_FILE_SIZE = 1024 * 1024 * 1024 * 16
 MAX_NUM_FILES = 8192
 MAX_TEXT_LENGTH = 1024 * 1024 * 4
 MAX_FILENAME_LENGTH = 256
+MAX_FORM_SIZE = 1024 * 1024 * 40
+UPLOAD_BLOCK_SIZE = 1024 * 64
+UPLOAD_CHUNK_SIZE = 1024 * 1024 * 4
+MAX_CHUNK_SIZE = 1024 * 1024 * 16
+UPLOAD_PARALLELISM = 3
+UPLOAD_EXPIRE_TIME = 60 * 60 * 24 * 3
+SENDFILE_MODE = ""
+SENDFILE_BLOCK_SIZE = 1024 * 1024
+ACCEL_REDIRECT_PREFIX = "/bbb-internal"
+DIR_INDEX_NAME = ".bbb-index.tsv"
+WORK_DIR_NAME = ".bbb-work"
+DIGEST_ALGORITHM = "md5"
+DIGEST_BLOCK_SIZE = 1024 * 1024
+JOB_DIR_NAME = "jobs"
+JOB_EXPIRE_TIME = 60 * 60 * 24
+DIR_LOCK_NAME = "dir.lock"
+MAX_BATCH_FILES = 256
+COMPRESS_OUTPUT = False
+COMPRESS_MIN_SIZE = 1024 * 2
 IGNORE_FILENAME_REGEXES = [
   r"^\.", r"\.(cgi)$", r"^(bbb)[-_\W]",
 ]
@@ -156,6 +184,13 @@ div.pages_area a, div.pages_area span {
 div.pages_area span {
   color: #888;
 }
+div.batch_row {
+  margin: 0.5ex 0;
+  font-size: 90%;
+}
+form#batch_form div.hidden_row {
+  display: none;
+}
 table.file_table {
   margin: 0;
   border-collapse: collapse;
@@ -424,8 +459,171 @@ function check_upload() {
     alert("The filename is empty.");
     return false;
   }
+  if (select_name.value == "assign" && input_file.files && input_file.files.length > 1) {
+    alert("Only one file can be assigned a name.");
+    return false;
+  }
+  const form = document.getElementById("upload_form");
+  const chunk_size = parseInt(form.dataset.chunkSize);
+  if (select_name.value != "empty" && input_file.files && input_file.files.length == 1 &&
+      input_file.files[0].size > chunk_size && input_file.files[0].slice) {
+    upload_chunked(form, input_file.files[0]);
+    return false;
+  }
   return true;
 }
+function upload_chunked(form, file) {
+  const script_url = document.location.toString().replace(/\?.*/, "");
+  const dir = form.dir.value;
+  const chunk_size = parseInt(form.dataset.chunkSize);
+  const parallelism = parseInt(form.dataset.chunkParallelism);
+  const resume_key = "bbb-upload:" + [dir, file.name, file.size, file.lastModified].join(":");
+  const post = function(params, body, callback) {
+    const xhr = new XMLHttpRequest();
+    xhr.onload = function() {
+      callback(xhr);
+    };
+    xhr.onerror = function() {
+      callback(null);
+    };
+    xhr.open("POST", script_url + "?" + params.join("&"), true);
+    xhr.setRequestHeader("Cache-Control", "no-cache");
+    if (body) {
+      xhr.setRequestHeader("Content-Type", "application/octet-stream");
+      xhr.send(body);
+    } else {
+      xhr.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+      xhr.send("");
+    }
+  };
+  const parse_status = function(text) {
+    const status = {};
+    for (const line of text.split("\n")) {
+      const match = line.match(/^([a-z]+)=(.*)$/);
+      if (match) {
+        status[match[1]] = match[2];
+      }
+    }
+    const ranges = [];
+    for (const expr of (status.ranges || "").split(",")) {
+      const match = expr.match(/^(\d+)-(\d+)$/);
+      if (match) {
+        ranges.push([parseInt(match[1]), parseInt(match[2])]);
+      }
+    }
+    return {id: status.id, size: parseInt(status.size), ranges: ranges};
+  };
+  const start_upload = function(status) {
+    localStorage.setItem(resume_key, status.id);
+    const pending = [];
+    for (let offset = 0; offset < file.size; offset += chunk_size) {
+      const end = Math.min(offset + chunk_size, file.size);
+      let stored = false;
+      for (const range of status.ranges) {
+        if (range[0] <= offset && range[1] >= end) {
+          stored = true;
+        }
+      }
+      if (!stored) {
+        pending.push(offset);
+      }
+    }
+    const num_chunks = Math.ceil(file.size / chunk_size);
+    let num_done = num_chunks - pending.length;
+    let num_running = 0;
+    let failed = false;
+    const send_next = function() {
+      if (failed) return;
+      if (pending.length == 0) {
+        if (num_running == 0) {
+          finalize_upload(status.id);
+        }
+        return;
+      }
+      const offset = pending.shift();
+      const chunk = file.slice(offset, Math.min(offset + chunk_size, file.size));
+      const params = ["action=upload-chunk", "dir=" + encodeURIComponent(dir),
+                      "id=" + status.id, "offset=" + offset];
+      num_running++;
+      let retry = 0;
+      const send_chunk = function() {
+        post(params, chunk, function(xhr) {
+          if (xhr && xhr.status == 200) {
+            num_running--;
+            num_done++;
+            show_proc_message("uploading ... " + Math.floor(num_done * 100 / num_chunks) + "%");
+            send_next();
+          } else if (retry < 5 && (!xhr || xhr.status >= 500)) {
+            retry++;
+            setTimeout(send_chunk, 1000 * retry);
+          } else {
+            failed = true;
+            show_proc_message("uploading failed");
+            alert("Uploading failed. Submit the same file again to resume.");
+          }
+        });
+      };
+      send_chunk();
+    };
+    for (let i = 0; i < parallelism; i++) {
+      send_next();
+    }
+  };
+  const finalize_upload = function(id) {
+    show_proc_message("finalizing ...");
+    const params = ["action=upload-finalize", "dir=" + encodeURIComponent(dir), "id=" + id,
+                    "naming=" + encodeURIComponent(form.naming.value),
+                    "newname=" + encodeURIComponent(form.newname.value),
+                    "overwrite=" + encodeURIComponent(form.overwrite.value)];
+    post(params, null, function(xhr) {
+      if (xhr && xhr.status == 200) {
+        localStorage.removeItem(resume_key);
+        alert(xhr.responseText.trim());
+        document.location = script_url + "?dir=" + encodeURIComponent(dir) +
+          "&order=" + encodeURIComponent(form.order.value) +
+          "&page=" + encodeURIComponent(form.page.value);
+      } else {
+        show_proc_message("uploading failed");
+        alert(xhr ? xhr.responseText.trim() : "networking error while uploading the file");
+      }
+    });
+  };
+  const init_upload = function() {
+    const params = ["action=upload-init", "dir=" + encodeURIComponent(dir),
+                    "filename=" + encodeURIComponent(file.name), "size=" + file.size];
+    post(params, null, function(xhr) {
+      if (xhr && xhr.status == 200) {
+        start_upload(parse_status(xhr.responseText));
+      } else {
+        show_proc_message("uploading failed");
+        alert(xhr ? xhr.responseText.trim() : "networking error while uploading the file");
+      }
+    });
+  };
+  show_proc_message("uploading ...");
+  const resume_id = localStorage.getItem(resume_key);
+  if (resume_id) {
+    const status_url = script_url + "?action=upload-status&dir=" + encodeURIComponent(dir) +
+      "&id=" + resume_id;
+    const xhr = new XMLHttpRequest();
+    xhr.onload = function() {
+      if (xhr.status == 200) {
+        start_upload(parse_status(xhr.responseText));
+      } else {
+        localStorage.removeItem(resume_key);
+        init_upload();
+      }
+    };
+    xhr.onerror = function() {
+      init_upload();
+    };
+    xhr.open("GET", status_url, true);
+    xhr.setRequestHeader("Cache-Control", "no-cache");
+    xhr.send();
+  } else {
+    init_upload();
+  }
+}
 function show_proc_message(message) {
   const message_elem = document.getElementById("proc_message");
   message_elem.textContent = message;
@@ -497,21 +695,21 @@ function bbb_generate(dir, res, hoard) {
   const params = [];
   params.push("action=generate");
   params.push("dir=" + encodeURIComponent(dir));
-  params.push("res=" + encodeURIComponent(res));
+  for (const name of [].concat(res)) {
+    params.push("res=" + encodeURIComponent(name));
+  }
   if (hoard) {
     params.push("hoard=true");
   }
   const joined_params = params.join("&");
   const xhr = new XMLHttpRequest();
   xhr.onload = function() {
-    if (xhr.status == 200) {
-      show_proc_message("updated successfully");
+    const match = xhr.responseText.match(/^job=(.*)$/m);
+    if ((xhr.status == 200 || xhr.status == 202) && match) {
       bbb_update_logs.style.display = "block";
       const pre = document.createElement("pre");
-      pre.textContent = xhr.responseText;
       bbb_update_logs.insertBefore(pre, null);
-      update_edit_text();
-      reload_preview();
+      watch_generate_job(dir, match[1], pre, 0);
     } else {
       show_proc_message("updating failed");
     }
@@ -524,8 +722,44 @@ function bbb_generate(dir, res, hoard) {
   xhr.setRequestHeader("Cache-Control", "no-cache");
   xhr.send(joined_params);
 }
+function watch_generate_job(dir, job, pre, offset) {
+  const script_url = document.location.toString().replace(/\?.*/, "");
+  const status_url = script_url + "?action=generate-status&dir=" + encodeURIComponent(dir) +
+    "&job=" + encodeURIComponent(job) + "&offset=" + offset;
+  const xhr = new XMLHttpRequest();
+  xhr.onload = function() {
+    if (xhr.status != 200) {
+      show_proc_message("updating failed");
+      return;
+    }
+    pre.textContent += xhr.responseText;
+    const state = xhr.getResponseHeader("bbb-job-state");
+    const next_offset = parseInt(xhr.getResponseHeader("bbb-log-offset"));
+    if (state == "done") {
+      show_proc_message("updated successfully");
+      update_edit_text();
+      reload_preview();
+    } else if (state == "failed") {
+      show_proc_message("updating failed");
+    } else {
+      const elapsed = xhr.getResponseHeader("bbb-job-elapsed");
+      show_proc_message(state == "pending" ? "waiting for the queue ..." :
+                        "updating the BBB site ... " + elapsed + "s");
+      setTimeout(function() {
+        watch_generate_job(dir, job, pre, next_offset);
+      }, 1000);
+    }
+  };
+  xhr.onerror = function() {
+    alert('networking error while updating the BBB site');
+  };
+  xhr.open("GET", status_url, true);
+  xhr.setRequestHeader("Cache-Control", "no-cache");
+  xhr.send();
+}
 function update_edit_text() {
   const form = document.getElementById("edit_form");
+  if (!form) return;
   const dir = form.dataset.dir;
   const res = form.dataset.res;
   const script_url = document.location.toString().replace(/\?.*/, "");
@@ -550,9 +784,84 @@ function update_edit_text() {
 }
 function reload_preview() {
   const preview_frame = document.getElementById("preview_frame");
+  if (!preview_frame) return;
   if (!preview_frame.src || preview_frame.src.length < 1) return;
+  if (preview_frame.src.startsWith("blob:")) {
+    render_edit_preview();
+    return;
+  }
   preview_frame.contentWindow.location.reload(true);
 }
+function render_edit_preview() {
+  const edit_form = document.getElementById("edit_form");
+  const preview_frame = document.getElementById("preview_frame");
+  const script_url = document.location.toString().replace(/\?.*/, "");
+  const params = [];
+  params.push("action=render-preview");
+  params.push("dir=" + encodeURIComponent(edit_form.dataset.dir));
+  params.push("res=" + encodeURIComponent(edit_form.dataset.res));
+  params.push("text=" + encodeURIComponent(edit_form.text.value));
+  const xhr = new XMLHttpRequest();
+  xhr.onload = function() {
+    if (xhr.status == 200) {
+      const blob = new Blob([xhr.responseText], {type: "application/xhtml+xml"});
+      const old_url = preview_frame.src;
+      preview_frame.src = URL.createObjectURL(blob);
+      if (old_url.startsWith("blob:")) {
+        URL.revokeObjectURL(old_url);
+      }
+    } else {
+      preview_frame.src = edit_form.dataset.generatedUrl;
+    }
+  };
+  xhr.onerror = function() {
+    preview_frame.src = edit_form.dataset.generatedUrl;
+  };
+  xhr.open("POST", script_url, true);
+  xhr.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+  xhr.setRequestHeader("Cache-Control", "no-cache");
+  xhr.send(params.join("&"));
+}
+function get_batch_selection() {
+  const form = document.getElementById("batch_form");
+  const names = [];
+  for (const input of form.querySelectorAll('input[name="res"]')) {
+    if (input.checked) {
+      names.push(input.value);
+    }
+  }
+  return names;
+}
+function toggle_batch_selection(toggle) {
+  const form = document.getElementById("batch_form");
+  for (const input of form.querySelectorAll('input[name="res"]')) {
+    input.checked = toggle.checked;
+  }
+}
+function check_batch_removal() {
+  if (get_batch_selection().length < 1) {
+    alert("No file is selected.");
+    return false;
+  }
+  return true;
+}
+function batch_generate() {
+  const form = document.getElementById("batch_form");
+  const names = [];
+  for (const name of get_batch_selection()) {
+    if (name.endsWith(".art")) {
+      names.push(name);
+    }
+  }
+  if (names.length < 1) {
+    alert("No article file is selected.");
+    return;
+  }
+  const bbb_update_logs = document.getElementById("bbb_update_logs");
+  bbb_update_logs.style.display = "none";
+  bbb_update_logs.innerHTML = "";
+  bbb_generate(form.dataset.dir, names, false);
+}
 function go_back() {
   const back_url = document.location.toString().replace(/action=[-a-z]+/, "action=view");
   document.location = back_url;
@@ -564,7 +873,11 @@ function open_edit_preview() {
   const preview_frame = document.getElementById("preview_frame");
   page.style.textAlign = "left";
   preview_pane.style.display = "inline-block";
-  preview_frame.src = edit_form.dataset.generatedUrl;
+  if (edit_form.dataset.renderPreview == "true") {
+    render_edit_preview();
+  } else {
+    preview_frame.src = edit_form.dataset.generatedUrl;
+  }
   if (preview_pane.clientWidth > screen.width) {
     preview_pane.style.width = screen.width + "px";
   }
@@ -591,14 +904,20 @@ MAIN_FOOTER_TEXT = r"""
 """
 
 
+generator_module = None
+generator_sites = {}
+
+
 def main():
-  request_method = os.environ.get("REQUEST_METHOD", "GET")
-  script_filename = os.environ.get("SCRIPT_FILENAME", "")
-  script_url = os.environ.get("REQUEST_SCHEME", "http") + "://"
-  script_url += os.environ.get("HTTP_HOST", "localhost")
-  script_url += os.environ.get("REQUEST_URI", "/bbb_comment.cgi")
-  script_url = re.sub(r"\?.*", "", script_url)
-  referrer_url = os.environ.get("HTTP_REFERER", "")
+  if len(sys.argv) > 1 and not os.environ.get("GATEWAY_INTERFACE"):
+    return RunCommand(sys.argv[1:])
+  bbb_web.RunCGI(HandleRequest)
+
+
+def HandleRequest(request):
+  script_filename = request.get("SCRIPT_FILENAME")
+  script_url = request.script_url("/bbb_manage.cgi")
+  referrer_url = request.header("Referer")
   base_dir = os.path.dirname(script_filename)
   data_dirs = []
   for label, path, url, conf in DATA_DIRS:
@@ -610,58 +929,112 @@ def main():
     script_parts = urllib.parse.urlparse(script_url)
     referrer_parts = urllib.parse.urlparse(referrer_url)
     if referrer_parts.netloc != script_parts.netloc:
-      PrintError(403, "Forbidden", "bad referrer")
+      SendError(403, "Forbidden", "bad referrer")
       return
-  form = cgi.FieldStorage()
-  params = {}
-  for key in form.keys():
-    value = form[key]
-    if hasattr(value, "filename") and value.filename:
-      params[key] = value.value
-      params[key + "_filename"] = value.filename
-    if isinstance(value, list):
-      params[key] = value[0].value
-    else:
-      params[key] = value.value
+  def GetUploadDir(params):
+    p_dir = TextToInt(params.get("dir", "1"))
+    if p_dir < 1 or p_dir > len(data_dirs) or not os.path.isdir(data_dirs[p_dir-1][1]):
+      return None, "invalid dir parameter"
+    return GetWorkDir(data_dirs[p_dir-1][1]), None
+  uploads = {}
+  try:
+    params = bbb_web.ReadFormParams(request, MAX_FORM_SIZE, uploads, GetUploadDir,
+                                    MAX_FILE_SIZE, MAX_BATCH_FILES)
+    ProcessRequest(params, uploads, data_dirs, request, script_url)
+  finally:
+    for name_uploads in uploads.values():
+      for upload in name_uploads:
+        if upload["path"] and os.path.exists(upload["path"]):
+          os.remove(upload["path"])
+
+
+def application(environ, start_response):
+  return bbb_web.RunApplication(HandleRequest, environ, start_response)
+
+
+def RunCommand(args):
+  if args[0] == "--run-jobs" and len(args) == 2:
+    return RunJobWorker(args[1])
+  if args[0] == "--serve" and len(args) in (2, 3):
+    return bbb_web.RunServer(args[1], args[2] if len(args) > 2 else ".", application)
+  print("usage: bbb_manage.cgi --run-jobs job_dir", file=sys.stderr)
+  print("       bbb_manage.cgi --serve [host:]port [base_dir]", file=sys.stderr)
+  return 1
+
+
+def ProcessRequest(params, uploads, data_dirs, request, script_url):
+  if params is None:
+    SendError(400, "Bad Request", "invalid form data")
+    return
   p_action = params.get("action", "").strip()
   p_generate = params.get("generate", "").strip()
   if p_action == "download":
-    ProcessDownload(params, data_dirs)
+    ProcessDownload(params, data_dirs, request)
     return
   if p_action == "edit":
-    if CHECK_METHOD and request_method != "POST":
+    if CHECK_METHOD and request.method != "POST":
       SendError(403, "Forbidden", "bad method")
     else:
       ProcessEdit(params, data_dirs)
     return
+  if p_action == "upload-status":
+    ProcessUploadStatus(params, data_dirs)
+    return
+  if p_action == "upload-init":
+    if CHECK_METHOD and request.method != "POST":
+      SendError(403, "Forbidden", "bad method")
+    else:
+      ProcessUploadInit(params, data_dirs)
+    return
+  if p_action == "upload-chunk":
+    if CHECK_METHOD and request.method != "POST":
+      SendError(403, "Forbidden", "bad method")
+    else:
+      ProcessUploadChunk(params, data_dirs, request)
+    return
+  if p_action == "upload-finalize":
+    if CHECK_METHOD and request.method != "POST":
+      SendError(403, "Forbidden", "bad method")
+    else:
+      ProcessUploadFinalize(params, data_dirs)
+    return
+  if p_action == "render-preview":
+    if CHECK_METHOD and request.method != "POST":
+      SendError(403, "Forbidden", "bad method")
+    else:
+      ProcessRenderPreview(params, data_dirs)
+    return
+  if p_action == "generate-status":
+    ProcessGenerateStatus(params, data_dirs)
+    return
   if p_action == "generate":
-    if CHECK_METHOD and request_method != "POST":
+    if CHECK_METHOD and request.method != "POST":
       SendError(403, "Forbidden", "bad method")
     else:
       ProcessGenerate(params, data_dirs)
     return
   print("Content-Type: application/xhtml+xml")
-  print("")
-  print(MAIN_HEADER_TEXT.strip())
-  P('<h1><a href="{}">BikiBikiBob Manager</a></h1>', script_url)
-  if p_action == "upload":
-    if CHECK_METHOD and request_method != "POST":
-      PrintError("bad method")
-    else:
-      ProcessUpload(params, data_dirs)
-  if p_action == "remove":
-    if CHECK_METHOD and request_method != "POST":
-      PrintError("bad method")
+  with bbb_web.CompressOutput(request, COMPRESS_OUTPUT, COMPRESS_MIN_SIZE):
+    print(MAIN_HEADER_TEXT.strip())
+    P('<h1><a href="{}">BikiBikiBob Manager</a></h1>', script_url)
+    if p_action == "upload":
+      if CHECK_METHOD and request.method != "POST":
+        PrintError("bad method")
+      else:
+        ProcessUpload(params, uploads, data_dirs)
+    if p_action == "remove":
+      if CHECK_METHOD and request.method != "POST":
+        PrintError("bad method")
+      else:
+        ProcessRemoval(params, data_dirs)
+    PrintControl(params, data_dirs, script_url)
+    if p_action == "edit-preview":
+      PrintEditPreview(params, data_dirs, script_url)
+    elif p_action == "remove-preview":
+      PrintRemovePreview(params, data_dirs, script_url)
     else:
-      ProcessRemoval(params, data_dirs)
-  PrintControl(params, data_dirs, script_url)
-  if p_action == "edit-preview":
-    PrintEditPreview(params, data_dirs, script_url)
-  elif p_action == "remove-preview":
-    PrintRemovePreview(params, data_dirs, script_url)
-  else:
-    PrintDirectory(params, data_dirs)
-  print(MAIN_FOOTER_TEXT.strip())
+      PrintDirectory(params, data_dirs, script_url)
+    print(MAIN_FOOTER_TEXT.strip())
 
 
 def TextToInt(text):
@@ -707,16 +1080,188 @@ def NormalizeFilename(name):
   return name
 
 
+def NewDigestHasher():
+  if DIGEST_ALGORITHM == "blake2b":
+    return hashlib.blake2b(digest_size=16)
+  return hashlib.new(DIGEST_ALGORITHM)
+
+
 def ReadFileDigest(path):
-  h = hashlib.new("md5")
+  h = NewDigestHasher()
   with open(path, "rb") as input_file:
     while True:
-      buf = input_file.read(8192)
+      buf = input_file.read(DIGEST_BLOCK_SIZE)
       if len(buf) == 0: break
       h.update(buf)
   return h.hexdigest()
 
 
+def GetFileDigest(dir_path, name):
+  path = os.path.join(dir_path, name)
+  st = os.stat(path)
+  prefix = DIGEST_ALGORITHM + ":"
+  index_file = OpenDirIndex(dir_path)
+  if index_file:
+    try:
+      fcntl.flock(index_file, fcntl.LOCK_SH)
+      index_mtime, entries = ReadDirIndexFile(index_file)
+    finally:
+      index_file.close()
+    for entry in entries or []:
+      if (entry["name"] == name and entry["size"] == st.st_size and
+          entry["mtime_ns"] == st.st_mtime_ns and entry["ino"] == st.st_ino and
+          entry["digest"].startswith(prefix)):
+        return entry["digest"][len(prefix):]
+  digest = ReadFileDigest(path)
+  StoreFileDigest(dir_path, name, st, digest)
+  return digest
+
+
+def StoreFileDigest(dir_path, name, st, digest):
+  index_file = OpenDirIndex(dir_path)
+  if not index_file: return
+  try:
+    fcntl.flock(index_file, fcntl.LOCK_EX)
+    index_mtime, entries = ReadDirIndexFile(index_file)
+    if index_mtime is None: return
+    for entry in entries:
+      if (entry["name"] == name and entry["size"] == st.st_size and
+          entry["mtime_ns"] == st.st_mtime_ns and entry["ino"] == st.st_ino):
+        entry["digest"] = DIGEST_ALGORITHM + ":" + digest
+        WriteDirIndexFile(index_file, index_mtime, entries)
+        break
+  finally:
+    index_file.close()
+
+
+def IsIgnoredFilename(name):
+  for ignore_regex in IGNORE_FILENAME_REGEXES:
+    if re.search(ignore_regex, name):
+      return True
+  return False
+
+
+def MakeDirIndexEntry(dir_path, name):
+  if re.search(r"[\t\n]", name):
+    return None
+  try:
+    st = os.stat(os.path.join(dir_path, name))
+  except FileNotFoundError:
+    return None
+  if not stat.S_ISREG(st.st_mode):
+    return None
+  return {"name": name, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+          "ino": st.st_ino, "digest": ""}
+
+
+def ReadDirIndexFile(index_file):
+  index_file.seek(0)
+  header = index_file.readline().rstrip("\n").split("\t")
+  if len(header) != 4 or header[0] != "#bbb-index":
+    return None, None
+  entries = []
+  for line in index_file:
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != 5: continue
+    entries.append({"name": fields[0], "size": TextToInt(fields[1]),
+                    "mtime_ns": TextToInt(fields[2]), "ino": TextToInt(fields[3]),
+                    "digest": fields[4]})
+  if len(entries) != TextToInt(header[2]):
+    return None, None
+  return TextToInt(header[1]), entries
+
+
+def WriteDirIndexFile(index_file, dir_mtime, entries):
+  entries = sorted(entries, key=lambda x: x["name"])
+  total_size = sum([x["size"] for x in entries])
+  index_file.seek(0)
+  index_file.truncate()
+  index_file.write("#bbb-index\t{}\t{}\t{}\n".format(dir_mtime, len(entries), total_size))
+  for entry in entries:
+    index_file.write("{}\t{}\t{}\t{}\t{}\n".format(
+      entry["name"], entry["size"], entry["mtime_ns"], entry["ino"], entry["digest"]))
+  index_file.flush()
+
+
+def OpenDirIndex(dir_path):
+  try:
+    fd = os.open(os.path.join(dir_path, DIR_INDEX_NAME), os.O_RDWR | os.O_CREAT, 0o666)
+  except OSError:
+    return None
+  return os.fdopen(fd, "r+", encoding="UTF-8")
+
+
+def LoadDirIndex(dir_path):
+  index_file = OpenDirIndex(dir_path)
+  if index_file:
+    fcntl.flock(index_file, fcntl.LOCK_SH)
+  try:
+    dir_mtime = os.stat(dir_path).st_mtime_ns
+    if index_file:
+      index_mtime, entries = ReadDirIndexFile(index_file)
+      if index_mtime == dir_mtime:
+        return entries
+      fcntl.flock(index_file, fcntl.LOCK_EX)
+      index_mtime, old_entries = ReadDirIndexFile(index_file)
+      if index_mtime == dir_mtime:
+        return old_entries
+    old_entries = {x["name"]: x for x in old_entries or []} if index_file else {}
+    entries = []
+    for name in os.listdir(dir_path):
+      if IsIgnoredFilename(name): continue
+      entry = MakeDirIndexEntry(dir_path, name)
+      if not entry: continue
+      old_entry = old_entries.get(name)
+      if (old_entry and old_entry["size"] == entry["size"] and
+          old_entry["mtime_ns"] == entry["mtime_ns"] and old_entry["ino"] == entry["ino"]):
+        entry["digest"] = old_entry["digest"]
+      entries.append(entry)
+    if index_file:
+      WriteDirIndexFile(index_file, dir_mtime, entries)
+    return sorted(entries, key=lambda x: x["name"])
+  finally:
+    if index_file:
+      index_file.close()
+
+
+def UpdateDirIndex(dir_path, names, old_dir_mtime, digests=None):
+  index_file = OpenDirIndex(dir_path)
+  if not index_file: return
+  try:
+    fcntl.flock(index_file, fcntl.LOCK_EX)
+    index_mtime, entries = ReadDirIndexFile(index_file)
+    if index_mtime is None:
+      return
+    dir_mtime = os.stat(dir_path).st_mtime_ns
+    if index_mtime != old_dir_mtime and index_mtime != dir_mtime:
+      return
+    entries = [x for x in entries if x["name"] not in names]
+    for name in names:
+      entry = MakeDirIndexEntry(dir_path, name)
+      if not entry: continue
+      digest = (digests or {}).get(name)
+      if digest:
+        entry["digest"] = DIGEST_ALGORITHM + ":" + digest
+      entries.append(entry)
+    WriteDirIndexFile(index_file, dir_mtime, entries)
+  finally:
+    index_file.close()
+
+
+# Temporary files of the manager are kept in a hidden subdirectory so that creating and removing
+# them does not change the mtime of the data directory, which the directory index relies on.
+def GetWorkDir(dir_path):
+  work_dir = os.path.join(dir_path, WORK_DIR_NAME)
+  os.makedirs(work_dir, exist_ok=True)
+  return work_dir
+
+
+def LockDataDir(dir_path):
+  fd = os.open(os.path.join(GetWorkDir(dir_path), DIR_LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o666)
+  fcntl.flock(fd, fcntl.LOCK_EX)
+  return fd
+
+
 def SendError(code, status, message):
   print("Status: {} {}".format(code, status))
   print("Content-Type: text/plain; charset=UTF-8")
@@ -724,7 +1269,7 @@ def SendError(code, status, message):
   print(message)
 
 
-def ProcessDownload(params, data_dirs):
+def ProcessDownload(params, data_dirs, request):
   p_dir = TextToInt(params.get("dir", "1"))
   p_res = params.get("res", "")
   if p_dir < 1 or p_dir > len(data_dirs):
@@ -781,20 +1326,114 @@ def ProcessDownload(params, data_dirs):
     ctype = "video/x-msvideo"
   elif ext in VIDEO_EXTS:
     ctype = "video/" + ext
+  etag = '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+  last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+  if_none_match = request.header("If-None-Match")
+  if_modified_since = request.header("If-Modified-Since")
+  not_modified = False
+  if if_none_match:
+    not_modified = etag in [x.strip() for x in if_none_match.split(",")] or if_none_match == "*"
+  elif if_modified_since:
+    try:
+      since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+      not_modified = int(st.st_mtime) <= since
+    except Exception:
+      pass
+  if not_modified:
+    print("Status: 304 Not Modified")
+    print("ETag: " + etag)
+    print("Last-Modified: " + last_modified)
+    print("")
+    return
+  # Articles are small and the editor needs their digest header, which the front server may
+  # drop when it serves the file, so they are always sent in-process.
+  is_article = bool(dir_conf) and ext == "art"
+  if SENDFILE_MODE in ["x-sendfile", "x-accel-redirect"] and not is_article:
+    print("Content-Type: " + ctype)
+    print("ETag: " + etag)
+    print("Last-Modified: " + last_modified)
+    if SENDFILE_MODE == "x-sendfile":
+      print("X-Sendfile: " + path)
+    else:
+      print("X-Accel-Redirect: {}/{}/{}".format(
+        re.sub(r"/$", "", ACCEL_REDIRECT_PREFIX), p_dir, urllib.parse.quote(p_res)))
+    print("")
+    return
+  start, end = ParseRangeHeader(request.header("Range"), st.st_size)
+  if_range = request.header("If-Range")
+  if if_range and if_range != etag and if_range != last_modified:
+    start, end = None, None
+  if start is not None and start < 0:
+    print("Status: 416 Range Not Satisfiable")
+    print("Content-Range: bytes */{}".format(st.st_size))
+    print("Content-Type: text/plain; charset=UTF-8")
+    print("")
+    print("unsatisfiable range")
+    return
   digest = ""
-  if dir_conf and ext == "art":
-    digest = ReadFileDigest(path)
+  if is_article and start is None:
+    digest = GetFileDigest(dir_path, p_res)
   with open(path, "rb") as input_file:
+    if start is None:
+      start, end = 0, st.st_size
+    else:
+      print("Status: 206 Partial Content")
+      print("Content-Range: bytes {}-{}/{}".format(start, end - 1, st.st_size))
     print("Content-Type: " + ctype)
+    print("Content-Length: {}".format(end - start))
+    print("Accept-Ranges: bytes")
+    print("ETag: " + etag)
+    print("Last-Modified: " + last_modified)
     if digest:
       print("BBB-digest: " + digest)
     print("")
     sys.stdout.flush()
-    while True:
-      buf = input_file.read(8192)
-      if len(buf) == 0: break
-      sys.stdout.buffer.write(buf)
-    sys.stdout.flush()
+    if request.method == "HEAD":
+      return
+    SendFileRange(input_file, start, end)
+
+
+def ParseRangeHeader(expr, size):
+  match = re.search(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", expr)
+  if not match or (not match.group(1) and not match.group(2)):
+    return None, None
+  if match.group(1):
+    start = int(match.group(1))
+    end = int(match.group(2)) + 1 if match.group(2) else size
+    if match.group(2) and end <= start:
+      return None, None
+  else:
+    start = max(size - int(match.group(2)), 0)
+    end = size
+  end = min(end, size)
+  if start >= size or start >= end:
+    return -1, -1
+  return start, end
+
+
+def SendFileRange(input_file, start, end):
+  response = bbb_web.CurrentResponse()
+  if response:
+    response.send_file(input_file, start, end)
+    return
+  output_fd = sys.stdout.fileno()
+  offset = start
+  try:
+    while offset < end:
+      sent = os.sendfile(output_fd, input_file.fileno(), offset, min(end - offset, SENDFILE_BLOCK_SIZE))
+      if sent == 0: break
+      offset += sent
+    return
+  except OSError as e:
+    if offset > start or e.errno not in [errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP]:
+      raise
+  input_file.seek(offset)
+  while offset < end:
+    buf = input_file.read(min(end - offset, SENDFILE_BLOCK_SIZE))
+    if len(buf) == 0: break
+    sys.stdout.buffer.write(buf)
+    offset += len(buf)
+  sys.stdout.flush()
 
 
 def ProcessEdit(params, data_dirs):
@@ -829,36 +1468,44 @@ def ProcessEdit(params, data_dirs):
     return
   url = re.sub(r"/$", "", dir_url) + "/" + urllib.parse.quote(p_res)
   ext = re.sub(r"^\.", "", os.path.splitext(p_res)[1].lower())
-  digest = ReadFileDigest(path)
+  digest = GetFileDigest(dir_path, p_res)
   if p_digest != digest:
     SendError(409, "Conflict", "conflict with another edit")
     return
   if ext not in TEXT_EXTS:
     SendError(400, "Bad Parameter", "not a text file")
     return
+  data = p_text.encode("UTF-8")
+  h = NewDigestHasher()
+  h.update(data)
+  new_digest = h.hexdigest()
   try:
-    with open(path, "w") as output_file:
-      output_file.write(p_text)
+    with open(path, "wb") as output_file:
+      output_file.write(data)
   except Exception as e:
     SendError(500, "Internal Server Error", "writing failed: " + str(e))
     return
+  UpdateDirIndex(dir_path, [p_res], os.stat(dir_path).st_mtime_ns, {p_res: new_digest})
   print("Content-Type: text/plain; charset=UTF-8")
   print("")
   print('The file "{}" has been updated successfully.'.format(p_res))
-  new_digest = ReadFileDigest(path)
   print('digest={}'.format(new_digest))
 
 
 def ProcessGenerate(params, data_dirs):
   p_dir = TextToInt(params.get("dir", "1"))
-  p_res = params.get("res", "")
+  p_res_list = [x for x in params.getlist("res") if x]
   p_hoard = TextToBool(params.get("hoard", ""))
   if p_dir < 1 or p_dir > len(data_dirs):
     SendError(404, "Not Found", "invalid dir parameter")
     return
-  if p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
-    SendError(400, "Bad Parameter", "invalid res parameter")
+  if len(p_res_list) > MAX_BATCH_FILES:
+    SendError(400, "Bad Parameter", "too many res parameters")
     return
+  for p_res in p_res_list:
+    if p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
+      SendError(400, "Bad Parameter", "invalid res parameter")
+      return
   dir_label, dir_path, dir_url, dir_conf = data_dirs[p_dir-1]
   if not os.path.isdir(dir_path):
     SendError(404, "Not Found", "no such directory")
@@ -869,7 +1516,7 @@ def ProcessGenerate(params, data_dirs):
   if not os.path.isfile(dir_conf):
     SendError(403, "Not Found", "missing config file")
     return
-  if p_res:
+  for p_res in p_res_list:
     ext = re.sub(r"^\.", "", os.path.splitext(p_res)[1])
     if ext != "art":
       SendError(403, "Forbidden", "not an article file")
@@ -880,102 +1527,432 @@ def ProcessGenerate(params, data_dirs):
       return
     st = os.stat(path)
     if not stat.S_ISREG(st.st_mode):
-      PrintError(403, "Forbidden", "not a regular file")
+      SendError(403, "Forbidden", "not a regular file")
       return
+  job_dir = os.path.join(GetWorkDir(dir_path), JOB_DIR_NAME)
+  try:
+    job_id = EnqueueJob(job_dir, dir_conf, p_res_list, p_hoard)
+    StartJobWorker(job_dir)
+  except Exception as e:
+    SendError(500, "Internal Server Error", "generating failed: " + str(e))
+    return
+  print("Status: 202 Accepted")
+  print("Content-Type: text/plain; charset=UTF-8")
+  print("")
+  print("job={}".format(job_id))
+
+
+def ProcessGenerateStatus(params, data_dirs):
+  p_dir = TextToInt(params.get("dir", "1"))
+  p_job = params.get("job", "")
+  p_offset = max(TextToInt(params.get("offset", "0")), 0)
+  if p_dir < 1 or p_dir > len(data_dirs):
+    SendError(404, "Not Found", "invalid dir parameter")
+    return
+  if not re.search(r"^[0-9]+-[0-9a-f]+$", p_job):
+    SendError(400, "Bad Parameter", "invalid job parameter")
+    return
+  job_dir = os.path.join(data_dirs[p_dir-1][1], WORK_DIR_NAME, JOB_DIR_NAME)
+  job_path = os.path.join(job_dir, p_job + ".job")
+  log_path = os.path.join(job_dir, p_job + ".log")
+  job = ReadJob(job_path)
+  if not job:
+    SendError(404, "Not Found", "no such job")
+    return
+  log_size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+  log_data = b""
+  if log_size > p_offset:
+    with open(log_path, "rb") as input_file:
+      input_file.seek(p_offset)
+      log_data = input_file.read(log_size - p_offset)
+  now = time.time()
+  elapsed = 0
+  if job["started"]:
+    elapsed = (float(job["finished"]) if job["finished"] else now) - float(job["started"])
+  print("Content-Type: text/plain; charset=UTF-8")
+  print("Cache-Control: no-store")
+  print("BBB-job-id: " + job["id"])
+  print("BBB-job-state: " + job["state"])
+  print("BBB-job-exit: " + job["exit"])
+  print("BBB-job-elapsed: {:.1f}".format(elapsed))
+  print("BBB-log-offset: {}".format(p_offset + len(log_data)))
+  print("")
+  sys.stdout.flush()
+  sys.stdout.buffer.write(log_data)
+  sys.stdout.flush()
+
+
+def ReadJob(path):
+  job = {"id": "", "conf": "", "targets": [], "full": False, "hoard": False,
+         "state": "", "requests": 0,
+         "created": "", "started": "", "finished": "", "exit": ""}
+  try:
+    with open(path) as input_file:
+      for line in input_file:
+        fields = line.rstrip("\n").split("\t", 1)
+        if len(fields) != 2: continue
+        name, value = fields
+        if name == "target":
+          job["targets"].append(value)
+        elif name in ["full", "hoard"]:
+          job[name] = TextToBool(value)
+        elif name == "requests":
+          job[name] = TextToInt(value)
+        elif name in job:
+          job[name] = value
+  except FileNotFoundError:
+    return None
+  return job
+
+
+def WriteJob(path, job):
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as output_file:
+    for name, value in job.items():
+      if name == "targets":
+        for target in value:
+          print("target\t" + target, file=output_file)
+      else:
+        print("{}\t{}".format(name, value), file=output_file)
+  os.replace(tmp_path, path)
+
+
+def ListJobs(job_dir):
+  jobs = []
+  for name in os.listdir(job_dir):
+    match = re.search(r"^([0-9]+-[0-9a-f]+)\.job$", name)
+    if not match: continue
+    job = ReadJob(os.path.join(job_dir, name))
+    if job:
+      jobs.append(job)
+  return sorted(jobs, key=lambda x: x["id"])
+
+
+def LockJobQueue(job_dir):
+  os.makedirs(job_dir, exist_ok=True)
+  fd = os.open(os.path.join(job_dir, "queue.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+  fcntl.flock(fd, fcntl.LOCK_EX)
+  return fd
+
+
+def EnqueueJob(job_dir, dir_conf, res_list, hoard):
+  fd = LockJobQueue(job_dir)
+  try:
+    now = time.time()
+    for job in ListJobs(job_dir):
+      if job["state"] in ["done", "failed"] and job["finished"]:
+        if float(job["finished"]) < now - JOB_EXPIRE_TIME:
+          for ext in [".job", ".log"]:
+            path = os.path.join(job_dir, job["id"] + ext)
+            if os.path.exists(path):
+              os.remove(path)
+        continue
+      if job["state"] == "pending" and job["conf"] == dir_conf:
+        if res_list:
+          if not job["full"]:
+            for res in res_list:
+              if res not in job["targets"]:
+                job["targets"].append(res)
+        else:
+          job["full"] = True
+          job["targets"] = []
+        job["hoard"] = job["hoard"] or bool(hoard)
+        job["requests"] += 1
+        WriteJob(os.path.join(job_dir, job["id"] + ".job"), job)
+        return job["id"]
+    job_id = "{:020d}-{}".format(time.time_ns(), os.urandom(4).hex())
+    targets = []
+    for res in res_list:
+      if res not in targets:
+        targets.append(res)
+    job = {"id": job_id, "conf": dir_conf, "targets": targets,
+           "full": not targets, "hoard": bool(hoard), "state": "pending", "requests": 1,
+           "created": "{:.3f}".format(now), "started": "", "finished": "",
+           "exit": ""}
+    WriteJob(os.path.join(job_dir, job_id + ".job"), job)
+    return job_id
+  finally:
+    os.close(fd)
+
+
+def StartJobWorker(job_dir):
+  script_path = os.path.abspath(__file__)
+  command = [sys.executable, script_path, "--run-jobs", job_dir]
+  env = dict(os.environ)
+  env.pop("GATEWAY_INTERFACE", None)
+  subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, env=env, start_new_session=True, close_fds=True)
+
+
+def RunJobWorker(job_dir):
+  worker_fd = os.open(os.path.join(job_dir, "worker.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+  try:
+    fcntl.flock(worker_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except BlockingIOError:
+    os.close(worker_fd)
+    return 0
   old_env_path = os.environ.get("PATH")
   if old_env_path:
-    new_env_path = old_env_path + ":/usr/local/bin:."
+    os.environ["PATH"] = old_env_path + ":/usr/local/bin:."
   else:
-    new_env_path = "/bin:/usr/bin:/usr/local/bin:."
-  os.environ["PATH"] = new_env_path
-  command = "{} --conf {}".format(BBB_GENERATE_COMMAND, dir_conf)
-  if p_hoard:
-    command += " --hoard"
-  if p_res and p_res.find("'") < 0:
-    command += " '{}'".format(p_res)
-  try:
-    fd = os.open(dir_conf, os.O_RDONLY)
-    fcntl.flock(fd, fcntl.LOCK_EX)
-    output = subprocess.Popen(
-      command, stderr=subprocess.PIPE, shell=True).stderr.readlines()
+    os.environ["PATH"] = "/bin:/usr/bin:/usr/local/bin:."
+  fd = LockJobQueue(job_dir)
+  for job in ListJobs(job_dir):
+    if job["state"] == "running":
+      job["state"] = "failed"
+      job["finished"] = "{:.3f}".format(time.time())
+      WriteJob(os.path.join(job_dir, job["id"] + ".job"), job)
+  os.close(fd)
+  while True:
+    fd = LockJobQueue(job_dir)
+    pending = [x for x in ListJobs(job_dir) if x["state"] == "pending"]
+    if not pending:
+      os.close(worker_fd)
+      os.close(fd)
+      return 0
+    job = pending[0]
+    job_path = os.path.join(job_dir, job["id"] + ".job")
+    job["state"] = "running"
+    job["started"] = "{:.3f}".format(time.time())
+    WriteJob(job_path, job)
+    os.close(fd)
+    command = [BBB_GENERATE_COMMAND, "--conf", job["conf"]]
+    if job["hoard"]:
+      command.append("--hoard")
+    if not job["full"]:
+      command.append("--")
+      command.extend(job["targets"])
+    exit_code = -1
+    with open(os.path.join(job_dir, job["id"] + ".log"), "w", buffering=1) as log_file:
+      try:
+        conf_fd = os.open(job["conf"], os.O_RDONLY)
+        try:
+          fcntl.flock(conf_fd, fcntl.LOCK_EX)
+          site = GetGeneratorSite(job["conf"], job["hoard"])
+          if site:
+            targets = set() if job["full"] else job["targets"]
+            exit_code = RunGeneratorSite(site, targets, log_file)
+          else:
+            exit_code = subprocess.call(command, stdin=subprocess.DEVNULL,
+                                        stdout=log_file, stderr=log_file)
+        finally:
+          os.close(conf_fd)
+      except Exception as e:
+        log_file.write("generating failed: {}\n".format(e))
+    fd = LockJobQueue(job_dir)
+    job = ReadJob(job_path)
+    job["state"] = "done" if exit_code == 0 else "failed"
+    job["finished"] = "{:.3f}".format(time.time())
+    job["exit"] = str(exit_code)
+    WriteJob(job_path, job)
     os.close(fd)
+
+
+def LoadGeneratorModule():
+  global generator_module
+  if generator_module:
+    return generator_module
+  path = BBB_GENERATE_MODULE
+  if not path:
+    local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bbb_generate.py")
+    if os.path.isfile(local_path):
+      path = local_path
+    else:
+      path = shutil.which(BBB_GENERATE_COMMAND) or ""
+  if not path or not os.path.isfile(path):
+    return None
+  module_dir = os.path.dirname(os.path.abspath(path))
+  if module_dir not in sys.path:
+    sys.path.append(module_dir)
+  try:
+    loader = importlib.machinery.SourceFileLoader("bbb_generate", path)
+    spec = importlib.util.spec_from_loader("bbb_generate", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+  except Exception:
+    return None
+  if not hasattr(module, "Site"):
+    return None
+  module.logger.propagate = False
+  generator_module = module
+  return module
+
+
+def GetGeneratorSite(dir_conf, hoard):
+  module = LoadGeneratorModule()
+  if not module:
+    return None
+  key = (dir_conf, bool(hoard))
+  site = generator_sites.get(key)
+  if not site:
+    site = module.Site(dir_conf, bool(hoard))
+    generator_sites[key] = site
+  return site
+
+
+def RunGeneratorSite(site, targets, log_file):
+  focus_stem_set = set([re.sub(r"\.art$", "", x) for x in targets])
+  handler = logging.StreamHandler(log_file)
+  handler.setFormatter(logging.Formatter("%(levelname)s\t%(message)s"))
+  logger = generator_module.logger
+  logger.addHandler(handler)
+  try:
+    start_time = time.time()
+    logger.info("Process started: conf={}".format(site.conf_path))
+    site.generate(focus_stem_set)
+    logger.info("Process done: elapsed_time={:.3f}s".format(time.time() - start_time))
+    return 0
+  except Exception:
+    log_file.write(traceback.format_exc())
+    return 1
+  finally:
+    logger.removeHandler(handler)
+
+
+def ProcessRenderPreview(params, data_dirs):
+  p_dir = TextToInt(params.get("dir", "1"))
+  p_res = params.get("res", "")
+  p_text = params.get("text")
+  if p_dir < 1 or p_dir > len(data_dirs):
+    SendError(404, "Not Found", "invalid dir parameter")
+    return
+  if (p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH or
+      not p_res.endswith(".art") or IsIgnoredFilename(p_res)):
+    SendError(400, "Bad Parameter", "invalid res parameter")
+    return
+  dir_label, dir_path, dir_url, dir_conf = data_dirs[p_dir-1]
+  if not dir_conf or not os.path.isfile(dir_conf):
+    SendError(403, "Forbidden", "no config is set")
+    return
+  if p_text is not None:
+    p_text = p_text.replace("\r\n", "\n").replace("\r", "\n")
+    if len(p_text) > MAX_TEXT_LENGTH:
+      SendError(400, "Bad Parameter", "too larget text")
+      return
+  site = GetGeneratorSite(dir_conf, False)
+  if not site:
+    SendError(501, "Not Implemented", "the generator module is not available")
+    return
+  stem = re.sub(r"\.art$", "", p_res)
+  try:
+    site_url = site.load()["site_url"]
+    content = site.render_article(stem, p_text)
   except Exception as e:
-    SendError(500, "Internal Server Error", "generating failed: " + str(e))
+    SendError(500, "Internal Server Error", "rendering failed: " + str(e))
     return
-  print("Content-Type: text/plain; charset=UTF-8")
-  print()
-  for line in output:
-    line = line.decode()
-    line = line.replace("\t", "  ").rstrip()
-    print(line)
+  page_url = re.sub(r"/[^/]+$", "/", site_url) + urllib.parse.quote(stem + ".xhtml")
+  content = re.sub(r"(<head[^>]*>)", lambda m: '{}\n<base href="{}"/>'.format(
+    m.group(1), esc(page_url)), content, count=1)
+  print("Content-Type: application/xhtml+xml")
+  print("Cache-Control: no-store")
+  print("")
+  sys.stdout.flush()
+  sys.stdout.buffer.write(content.encode("UTF-8"))
+  sys.stdout.flush()
 
 
-def ProcessUpload(params, data_dirs):
+def ProcessUpload(params, uploads, data_dirs):
   p_dir = TextToInt(params.get("dir", "1"))
-  p_file = params.get("file", b"")
-  p_file_filename = NormalizeFilename(params.get("file_filename", ""))
-  p_newname = NormalizeFilename(params.get("newname", ""))
+  p_uploads = uploads.get("file") or []
+  p_newname = params.get("newname", "")
   p_naming = params.get("naming", "local").strip()
   p_overwrite = params.get("overwrite", "stop").strip()
-  if p_dir < 1 or p_dir > len(data_dirs):
-    PrintError("upload failed: invalid dir parameter")
-    return
-  if p_naming != "empty" and (not p_file or not p_file_filename):
+  if p_naming == "empty":
+    p_uploads = [{"filename": "", "path": "", "size": 0, "error": ""}]
+  if not p_uploads:
     PrintError("upload failed: file is not specified")
     return
-  if len(p_file) > MAX_FILE_SIZE:
-    PrintError("upload failed: too large file")
+  results, error = PlaceUploadedFiles(
+    data_dirs, p_dir, p_uploads, p_naming, p_newname, p_overwrite)
+  if error:
+    PrintError("upload failed: " + error)
     return
+  for upload, filename, error in results:
+    if error:
+      if upload["filename"]:
+        error = '"{}": {}'.format(upload["filename"], error)
+      PrintError("upload failed: " + error)
+    else:
+      PrintInfo('The file "{}" has been uploaded successfully.'.format(filename))
+
+
+def PlaceUploadedFiles(data_dirs, p_dir, uploads, p_naming, p_newname, p_overwrite):
+  p_newname = NormalizeFilename(p_newname)
+  if p_dir < 1 or p_dir > len(data_dirs):
+    return None, "invalid dir parameter"
+  if p_naming in ["assign", "empty"] and len(uploads) > 1:
+    return None, "only one file can be assigned a name"
   dir_label, dir_path, dir_url, dir_conf = data_dirs[p_dir-1]
   if not os.path.isdir(dir_path):
-    PrintError("upload failed: no such directory")
-    return
-  total_file_size = len(p_file)
-  num_files = 1
-  for name in os.listdir(dir_path):
-    ignore = False
-    for ignore_regex in IGNORE_FILENAME_REGEXES:
-      if re.search(ignore_regex, name):
-        ignore = True
-    if ignore: continue
-    total_file_size += os.path.getsize(os.path.join(dir_path, name))
-    num_files += 1
+    return None, "no such directory"
+  lock_fd = LockDataDir(dir_path)
+  try:
+    old_dir_mtime = os.stat(dir_path).st_mtime_ns
+    entries = LoadDirIndex(dir_path)
+    total_file_size = sum([x["size"] for x in entries])
+    num_files = len(entries)
+    date = datetime.datetime.fromtimestamp(time.time(), dateutil.tz.tzlocal())
+    results = []
+    names = []
+    for upload in uploads:
+      if upload["error"]:
+        results.append((upload, None, upload["error"]))
+        continue
+      total_file_size += upload["size"]
+      filename, error = PlaceUploadedFile(
+        dir_path, dir_conf, upload, p_naming, p_newname, p_overwrite, date, len(names),
+        total_file_size, num_files + 1)
+      if error:
+        total_file_size -= upload["size"]
+      else:
+        num_files += 1
+        names.append(filename)
+      results.append((upload, filename, error))
+    if names:
+      UpdateDirIndex(dir_path, names, old_dir_mtime)
+  finally:
+    os.close(lock_fd)
+  return results, None
+
+
+def PlaceUploadedFile(dir_path, dir_conf, upload, p_naming, p_newname, p_overwrite,
+                      date, seq, total_file_size, num_files):
+  p_file_filename = NormalizeFilename(upload["filename"])
+  if p_naming != "empty" and (not upload["size"] or not p_file_filename):
+    return None, "file is not specified"
+  if upload["size"] > MAX_FILE_SIZE:
+    return None, "too large file"
   if total_file_size > MAX_TOTAL_FILE_SIZE:
-    PrintError("upload failed: exceeding the total file size limit")
-    return
+    return None, "exceeding the total file size limit"
   if num_files > MAX_NUM_FILES:
-    PrintError("upload failed: exceeding the file number limit")
-    return
+    return None, "exceeding the file number limit"
   if p_naming == "date":
-    date = datetime.datetime.fromtimestamp(time.time(), dateutil.tz.tzlocal())
     filename = date.strftime("%Y%m%d%H%M%S")
+    if seq > 0:
+      filename += "-{:d}".format(seq + 1)
   elif p_naming in ["assign", "empty"]:
     filename = p_newname
   else:
     filename = p_file_filename
   if len(filename) > MAX_FILENAME_LENGTH:
-    PrintError("upload failed: too long filename")
-    return
+    return None, "too long filename"
   stem, ext = os.path.splitext(filename)
   if not stem:
-    PrintError("upload failed: invalid filename")
-    return
+    return None, "invalid filename"
   if not ext:
     ext = os.path.splitext(p_file_filename)[1]
     if ext:
       filename = filename + ext
   for ignore_regex in IGNORE_FILENAME_REGEXES:
     if re.search(ignore_regex, filename):
-      PrintError("upload failed: forbidden filename")
-      return
+      return None, "forbidden filename"
   path = os.path.join(dir_path, filename)
   if os.path.exists(path):
     if p_overwrite == "rename":
       i = 2
       while True:
         if i >= 1000:
-          PrintError("upload failed: too many filename duplications")
-          return
+          return None, "too many filename duplications"
         stem, ext = os.path.splitext(filename)
         new_filename = "{}-{:d}.{}".format(stem, i, ext)
         new_path = os.path.join(dir_path, new_filename)
@@ -985,19 +1962,232 @@ def ProcessUpload(params, data_dirs):
           break
         i += 1
     elif p_overwrite == "stop":
-      PrintError("upload failed: duplicated filename")
-      return
+      return None, "duplicated filename"
   try:
-    with open(path, "wb") as output_file:
-      if p_naming == "empty" and dir_conf:
-        if filename.endswith(".art"):
+    if p_naming == "empty":
+      with open(path, "wb") as output_file:
+        if dir_conf and filename.endswith(".art"):
           WriteArticleTemplate(output_file, dir_conf, filename)
-      else:
-        output_file.write(p_file)
+    elif os.path.dirname(upload["path"]) == os.path.join(dir_path, WORK_DIR_NAME):
+      os.replace(upload["path"], path)
+    else:
+      shutil.move(upload["path"], path)
+  except Exception as e:
+    return None, str(e)
+  return filename, None
+
+
+def GetChunkedUploadPaths(dir_path, upload_id):
+  work_dir = GetWorkDir(dir_path)
+  part_path = os.path.join(work_dir, ".upload-{}.part".format(upload_id))
+  meta_path = os.path.join(work_dir, ".upload-{}.meta".format(upload_id))
+  return part_path, meta_path
+
+
+def ReadChunkedUploadMeta(meta_path):
+  size = -1
+  filename = ""
+  ranges = []
+  with open(meta_path) as input_file:
+    fcntl.flock(input_file, fcntl.LOCK_SH)
+    for i, line in enumerate(input_file):
+      fields = line.rstrip("\n").split("\t")
+      if i == 0:
+        if len(fields) < 2: break
+        size = TextToInt(fields[0])
+        filename = fields[1]
+      elif len(fields) == 2:
+        ranges.append((TextToInt(fields[0]), TextToInt(fields[1])))
+  return size, filename, ranges
+
+
+def GetStoredOffset(ranges):
+  offset = 0
+  for start, length in sorted(ranges):
+    if start > offset: break
+    offset = max(offset, start + length)
+  return offset
+
+
+def CleanChunkedUploads(dir_path):
+  now = time.time()
+  work_dir = GetWorkDir(dir_path)
+  for name in os.listdir(work_dir):
+    if not re.search(r"^\.upload-[0-9a-f]+\.(part|meta|tmp)$", name): continue
+    path = os.path.join(work_dir, name)
+    try:
+      if os.path.getmtime(path) < now - UPLOAD_EXPIRE_TIME:
+        os.remove(path)
+    except FileNotFoundError:
+      pass
+
+
+# Pending uploads reserve their whole size when they are started, so they count towards the
+# limits of the directory until they are completed or expire.
+def GetPendingUploadUsage(dir_path):
+  total_size = 0
+  num_uploads = 0
+  work_dir = GetWorkDir(dir_path)
+  for name in os.listdir(work_dir):
+    if not re.search(r"^\.upload-[0-9a-f]+\.part$", name): continue
+    try:
+      total_size += os.path.getsize(os.path.join(work_dir, name))
+    except FileNotFoundError:
+      continue
+    num_uploads += 1
+  return total_size, num_uploads
+
+
+def CheckChunkedUpload(params, data_dirs):
+  p_dir = TextToInt(params.get("dir", "1"))
+  p_id = params.get("id", "")
+  if p_dir < 1 or p_dir > len(data_dirs):
+    SendError(404, "Not Found", "invalid dir parameter")
+    return None
+  if not re.search(r"^[0-9a-f]{32}$", p_id):
+    SendError(400, "Bad Parameter", "invalid id parameter")
+    return None
+  dir_path = data_dirs[p_dir-1][1]
+  part_path, meta_path = GetChunkedUploadPaths(dir_path, p_id)
+  if not os.path.isfile(part_path) or not os.path.isfile(meta_path):
+    SendError(404, "Not Found", "no such upload")
+    return None
+  size, filename, ranges = ReadChunkedUploadMeta(meta_path)
+  if size < 0:
+    SendError(500, "Internal Server Error", "broken upload metadata")
+    return None
+  return p_dir, dir_path, part_path, meta_path, size, filename, ranges
+
+
+def PrintChunkedUploadStatus(upload_id, size, ranges):
+  print("Content-Type: text/plain; charset=UTF-8")
+  print("")
+  print("id={}".format(upload_id))
+  print("size={}".format(size))
+  print("offset={}".format(GetStoredOffset(ranges)))
+  print("ranges={}".format(",".join(
+    ["{}-{}".format(start, start + length) for start, length in sorted(ranges)])))
+
+
+def ProcessUploadInit(params, data_dirs):
+  p_dir = TextToInt(params.get("dir", "1"))
+  p_filename = params.get("filename", "")
+  p_size = TextToInt(params.get("size", ""))
+  if p_dir < 1 or p_dir > len(data_dirs):
+    SendError(404, "Not Found", "invalid dir parameter")
+    return
+  if not NormalizeFilename(p_filename) or len(p_filename) > MAX_FILENAME_LENGTH:
+    SendError(400, "Bad Parameter", "invalid filename parameter")
+    return
+  if p_size < 1:
+    SendError(400, "Bad Parameter", "invalid size parameter")
+    return
+  if p_size > MAX_FILE_SIZE:
+    SendError(413, "Payload Too Large", "too large file")
+    return
+  dir_path = data_dirs[p_dir-1][1]
+  if not os.path.isdir(dir_path):
+    SendError(404, "Not Found", "no such directory")
+    return
+  CleanChunkedUploads(dir_path)
+  upload_id = os.urandom(16).hex()
+  part_path, meta_path = GetChunkedUploadPaths(dir_path, upload_id)
+  lock_fd = LockDataDir(dir_path)
+  try:
+    entries = LoadDirIndex(dir_path)
+    pending_size, num_pending = GetPendingUploadUsage(dir_path)
+    if sum([x["size"] for x in entries]) + pending_size + p_size > MAX_TOTAL_FILE_SIZE:
+      SendError(507, "Insufficient Storage", "exceeding the total file size limit")
+      return
+    if len(entries) + num_pending + 1 > MAX_NUM_FILES:
+      SendError(507, "Insufficient Storage", "exceeding the file number limit")
+      return
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+      os.ftruncate(fd, p_size)
+    finally:
+      os.close(fd)
+    with open(meta_path, "x") as output_file:
+      print("{}\t{}".format(p_size, re.sub(r"[\t\r\n]", " ", p_filename)), file=output_file)
   except Exception as e:
-    PrintError("upload failed: " + str(e))
+    SendError(500, "Internal Server Error", "init failed: " + str(e))
     return
-  PrintInfo('The file "{}" has been uploaded successfully.'.format(filename))
+  finally:
+    os.close(lock_fd)
+  PrintChunkedUploadStatus(upload_id, p_size, [])
+
+
+def ProcessUploadStatus(params, data_dirs):
+  upload = CheckChunkedUpload(params, data_dirs)
+  if not upload: return
+  p_dir, dir_path, part_path, meta_path, size, filename, ranges = upload
+  PrintChunkedUploadStatus(params.get("id"), size, ranges)
+
+
+def ProcessUploadChunk(params, data_dirs, request):
+  upload = CheckChunkedUpload(params, data_dirs)
+  if not upload: return
+  p_dir, dir_path, part_path, meta_path, size, filename, ranges = upload
+  p_offset = TextToInt(params.get("offset", ""))
+  content_length = request.content_length()
+  if content_length < 1 or content_length > MAX_CHUNK_SIZE:
+    SendError(413, "Payload Too Large", "invalid chunk size")
+    return
+  if p_offset < 0 or p_offset + content_length > size:
+    SendError(416, "Range Not Satisfiable", "invalid offset parameter")
+    return
+  input_file = request.input
+  written = 0
+  try:
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+      while written < content_length:
+        buf = input_file.read(min(content_length - written, UPLOAD_BLOCK_SIZE))
+        if not buf: break
+        while buf:
+          num = os.pwrite(fd, buf, p_offset + written)
+          buf = buf[num:]
+          written += num
+    finally:
+      os.close(fd)
+  except Exception as e:
+    SendError(500, "Internal Server Error", "writing failed: " + str(e))
+    return
+  if written != content_length:
+    SendError(400, "Bad Request", "truncated chunk")
+    return
+  with open(meta_path, "a") as output_file:
+    fcntl.flock(output_file, fcntl.LOCK_EX)
+    print("{}\t{}".format(p_offset, written), file=output_file)
+  size, filename, ranges = ReadChunkedUploadMeta(meta_path)
+  PrintChunkedUploadStatus(params.get("id"), size, ranges)
+
+
+def ProcessUploadFinalize(params, data_dirs):
+  upload = CheckChunkedUpload(params, data_dirs)
+  if not upload: return
+  p_dir, dir_path, part_path, meta_path, size, filename, ranges = upload
+  p_newname = params.get("newname", "")
+  p_naming = params.get("naming", "local").strip()
+  p_overwrite = params.get("overwrite", "stop").strip()
+  if p_naming == "empty":
+    SendError(400, "Bad Parameter", "invalid naming parameter")
+    return
+  if GetStoredOffset(ranges) < size:
+    SendError(409, "Conflict", "incomplete upload")
+    return
+  upload = {"filename": filename, "path": part_path, "size": size, "error": ""}
+  results, error = PlaceUploadedFiles(
+    data_dirs, p_dir, [upload], p_naming, p_newname, p_overwrite)
+  if not error:
+    upload, filename, error = results[0]
+  if error:
+    SendError(400, "Bad Request", "upload failed: " + error)
+    return
+  os.remove(meta_path)
+  print("Content-Type: text/plain; charset=UTF-8")
+  print("")
+  print('The file "{}" has been uploaded successfully.'.format(filename))
 
 
 def WriteArticleTemplate(output_file, dir_conf, filename):
@@ -1052,33 +2242,51 @@ def WriteArticleTemplate(output_file, dir_conf, filename):
 
 def ProcessRemoval(params, data_dirs):
   p_dir = TextToInt(params.get("dir", "1"))
-  p_res = params.get("res", "")
-  p_order = params.get("order", "date_r").strip()
-  p_page = TextToInt(params.get("page", "1"))
+  p_res_list = params.getlist("res")
   if p_dir < 1 or p_dir > len(data_dirs):
     PrintError("removal failed: invalid dir parameter")
     return
-  if p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
+  if not p_res_list or len(p_res_list) > MAX_BATCH_FILES:
     PrintError("removal failed: invalid res parameter")
     return
+  for p_res in p_res_list:
+    if not p_res or p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
+      PrintError("removal failed: invalid res parameter")
+      return
   dir_label, dir_path, dir_url, dir_conf = data_dirs[p_dir-1]
   if not os.path.isdir(dir_path):
     PrintError("removal failed: no such directory")
     return
-  path = os.path.join(dir_path, p_res)
-  if not os.path.exists(path):
-    PrintError("preview failed: no such file")
-    return
-  st = os.stat(path)
-  if not stat.S_ISREG(st.st_mode):
-    PrintError("preview failed: not a regular file")
-    return
+  lock_fd = LockDataDir(dir_path)
   try:
-    os.remove(path)
-  except Exception as e:
-    PrintError("removal failed: " + str(e))
-    return
-  PrintInfo('The file "{}" has been removed successfully.'.format(p_res))
+    old_dir_mtime = os.stat(dir_path).st_mtime_ns
+    removed = []
+    for p_res in p_res_list:
+      if p_res in removed: continue
+      path = os.path.join(dir_path, p_res)
+      if IsIgnoredFilename(p_res):
+        PrintError('removal failed: "{}": forbidden filename'.format(p_res))
+        continue
+      if not os.path.exists(path):
+        PrintError('removal failed: "{}": no such file'.format(p_res))
+        continue
+      if not stat.S_ISREG(os.stat(path).st_mode):
+        PrintError('removal failed: "{}": not a regular file'.format(p_res))
+        continue
+      try:
+        os.remove(path)
+      except Exception as e:
+        PrintError('removal failed: "{}": {}'.format(p_res, str(e)))
+        continue
+      removed.append(p_res)
+    if removed:
+      UpdateDirIndex(dir_path, removed, old_dir_mtime)
+  finally:
+    os.close(lock_fd)
+  if len(removed) == 1:
+    PrintInfo('The file "{}" has been removed successfully.'.format(removed[0]))
+  elif removed:
+    PrintInfo('{:d} files have been removed successfully.'.format(len(removed)))
 
 
 def PrintControl(params, data_dirs, script_url):
@@ -1127,12 +2335,14 @@ def PrintControl(params, data_dirs, script_url):
     P('<tr>')
     P('<td class="label">Upload:</td>')
     P('<td class="input">')
-    P('<form name="upload_form" action="{}" method="POST" enctype="multipart/form-data"'
+    P('<form name="upload_form" action="{}?dir={}" method="POST"'
+      ' enctype="multipart/form-data"'
       ' autocomplete="off" onsubmit="return check_upload();"'
-      ' id="upload_form" data-step-order="{}">',
-      script_url, step_order)
+      ' id="upload_form" data-step-order="{}"'
+      ' data-chunk-size="{}" data-chunk-parallelism="{}">',
+      script_url, p_dir, step_order, UPLOAD_CHUNK_SIZE, UPLOAD_PARALLELISM)
     P('<div class="control_row">')
-    P('<input type="file" id="input_file" name="file"/>')
+    P('<input type="file" id="input_file" name="file" multiple="multiple"/>')
     P('<select id="select_name" name="naming" onchange="adjust_control();">')
     for label, value in [("name: local", "local"), ("name: date", "date"),
                          ("name: assign", "assign"), ("empty file", "empty")]:
@@ -1148,6 +2358,7 @@ def PrintControl(params, data_dirs, script_url):
       P('>{}</option>', label)
     P('</select>')
     P('<input type="submit" value="upload"/>')
+    P('<span id="proc_message"></span>')
     P('</div>')
     P('<div id="filename_row" class="hidden_row">')
     P('Filename: <input type="input" id="input_filename" name="newname" value=""/>')
@@ -1180,7 +2391,7 @@ def DateExpr(num):
   return date.strftime("%Y/%m/%d %H:%M:%S")
 
 
-def PrintDirectory(params, data_dirs):
+def PrintDirectory(params, data_dirs, script_url):
   p_dir = TextToInt(params.get("dir", "1"))
   p_order = params.get("order", "date_r").strip()
   p_page = TextToInt(params.get("page", "1"))
@@ -1196,41 +2407,35 @@ def PrintDirectory(params, data_dirs):
     return
   data_files = []
   total_size = 0
-  for name in sorted(os.listdir(dir_path)):
-    ignore = False
-    for ignore_regex in IGNORE_FILENAME_REGEXES:
-      if re.search(ignore_regex, name):
-        ignore = True
-    if ignore: continue
-    path = os.path.join(dir_path, name)
-    st = os.stat(path)
-    if not stat.S_ISREG(st.st_mode): continue
+  for entry in LoadDirIndex(dir_path):
+    name = entry["name"]
     data_file = {
       "name": name,
-      "path": path,
-      "stat": st,
+      "path": os.path.join(dir_path, name),
+      "size": entry["size"],
+      "mtime": entry["mtime_ns"],
+      "ino": entry["ino"],
       "ext": re.sub(r"^\.", "", os.path.splitext(name)[1].lower())
     }
     data_files.append(data_file)
-    total_size += st.st_size
+    total_size += entry["size"]
   if not data_files:
     PrintError("no files to show")
     return
-  if p_order == "name":
-    data_files = sorted(data_files, key=lambda x: x["name"])
-  elif p_order == "name_r":
-    data_files = sorted(data_files, key=lambda x: x["name"], reverse=True)
+  if p_order == "name_r":
+    data_files.reverse()
   elif p_order == "size":
-    data_files = sorted(data_files, key=lambda x: (x["stat"].st_size, x["name"]))
+    data_files = sorted(data_files, key=lambda x: (x["size"], x["name"]))
   elif p_order == "size_r":
-    data_files = sorted(data_files, key=lambda x: (x["stat"].st_size, x["name"]), reverse=True)
+    data_files = sorted(data_files, key=lambda x: (x["size"], x["name"]), reverse=True)
   elif p_order == "date":
-    data_files = sorted(data_files, key=lambda x: (x["stat"].st_mtime, x["name"]))
+    data_files = sorted(data_files, key=lambda x: (x["mtime"], x["name"]))
   elif p_order == "date_r":
-    data_files = sorted(data_files, key=lambda x: (x["stat"].st_mtime, x["name"]), reverse=True)
+    data_files = sorted(data_files, key=lambda x: (x["mtime"], x["name"]), reverse=True)
   num_files = len(data_files)
   start_index = NUM_FILES_IN_PAGE * (p_page - 1)
   data_files = data_files[start_index:start_index+NUM_FILES_IN_PAGE]
+  total_size += RefreshDataFiles(dir_path, data_files)
   P('<p>There are {:d} files with {} in total.</p>',
     num_files, SizeExpr(total_size))
   def PrintPagenation():
@@ -1244,9 +2449,25 @@ def PrintDirectory(params, data_dirs):
         P('<a href="{}">{}</a>', page_url, i)
     P('</div>')
   PrintPagenation()
+  P('<form name="batch_form" action="{}" method="GET" autocomplete="off"'
+    ' onsubmit="return check_batch_removal();" id="batch_form" data-dir="{}">',
+    script_url, p_dir)
+  P('<div class="batch_row">')
+  P('Selected files:')
+  P('<input type="submit" value="remove"/>')
+  if BBB_GENERATE_COMMAND and dir_conf:
+    P('<input type="button" value="generate" onclick="batch_generate();"/>')
+  P('</div>')
+  P('<div class="control_row" id="bbb_update_logs"></div>')
+  P('<div class="hidden_row">')
+  P('<input type="hidden" name="action" value="remove-preview"/>')
+  P('<input type="hidden" name="dir" value="{}"/>', p_dir)
+  P('<input type="hidden" name="order" value="{}"/>', p_order)
+  P('<input type="hidden" name="page" value="{}"/>', p_page)
+  P('</div>')
   P('<table class="file_table">')
   P('<tr>')
-  P('<th>#</th>')
+  P('<th><input type="checkbox" onclick="toggle_batch_selection(this);"/></th>')
   P('<th>name</th>')
   P('<th>attributes</th>')
   P('<th>preview</th>')
@@ -1255,14 +2476,16 @@ def PrintDirectory(params, data_dirs):
     num = i + 1 + start_index
     name = data_file["name"]
     path = data_file["path"]
-    st = data_file["stat"]
     ext = data_file["ext"]
     if dir_url:
       url = re.sub(r"/$", "", dir_url) + "/" + urllib.parse.quote(name)
     else:
       url = "?action=download&res={}&dir={}".format(name, p_dir)
     P('<tr>')
-    P('<td class="num">{}</td>', num)
+    P('<td class="num">')
+    P('<div><input type="checkbox" name="res" value="{}"/></div>', name)
+    P('<div>{}</div>', num)
+    P('</td>')
     P('<td class="name">')
     P('<div><a href="{}">{}</a></div>', url, name)
     P('<div class="process_buttons_row">')
@@ -1276,8 +2499,8 @@ def PrintDirectory(params, data_dirs):
     P('</div>')
     P('</td>')
     P('<td class="attrs">')
-    P('<div>{}</div>', SizeExpr(st.st_size))
-    for date_expr in DateExpr(st.st_mtime).split(" "):
+    P('<div>{}</div>', SizeExpr(data_file["size"]))
+    for date_expr in DateExpr(data_file["mtime"] / 1000000000).split(" "):
       P('<div>{}</div>', date_expr)
     P('</td>')
     P('<td class="preview">', end="")
@@ -1285,9 +2508,32 @@ def PrintDirectory(params, data_dirs):
     P('</td>', num)
     P('</tr>')
   P('</table>')
+  P('</form>')
   PrintPagenation()
 
 
+# The directory index is only revalidated against the mtime of the directory, which does not
+# change when a file is rewritten in place.  The files on the shown page are checked one by one
+# and the stale entries are updated, so such files are corrected when they are listed.
+def RefreshDataFiles(dir_path, data_files):
+  size_delta = 0
+  stale_names = []
+  for data_file in data_files:
+    entry = MakeDirIndexEntry(dir_path, data_file["name"])
+    if not entry: continue
+    if (entry["size"] == data_file["size"] and entry["mtime_ns"] == data_file["mtime"] and
+        entry["ino"] == data_file["ino"]): continue
+    size_delta += entry["size"] - data_file["size"]
+    data_file["size"] = entry["size"]
+    data_file["mtime"] = entry["mtime_ns"]
+    data_file["ino"] = entry["ino"]
+    stale_names.append(data_file["name"])
+  if stale_names:
+    dir_mtime = os.stat(dir_path).st_mtime_ns
+    UpdateDirIndex(dir_path, stale_names, dir_mtime)
+  return size_delta
+
+
 def PrintPreview(ext, path, url, digest):
   if ext in TEXT_EXTS:
     if digest:
@@ -1337,7 +2583,7 @@ def PrintEditPreview(params, data_dirs, script_url):
   if ext not in TEXT_EXTS:
     PrintError("preview failed: not a text file")
     return
-  digest = ReadFileDigest(path)
+  digest = GetFileDigest(dir_path, p_res)
   is_article = BBB_GENERATE_COMMAND and dir_conf and ext == "art"
   generated_url = ""
   hoard_local_url = ""
@@ -1358,9 +2604,11 @@ def PrintEditPreview(params, data_dirs, script_url):
     P('<div class="preview_open_button" onclick="open_edit_preview();">preview</div>')
   P('<p>Edit the text content and save.</p>')
   P('<div class="preview_confirm_action">')
+  render_preview = is_article and LoadGeneratorModule() is not None
   P('<form name="edit_form" autocomplete="off" onsubmit="return false;" id="edit_form"'
-    ' data-dir="{}" data-res="{}" data-digest="{}" data-generated-url="{}">',
-    p_dir, p_res, digest, generated_url)
+    ' data-dir="{}" data-res="{}" data-digest="{}" data-generated-url="{}"'
+    ' data-render-preview="{}">',
+    p_dir, p_res, digest, generated_url, "true" if render_preview else "false")
   P('<div class="control_row">')
   P('<input type="button" value="save" class="confirm_button" onclick="edit_save();"/>')
   P('<input type="button" value="cancel" class="confirm_button" onclick="go_back();"/>')
@@ -1398,16 +2646,20 @@ def PrintEditPreview(params, data_dirs, script_url):
 
 
 def PrintRemovePreview(params, data_dirs, script_url):
-  p_res = params.get("res", "")
+  p_res_list = params.getlist("res")
   p_dir = TextToInt(params.get("dir", "1"))
   p_order = params.get("order", "date_r").strip()
   p_page = TextToInt(params.get("page", "1"))
-  if not p_res:
-    PrintError("preview failed: invalid res parameter")
+  if not p_res_list:
+    PrintError("preview failed: no file is selected")
     return
-  if p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
-    PrintError("preview failed: invalid res parameter")
+  if len(p_res_list) > MAX_BATCH_FILES:
+    PrintError("preview failed: too many files")
     return
+  for p_res in p_res_list:
+    if not p_res or p_res.find("/") >= 0 or len(p_res) > MAX_FILENAME_LENGTH:
+      PrintError("preview failed: invalid res parameter")
+      return
   if p_dir < 1 or p_dir > len(data_dirs):
     PrintError("preview failed: invalid dir parameter")
     return
@@ -1415,22 +2667,26 @@ def PrintRemovePreview(params, data_dirs, script_url):
   if not os.path.isdir(dir_path):
     PrintError("preview failed: no such directory")
     return
-  for ignore_regex in IGNORE_FILENAME_REGEXES:
-    if re.search(ignore_regex, p_res):
+  data_files = []
+  for p_res in p_res_list:
+    if p_res in [x[0] for x in data_files]: continue
+    if IsIgnoredFilename(p_res):
       PrintError("preview failed: forbidden filename")
       return
-  path = os.path.join(dir_path, p_res)
-  if not os.path.exists(path):
-    PrintError("preview failed: no such file")
-    return
-  st = os.stat(path)
-  if not stat.S_ISREG(st.st_mode):
-    PrintError("preview failed: not a regular file")
-    return
-  url = re.sub(r"/$", "", dir_url) + "/" + urllib.parse.quote(p_res)
-  ext = re.sub(r"^\.", "", os.path.splitext(p_res)[1].lower())
+    path = os.path.join(dir_path, p_res)
+    if not os.path.exists(path):
+      PrintError("preview failed: no such file")
+      return
+    st = os.stat(path)
+    if not stat.S_ISREG(st.st_mode):
+      PrintError("preview failed: not a regular file")
+      return
+    data_files.append((p_res, path, st))
   P('<div class="preview_confirm_area">')
-  P('<p>Do you really remove this file?</p>')
+  if len(data_files) == 1:
+    P('<p>Do you really remove this file?</p>')
+  else:
+    P('<p>Do you really remove these {:d} files?</p>', len(data_files))
   P('<div class="preview_confirm_action">')
   P('<form name="remove_form" action="{}" method="POST" autocomplete="off">', script_url)
   P('<div class="control_row">')
@@ -1440,21 +2696,27 @@ def PrintRemovePreview(params, data_dirs, script_url):
   P('<div class="hidden_row">')
   P('<input type="hidden" name="action" value="remove"/>')
   P('<input type="hidden" name="dir" value="{}"/>', p_dir)
-  P('<input type="hidden" name="res" value="{}"/>', p_res)
+  for p_res, path, st in data_files:
+    P('<input type="hidden" name="res" value="{}"/>', p_res)
   P('<input type="hidden" name="order" value="{}"/>', p_order)
   P('<input type="hidden" name="page" value="{}"/>', p_page)
   P('</div>')
   P('</form>')
   P('</div>')
-  P('<ul>')
-  P('<li>dir: {}</li>', dir_label)
-  P('<li>name: <b>{}</b></li>', p_res)
-  P('<li>size: {}</li>', SizeExpr(st.st_size))
-  P('<li>date: {}</li>', DateExpr(st.st_mtime))
-  P('</ul>')
-  P('<div class="preview_pane">')
-  PrintPreview(ext, path, url, False)
-  P('</div>')
+  for p_res, path, st in data_files:
+    P('<ul>')
+    P('<li>dir: {}</li>', dir_label)
+    P('<li>name: <b>{}</b></li>', p_res)
+    P('<li>size: {}</li>', SizeExpr(st.st_size))
+    P('<li>date: {}</li>', DateExpr(st.st_mtime))
+    P('</ul>')
+  if len(data_files) == 1:
+    p_res, path, st = data_files[0]
+    url = re.sub(r"/$", "", dir_url) + "/" + urllib.parse.quote(p_res)
+    ext = re.sub(r"^\.", "", os.path.splitext(p_res)[1].lower())
+    P('<div class="preview_pane">')
+    PrintPreview(ext, path, url, False)
+    P('</div>')
   P('</div>')
 
 
@@ -1490,7 +2752,7 @@ def PrintPreviewVideo(url):
 
 
 if __name__=="__main__":
-  main()
+  sys.exit(main())
 
 
 # END OF FILE
@@ -14,49 +14,90 @@
 #--------------------------------------------------------------------------------------------------
 
 
-import cgi
+import bisect
+import collections
+import fcntl
+import hashlib
+import heapq
 import html
+import mmap
 import os
 import re
+import struct
 import sys
+import time
 import urllib
 import urllib.parse
 
+import bbb_text
+import bbb_web
+
 
 HTML_DIR = "."
+TEXT_STORE_DIR = "__text__"
+VERSION_FILE = "__version__.txt"
+FIELD_INDEX_FILE = "__fields__.tsv"
+TERM_DICT_FILE = "__terms__.dat"
+TERM_DICT_MAGIC = b"BBBTRM2\n"
+SUGGEST_PREFIX_LENGTH = 2
+CACHE_DIR = "__srchcache__"
+MAX_CACHE_SIZE = 1024 * 1024 * 16
+MAX_CACHE_ENTRIES = 1024
 MAX_QUERIES = 10
 SNIPPET_WIDTH = 64
 NUM_SNIPPETS_PER_QUERY = 2
+MAX_SUGGESTIONS = 10
+MAX_FORM_SIZE = 1024 * 64
+COMPRESS_OUTPUT = False
+COMPRESS_MIN_SIZE = 1024 * 2
 CHECK_REFERRER = True
 
 
 def main():
-  script_filename = os.environ.get("SCRIPT_FILENAME", "")
-  script_url = os.environ.get("REQUEST_SCHEME", "http") + "://"
-  script_url += os.environ.get("HTTP_HOST", "localhost")
-  script_url += os.environ.get("REQUEST_URI", "/bbb_comment.cgi")
-  script_url = re.sub(r"\?.*", "", script_url)
-  referrer_url = os.environ.get("HTTP_REFERER", "")
+  if len(sys.argv) > 1 and not os.environ.get("GATEWAY_INTERFACE"):
+    return RunCommand(sys.argv[1:])
+  bbb_web.RunCGI(HandleRequest)
+
+
+def HandleRequest(request):
+  script_filename = request.get("SCRIPT_FILENAME")
+  script_url = request.script_url("/bbb_search.cgi")
+  referrer_url = request.header("Referer")
   if script_filename:
     resource_dir = os.path.join(os.path.dirname(script_filename), HTML_DIR)
+    cache_dir = os.path.join(os.path.dirname(script_filename), CACHE_DIR)
   else:
     resource_dir = HTML_DIR
+    cache_dir = CACHE_DIR
   resource_dir = os.path.realpath(resource_dir)
+  if not CACHE_DIR:
+    cache_dir = ""
   if CHECK_REFERRER and referrer_url:
     script_parts = urllib.parse.urlparse(script_url)
     referrer_parts = urllib.parse.urlparse(referrer_url)
     if referrer_parts.netloc != script_parts.netloc:
       PrintError(403, "Forbidden", "bad referrer")
       return
-  form = cgi.FieldStorage()
-  params = {}
-  for key in form.keys():
-    value = form[key]
-    if isinstance(value, list):
-      params[key] = value[0].value
-    else:
-      params[key] = value.value
-  DoSearch(resource_dir, params)
+  params = bbb_web.ReadFormParams(request, MAX_FORM_SIZE)
+  if params is None:
+    PrintError(400, "Bad Request", "invalid form data")
+    return
+  action = params.get("action") or ""
+  if action == "suggest":
+    DoSuggest(resource_dir, params)
+    return
+  DoSearch(resource_dir, cache_dir, params, request)
+
+
+def application(environ, start_response):
+  return bbb_web.RunApplication(HandleRequest, environ, start_response)
+
+
+def RunCommand(args):
+  if args[0] == "--serve" and len(args) in (2, 3):
+    return bbb_web.RunServer(args[1], args[2] if len(args) > 2 else ".", application)
+  print("usage: bbb_search.cgi --serve [host:]port [base_dir]", file=sys.stderr)
+  return 1
 
 
 def PrintError(code, name, message):
@@ -93,38 +134,49 @@ def ParseQuery(query):
 
 def ReadXHTML(path):
   meta = {}
-  texts = []
   with open(path) as input_file:
-    in_article = False
-    for line in input_file:
-      line = line.strip()
-      match = re.search(r'<meta .*name="(.*?)".*content="(.*?)".*/>', line)
-      if match:
-        meta_name = html.unescape(match.group(1).strip())
-        meta_value = html.unescape(match.group(2).strip())
-        if meta_name and meta_value:
-          meta[meta_name] = meta_value
-      if re.search(r'<article([\W]|>)', line):
-        in_article = True
-        continue
-      if re.search(r'</article>', line):
-        in_article = False
-        continue
-      if in_article:
-        text = line
-        if re.search('^<h2 .*class="article_title".*>.*</h2>', text): continue
-        if re.search('^<div .*class="article_date".*>.*</div>', text): continue
-        if re.search('^<li .*class="site_toc_item".*>.*</li>', text): continue
-        if re.search('^<dt .*class="site_tags_name".*>.*</dt>', text): continue
-        if re.search('^<a .*class="site_tags_link".*>.*</a>', text): continue
-        text = re.sub(r"<(br)/>", " ", text)
-        text = re.sub(r"</(p|div|td)>", " ", text)
-        text = re.sub(r"<[^>]*?>", "", text)
-        text = html.unescape(text)
-        text = re.sub(r"\s+", " ", text).strip()
-        if text:
-          texts.append(text)
-  return (meta, texts)
+    lines = input_file.readlines()
+  for line in lines:
+    match = re.search(r'<meta .*name="(.*?)".*content="(.*?)".*/>', line)
+    if match:
+      meta_name = html.unescape(match.group(1).strip())
+      meta_value = html.unescape(match.group(2).strip())
+      if meta_name and meta_value:
+        meta[meta_name] = meta_value
+  return (meta, bbb_text.ExtractSearchTexts(lines))
+
+
+def ReadTextStore(path):
+  fields, texts, offsets, widths = bbb_text.ReadTextStore(path)
+  meta = {"generator": "BikiBikiBob"}
+  for name, value in fields.items():
+    if value:
+      meta["x-bbb-" + name] = value
+  return (meta, texts, offsets, widths)
+
+
+def ReadDocument(resource_dir, name):
+  path = os.path.join(resource_dir, name)
+  store_path = os.path.join(resource_dir, TEXT_STORE_DIR, re.sub(r"\.xhtml$", ".bbt", name))
+  try:
+    if os.stat(store_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+      return ReadTextStore(store_path)
+  except Exception:
+    pass
+  meta, texts = ReadXHTML(path)
+  offsets, widths = bbb_text.MakeWidthIndex(texts)
+  return (meta, texts, offsets, widths)
+
+
+def CutSnippetSpan(widths, text_start, text_end, start, end):
+  limit = SNIPPET_WIDTH * 2
+  start += text_start
+  end += text_start
+  start_pos = bisect.bisect_right(widths, widths[start] - limit, text_start, start + 1) - 1
+  start_pos = max(start_pos, text_start)
+  end_pos = bisect.bisect_left(widths, widths[end] + limit, end, text_end + 1)
+  end_pos = min(end_pos, text_end)
+  return (start_pos - text_start, end_pos - text_start)
 
 
 def SegmentWeight(text, query):
@@ -147,30 +199,203 @@ def ParseMisc(misc):
   return tags
 
 
-def DoSearch(resource_dir, params):
+def ReadIndexVersion(resource_dir):
+  try:
+    with open(os.path.join(resource_dir, VERSION_FILE)) as input_file:
+      version = input_file.read().strip()
+      if version:
+        return version
+  except Exception:
+    pass
+  return str(os.stat(resource_dir).st_mtime_ns)
+
+
+def GetCachePath(cache_dir, version, key):
+  version_hash = hashlib.md5(version.encode()).hexdigest()[:8]
+  key_hash = hashlib.md5(key.encode()).hexdigest()
+  return os.path.join(cache_dir, version_hash + "-" + key_hash + ".txt")
+
+
+def ReadSearchCache(cache_dir, version, key):
+  path = GetCachePath(cache_dir, version, key)
+  try:
+    with open(path) as input_file:
+      if input_file.readline() != key + "\n":
+        return None
+      body = input_file.read()
+    os.utime(path)
+  except Exception:
+    return None
+  return body
+
+
+def WriteSearchCache(cache_dir, version, key, body):
+  path = GetCachePath(cache_dir, version, key)
+  tmp_path = os.path.join(cache_dir, ".{}.{}.tmp".format(os.path.basename(path), os.getpid()))
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(tmp_path, "w") as output_file:
+      output_file.write(key + "\n")
+      output_file.write(body)
+    os.replace(tmp_path, path)
+  except Exception:
+    return False
+  try:
+    fd = os.open(os.path.join(cache_dir, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+  except Exception:
+    return True
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    version_prefix = os.path.basename(path)[:9]
+    now = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+      entry_path = os.path.join(cache_dir, name)
+      try:
+        st = os.stat(entry_path)
+      except Exception:
+        continue
+      if name.startswith("."):
+        if name.endswith(".tmp") and st.st_mtime < now - 60:
+          os.remove(entry_path)
+        continue
+      if not name.startswith(version_prefix):
+        os.remove(entry_path)
+        continue
+      entries.append((st.st_mtime, entry_path, st.st_size))
+    entries.sort()
+    total_size = sum([x[2] for x in entries])
+    while entries and (len(entries) > MAX_CACHE_ENTRIES or total_size > MAX_CACHE_SIZE):
+      mtime, entry_path, size = entries.pop(0)
+      os.remove(entry_path)
+      total_size -= size
+  except Exception:
+    pass
+  finally:
+    os.close(fd)
+  return True
+
+
+def ParseDateBound(expr):
+  expr = expr.strip()
+  if not expr:
+    return ""
+  match = re.fullmatch(r"(\d{4})(?:[-/.](\d{1,2})(?:[-/.](\d{1,2}))?)?", expr)
+  if not match:
+    return None
+  bound = match.group(1)
+  for part in match.groups()[1:]:
+    if part:
+      bound += "/{:02d}".format(int(part))
+  return bound
+
+
+def ReadFieldIndex(path):
+  docs = []
+  postings = {}
+  with open(path) as input_file:
+    for line in input_file:
+      fields = line.rstrip("\n").split("\t")
+      if len(fields) != 3: continue
+      if fields[0] == "doc":
+        docs.append((fields[2], fields[1]))
+      elif fields[0] in ["tag", "misc"]:
+        postings[(fields[0], fields[1])] = [int(x) for x in fields[2].split(",") if x]
+  return (docs, postings)
+
+
+def SelectCandidates(resource_dir, filters):
+  try:
+    docs, postings = ReadFieldIndex(os.path.join(resource_dir, FIELD_INDEX_FILE))
+  except Exception:
+    return None
+  doc_ids = None
+  if filters["from"] or filters["to"]:
+    dates = [x[0] for x in docs]
+    start = bisect.bisect_right(dates, "")
+    if filters["from"]:
+      start = max(start, bisect.bisect_left(dates, filters["from"]))
+    end = len(dates)
+    if filters["to"]:
+      end = bisect.bisect_right(dates, filters["to"] + "~")
+    doc_ids = set(range(start, end))
+  for label, names in [("tag", filters["tags"]), ("misc", filters["misc"])]:
+    for name in names:
+      posting = set(postings.get((label, name)) or [])
+      doc_ids = posting if doc_ids is None else doc_ids & posting
+  if doc_ids is None:
+    return None
+  return [docs[x][1] + ".xhtml" for x in sorted(doc_ids)]
+
+
+def CheckFilters(filters, date, tags, misc):
+  if filters["from"] and (not date or date < filters["from"]): return False
+  if filters["to"] and (not date or date[:len(filters["to"])] > filters["to"]): return False
+  for tag in filters["tags"]:
+    if tag not in tags: return False
+  for flag in filters["misc"]:
+    if flag not in misc: return False
+  return True
+
+
+def DoSearch(resource_dir, cache_dir, params, request):
   p_query = (params.get("query") or "").strip()
   p_order = (params.get("order") or "").strip()
   p_max = TextToInt(params.get("max") or "0")
+  p_facet = (params.get("facet") or "").strip()
+  filters = {
+    "tags": ParseMisc(params.get("tag") or ""),
+    "misc": ParseMisc(params.get("misc") or ""),
+    "from": ParseDateBound(params.get("from") or ""),
+    "to": ParseDateBound(params.get("to") or ""),
+  }
+  if filters["from"] is None or filters["to"] is None:
+    PrintError(400, "Bad Request", "bad date range")
+    return
+  has_filters = filters["tags"] or filters["misc"] or filters["from"] or filters["to"]
   queries = ParseQuery(p_query)
-  if not queries:
+  if not queries and not has_filters:
     PrintError(400, "Bad Request", "no query")
     return
+  body = None
+  if cache_dir:
+    version = ReadIndexVersion(resource_dir)
+    cache_fields = [version, p_order, str(p_max), p_facet]
+    for name in ["tags", "misc", "from", "to"]:
+      value = filters[name]
+      cache_fields.append(",".join(value) if isinstance(value, list) else value)
+    cache_key = "\t".join(cache_fields + [x[0] for x in queries])
+    body = ReadSearchCache(cache_dir, version, cache_key)
+  if body is None:
+    body = SearchDocuments(resource_dir, queries, filters, p_order, p_max, p_facet)
+    if cache_dir:
+      WriteSearchCache(cache_dir, version, cache_key, body)
   print("Content-Type: text/plain; charset=UTF-8")
-  print("")
+  with bbb_web.CompressOutput(request, COMPRESS_OUTPUT, COMPRESS_MIN_SIZE):
+    print(body, end="")
+
+
+def SearchDocuments(resource_dir, queries, filters, p_order, p_max, p_facet):
+  names = None
+  if filters["tags"] or filters["misc"] or filters["from"] or filters["to"]:
+    names = SelectCandidates(resource_dir, filters)
+  if names is None:
+    names = os.listdir(resource_dir)
   docs = []
-  for name in os.listdir(resource_dir):
+  for name in names:
     if not name.endswith(".xhtml"): continue
-    path = os.path.join(resource_dir, name)
     try:
-      meta, texts = ReadXHTML(path)
+      meta, texts, offsets, widths = ReadDocument(resource_dir, name)
     except Exception:
       continue
     if meta.get("generator") != "BikiBikiBob": continue
     stem = re.sub(r"\.xhtml$", "", name)
     title = meta.get("x-bbb-title") or ""
     date = meta.get("x-bbb-date") or ""
+    tags = ParseMisc(meta.get("x-bbb-tags") or "")
     misc = ParseMisc(meta.get("x-bbb-misc") or "")
     if "nosearch" in misc: continue
+    if not CheckFilters(filters, date, tags, misc): continue
     hit_queries = set()
     snippets = []
     score = 0.0
@@ -193,28 +418,8 @@ def DoSearch(resource_dir, params):
         if match:
           hit_queries.add(query)
           span = match.span()
-          start_pos = span[0]
-          width = float(SNIPPET_WIDTH)
-          while start_pos > 0 and width > 0:
-            start_pos -= 1
-            cp = ord(text[start_pos])
-            if cp < 0x0200:
-              width -= 1.0
-            elif cp < 0x03000:
-              width -= 1.5
-            else:
-              width -= 2.0
-          end_pos = span[1]
-          width = float(SNIPPET_WIDTH)
-          while end_pos < len(text) and width > 0:
-            end_pos += 1
-            cp = ord(text[end_pos-1])
-            if cp < 0x0200:
-              width -= 1.0
-            elif cp < 0x03000:
-              width -= 1.5
-            else:
-              width -= 2.0
+          start_pos, end_pos = CutSnippetSpan(
+            widths, offsets[text_index], offsets[text_index + 1], span[0], span[1])
           segment = text[start_pos:end_pos]
           snippet = ""
           if start_pos > 0:
@@ -272,6 +477,7 @@ def DoSearch(resource_dir, params):
       "name": stem,
       "title": title,
       "date": date,
+      "tags": tags,
       "snippets": chosen_snippets,
       "score": score,
     }
@@ -290,7 +496,13 @@ def DoSearch(resource_dir, params):
     docs = sorted(docs, key=lambda x: (x["date"], x["name"]), reverse=True)
   else:
     docs = sorted(docs, key=lambda x: (-x["score"], x["name"]))
-  print("{}".format(len(docs)))
+  tag_counts = collections.defaultdict(int)
+  if p_facet == "tag":
+    for doc in docs:
+      for tag in doc["tags"]:
+        tag_counts[tag] += 1
+  lines = []
+  lines.append("{}".format(len(docs)))
   if p_max > 0 and len(docs) > p_max:
     docs = docs[:p_max]
   for doc in docs:
@@ -301,11 +513,84 @@ def DoSearch(resource_dir, params):
     fields.append(doc["date"])
     for snippet in doc["snippets"]:
       fields.append(snippet)
-    print("\t".join(fields))
+    lines.append("\t".join(fields))
+  for tag, count in sorted(tag_counts.items(), key=lambda x: (-x[1], x[0])):
+    lines.append("@tag\t{}\t{:d}".format(tag, count))
+  return "".join([x + "\n" for x in lines])
+
+
+# Short prefixes are looked up in the table of precomputed completions.  Records of the range
+# of a longer prefix are ranked by kind and frequency with a bounded heap.  A display appears at
+# most once per kind so that keeping three times the requested number is enough.
+def SearchTermDictionary(path, prefix, max_records):
+  kind_ranks = {"tag": 0, "title": 1}
+  with open(path, "rb") as input_file:
+    with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      if mm[:len(TERM_DICT_MAGIC)] != TERM_DICT_MAGIC:
+        raise ValueError("bad term dictionary")
+      pos = len(TERM_DICT_MAGIC)
+      num_records, num_tops = struct.unpack_from("<II", mm, pos)
+      pos += 8
+      top_pos = pos + (num_records + 1) * 4
+      base = top_pos + (num_tops + 1) * 4
+      top_base = base + struct.unpack_from("<I", mm, pos + num_records * 4)[0]
+      def GetRecord(table_pos, table_base, index):
+        start, end = struct.unpack_from("<II", mm, table_pos + index * 4)
+        return mm[table_base + start:table_base + end]
+      def BisectRecords(table_pos, table_base, num_table_records, key):
+        low = 0
+        high = num_table_records
+        while low < high:
+          middle = (low + high) // 2
+          if GetRecord(table_pos, table_base, middle).split(b"\t", 1)[0] < key:
+            low = middle + 1
+          else:
+            high = middle
+        return low
+      def ScanRecords(table_pos, table_base, num_table_records, key, exact):
+        index = BisectRecords(table_pos, table_base, num_table_records, key)
+        while index < num_table_records:
+          record = GetRecord(table_pos, table_base, index)
+          index += 1
+          if exact:
+            if record.split(b"\t", 1)[0] != key: break
+          elif not record.startswith(key): break
+          fields = record.decode().rstrip("\n").split("\t")
+          if len(fields) != 4: continue
+          yield (fields[3], fields[2], int(fields[1]))
+      key = prefix.encode()
+      if len(prefix) <= SUGGEST_PREFIX_LENGTH:
+        return list(ScanRecords(top_pos, top_base, num_tops, key, True))[:max_records]
+      records = heapq.nsmallest(max_records * 3, ScanRecords(pos, base, num_records, key, False),
+                                key=lambda x: (kind_ranks.get(x[1], 2), -x[2], x[0]))
+  return records
+
+
+def DoSuggest(resource_dir, params):
+  p_prefix = (params.get("prefix") or "").lower()
+  p_prefix = re.sub(r"\s+", " ", p_prefix).lstrip()[:256]
+  p_max = TextToInt(params.get("max") or "0")
+  if not p_prefix:
+    PrintError(400, "Bad Request", "no prefix")
+    return
+  if p_max < 1 or p_max > MAX_SUGGESTIONS:
+    p_max = MAX_SUGGESTIONS
+  try:
+    records = SearchTermDictionary(os.path.join(resource_dir, TERM_DICT_FILE), p_prefix, p_max)
+  except Exception:
+    records = []
+  print("Content-Type: text/plain; charset=UTF-8")
+  print("")
+  displays = set()
+  for display, kind, count in records:
+    if len(displays) >= p_max: break
+    if display in displays: continue
+    displays.add(display)
+    print("{}\t{}\t{:d}".format(display, kind, count))
 
 
 if __name__=="__main__":
-  main()
+  sys.exit(main())
 
 
 # END OF FILE
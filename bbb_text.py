@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Search text extraction and text store shared by the generator and the search script
+#
+# Copyright 2024 Mikio Hirabayashi
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain a copy of the License at
+#     https://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the
+# License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.  See the License for the specific language governing permissions
+# and limitations under the License.
+#--------------------------------------------------------------------------------------------------
+
+
+import array
+import html
+import re
+import struct
+import sys
+
+
+TEXT_STORE_MAGIC = b"BBBTXT1\n"
+TEXT_STORE_FIELDS = ["title", "date", "tags", "misc"]
+
+
+def ExtractSearchTexts(lines):
+  texts = []
+  in_article = False
+  for line in lines:
+    line = line.strip()
+    if re.search(r'<article([\W]|>)', line):
+      in_article = True
+      continue
+    if re.search(r'</article>', line):
+      in_article = False
+      continue
+    if not in_article: continue
+    text = line
+    if re.search('^<h2 .*class="article_title".*>.*</h2>', text): continue
+    if re.search('^<div .*class="article_date".*>.*</div>', text): continue
+    if re.search('^<li .*class="site_toc_item".*>.*</li>', text): continue
+    if re.search('^<dt .*class="site_tags_name".*>.*</dt>', text): continue
+    if re.search('^<a .*class="site_tags_link".*>.*</a>', text): continue
+    text = re.sub(r"<(br)/>", " ", text)
+    text = re.sub(r"</(p|div|td)>", " ", text)
+    text = re.sub(r"<[^>]*?>", "", text)
+    text = html.unescape(text)
+    text = re.sub(r"\s+", " ", text).strip()
+    if text:
+      texts.append(text)
+  return texts
+
+
+# The prefix sums of display widths are in half-width units.
+def MakeWidthIndex(texts):
+  offsets = array.array("I", [0])
+  widths = array.array("I", [0])
+  width = 0
+  for text in texts:
+    for c in text:
+      cp = ord(c)
+      if cp < 0x0200:
+        width += 2
+      elif cp < 0x3000:
+        width += 3
+      else:
+        width += 4
+      widths.append(width)
+    offsets.append(offsets[-1] + len(text))
+  return (offsets, widths)
+
+
+# The text store keeps the searchable texts of an article as UTF-32 so that spans are sliced
+# by character offsets.  The width index is stored as well to cut snippets without rescanning.
+def WriteTextStore(output_file, fields, texts):
+  meta = "\t".join(fields).encode()
+  meta += b"\0" * (-len(meta) % 4)
+  offsets, widths = MakeWidthIndex(texts)
+  if sys.byteorder != "little":
+    offsets.byteswap()
+    widths.byteswap()
+  output_file.write(TEXT_STORE_MAGIC)
+  output_file.write(struct.pack("<III", len(meta), len(texts), len(widths) - 1))
+  output_file.write(meta)
+  output_file.write(offsets.tobytes())
+  output_file.write(widths.tobytes())
+  output_file.write("".join(texts).encode("utf-32-le"))
+
+
+def ReadTextStore(path, with_texts=True, with_widths=True):
+  with open(path, "rb") as input_file:
+    if input_file.read(len(TEXT_STORE_MAGIC)) != TEXT_STORE_MAGIC:
+      raise ValueError("bad text store: " + path)
+    meta_size, num_texts, num_chars = struct.unpack("<III", input_file.read(12))
+    fields = input_file.read(meta_size).rstrip(b"\0").decode().split("\t")
+    meta = {}
+    for name, value in zip(TEXT_STORE_FIELDS, fields):
+      meta[name] = value
+    if not with_texts:
+      return (meta, None, None, None)
+    offsets = array.array("I", input_file.read((num_texts + 1) * 4))
+    widths = None
+    if with_widths:
+      widths = array.array("I", input_file.read((num_chars + 1) * 4))
+    else:
+      input_file.seek((num_chars + 1) * 4, 1)
+    body = input_file.read(num_chars * 4).decode("utf-32-le")
+  if len(offsets) != num_texts + 1 or len(body) != num_chars:
+    raise ValueError("truncated text store: " + path)
+  if sys.byteorder != "little":
+    offsets.byteswap()
+    if widths:
+      widths.byteswap()
+  texts = []
+  for i in range(num_texts):
+    texts.append(body[offsets[i]:offsets[i + 1]])
+  return (meta, texts, offsets, widths)
+
+
+# END OF FILE
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Request and response layer shared by the CGI scripts
+#
+# Copyright 2024 Mikio Hirabayashi
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License.  You may obtain a copy of the License at
+#     https://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the
+# License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied.  See the License for the specific language governing permissions
+# and limitations under the License.
+#--------------------------------------------------------------------------------------------------
+
+
+import contextlib
+import http
+import io
+import os
+import re
+import socketserver
+import sys
+import threading
+import urllib
+import urllib.parse
+import wsgiref.simple_server
+import zlib
+
+
+MAX_PART_HEADER_SIZE = 1024 * 8
+READ_BLOCK_SIZE = 1024 * 64
+SEND_BLOCK_SIZE = 1024 * 1024
+COMPRESS_LEVEL = 6
+output_lock = threading.Lock()
+
+
+class FormParams(dict):
+  def __init__(self):
+    super().__init__()
+    self.lists = {}
+
+  def add(self, key, value):
+    self.setdefault(key, value)
+    self.lists.setdefault(key, []).append(value)
+
+  def getlist(self, key):
+    return self.lists.get(key, [])
+
+
+class Request:
+  def __init__(self, environ, input_file=None):
+    self.environ = environ
+    self.input = input_file if input_file is not None else environ.get("wsgi.input")
+    self.method = environ.get("REQUEST_METHOD", "GET").upper()
+
+  def get(self, name, default=""):
+    return self.environ.get(name, default)
+
+  def header(self, name, default=""):
+    key = name.upper().replace("-", "_")
+    if key not in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
+      key = "HTTP_" + key
+    return self.environ.get(key, default)
+
+  def content_length(self):
+    try:
+      return max(int(self.environ.get("CONTENT_LENGTH", "") or 0), 0)
+    except ValueError:
+      return 0
+
+  def script_url(self, default_path):
+    scheme = self.environ.get("REQUEST_SCHEME") or self.environ.get("wsgi.url_scheme", "http")
+    host = self.environ.get("HTTP_HOST", "localhost")
+    path = self.environ.get("REQUEST_URI", "")
+    if not path:
+      path = self.environ.get("SCRIPT_NAME", "") + self.environ.get("PATH_INFO", "")
+    return re.sub(r"\?.*", "", scheme + "://" + host + (path or default_path))
+
+
+def ReadFormParams(request, max_form_size, uploads=None, upload_dir=None,
+                   max_file_size=0, max_files=0):
+  params = FormParams()
+  query = request.get("QUERY_STRING")
+  for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+    params.add(key, value)
+  if request.method != "POST":
+    return params
+  content_type = request.get("CONTENT_TYPE")
+  content_length = request.content_length()
+  if re.search(r"^application/octet-stream", content_type, re.IGNORECASE):
+    return params
+  if re.search(r"^multipart/form-data", content_type, re.IGNORECASE):
+    match = re.search(r'boundary="?([^";,]+)"?', content_type)
+    if not match:
+      return None
+    boundary = match.group(1).encode()
+    if not ReadMultipartParams(request.input, content_length, boundary, params, max_form_size,
+                               uploads, upload_dir, max_file_size, max_files):
+      return None
+    return params
+  if content_length > max_form_size:
+    return None
+  body = request.input.read(content_length).decode("UTF-8", "replace")
+  for key, value in urllib.parse.parse_qsl(body, keep_blank_values=True):
+    params.add(key, value)
+  return params
+
+
+def ReadMultipartParams(input_file, content_length, boundary, params, max_form_size,
+                        uploads, upload_dir, max_file_size, max_files):
+  delimiter = b"\r\n--" + boundary
+  state = {"buf": b"\r\n", "remaining": content_length}
+  def Fill():
+    if state["remaining"] <= 0:
+      return False
+    data = input_file.read(min(state["remaining"], READ_BLOCK_SIZE))
+    if not data:
+      state["remaining"] = 0
+      return False
+    state["remaining"] -= len(data)
+    state["buf"] += data
+    return True
+  def SkipTo(pattern, max_size):
+    while True:
+      index = state["buf"].find(pattern)
+      if index >= 0:
+        data = state["buf"][:index]
+        state["buf"] = state["buf"][index+len(pattern):]
+        return data
+      if len(state["buf"]) > max_size + len(pattern) or not Fill():
+        return None
+  if SkipTo(delimiter, MAX_PART_HEADER_SIZE) is None:
+    return False
+  form_size = 0
+  while True:
+    while len(state["buf"]) < 2:
+      if not Fill(): return False
+    if state["buf"].startswith(b"--"):
+      return True
+    if SkipTo(b"\r\n", MAX_PART_HEADER_SIZE) is None:
+      return False
+    while len(state["buf"]) < 2:
+      if not Fill(): return False
+    if state["buf"].startswith(b"\r\n"):
+      state["buf"] = state["buf"][2:]
+      header = b""
+    else:
+      header = SkipTo(b"\r\n\r\n", MAX_PART_HEADER_SIZE)
+      if header is None:
+        return False
+    header = header.decode("UTF-8", "replace")
+    match = re.search(r'(?:^|;)\s*name="([^"]*)"', header, re.IGNORECASE | re.MULTILINE)
+    name = match.group(1) if match else ""
+    match = re.search(r'(?:^|;)\s*filename="([^"]*)"', header, re.IGNORECASE | re.MULTILINE)
+    filename = match.group(1) if match else None
+    upload = None
+    output_fd = -1
+    value = []
+    if filename and uploads is not None:
+      upload = {"filename": filename, "path": "", "size": 0, "error": ""}
+      name_uploads = uploads.setdefault(name, [])
+      name_uploads.append(upload)
+      dir_path, error = upload_dir(params) if upload_dir else (None, "no upload directory")
+      if max_files > 0 and len(name_uploads) > max_files:
+        upload["error"] = "too many files"
+      elif error:
+        upload["error"] = error
+      else:
+        upload["path"] = os.path.join(dir_path, ".upload-{}.tmp".format(os.urandom(8).hex()))
+        try:
+          output_fd = os.open(upload["path"], os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except Exception as e:
+          upload["path"] = ""
+          upload["error"] = str(e)
+    try:
+      while True:
+        index = state["buf"].find(delimiter)
+        if index >= 0:
+          data = state["buf"][:index]
+          state["buf"] = state["buf"][index+len(delimiter):]
+        else:
+          safe_size = max(len(state["buf"]) - len(delimiter) + 1, 0)
+          data = state["buf"][:safe_size]
+          state["buf"] = state["buf"][safe_size:]
+        if upload:
+          upload["size"] += len(data)
+          if max_file_size > 0 and upload["size"] > max_file_size and not upload["error"]:
+            upload["error"] = "too large file"
+          if output_fd >= 0 and not upload["error"]:
+            while data:
+              data = data[os.write(output_fd, data):]
+        elif filename is None:
+          form_size += len(data)
+          if form_size > max_form_size:
+            return False
+          value.append(data)
+        if index >= 0:
+          break
+        if not Fill():
+          return False
+    finally:
+      if output_fd >= 0:
+        os.close(output_fd)
+    if upload and upload["error"] and upload["path"]:
+      os.remove(upload["path"])
+      upload["path"] = ""
+    if filename is None:
+      params.add(name, b"".join(value).decode("UTF-8", "replace"))
+
+
+class Response:
+  def __init__(self):
+    self.data = io.BytesIO()
+    self.file = None
+
+  def write(self, data):
+    if isinstance(data, str):
+      self.data.write(data.encode("UTF-8"))
+    else:
+      self.data.write(data)
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def send_file(self, input_file, start, end):
+    self.file = (os.fdopen(os.dup(input_file.fileno()), "rb"), start, end)
+
+
+class RequestOutput:
+  def __init__(self, stream):
+    self.stream = stream
+    self.local = threading.local()
+
+  def write(self, text):
+    return (getattr(self.local, "response", None) or self.stream).write(text)
+
+  def flush(self):
+    (getattr(self.local, "response", None) or self.stream).flush()
+
+  def fileno(self):
+    if getattr(self.local, "response", None):
+      raise io.UnsupportedOperation("fileno")
+    return self.stream.fileno()
+
+  @property
+  def buffer(self):
+    return getattr(self.local, "response", None) or self.stream.buffer
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+
+def CurrentResponse():
+  if isinstance(sys.stdout, RequestOutput):
+    return getattr(sys.stdout.local, "response", None)
+  return None
+
+
+def RunCGI(handler):
+  if not isinstance(sys.stdout, RequestOutput):
+    sys.stdout = RequestOutput(sys.stdout)
+  return handler(Request(os.environ, sys.stdin.buffer))
+
+
+def AcceptsGzip(request):
+  qualities = {}
+  for item in request.header("Accept-Encoding").split(","):
+    coding, sep, attrs = item.partition(";")
+    match = re.search(r"q\s*=\s*([0-9.]+)", attrs)
+    try:
+      quality = float(match.group(1)) if match else 1.0
+    except ValueError:
+      quality = 0.0
+    qualities[coding.strip().lower()] = quality
+  quality = qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0)))
+  return quality > 0
+
+
+class CompressedOutput:
+  def __init__(self, output, min_size):
+    self.output = output
+    self.min_size = min_size
+    self.pending = []
+    self.pending_size = 0
+    self.compressor = None
+
+  def write(self, data):
+    size = len(data)
+    if isinstance(data, str):
+      data = data.encode("UTF-8")
+    if self.compressor:
+      self.output.write(self.compressor.compress(data))
+    else:
+      self.pending.append(data)
+      self.pending_size += len(data)
+      if self.pending_size >= self.min_size:
+        self.start()
+    return size
+
+  def flush(self):
+    pass
+
+  @property
+  def buffer(self):
+    return self
+
+  def start(self):
+    self.output.write(b"Content-Encoding: gzip\n\n")
+    self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for data in self.pending:
+      self.output.write(self.compressor.compress(data))
+    self.pending = []
+
+  def close(self):
+    if self.compressor:
+      self.output.write(self.compressor.flush())
+    else:
+      self.output.write(b"\n")
+      for data in self.pending:
+        self.output.write(data)
+    self.output.flush()
+
+
+@contextlib.contextmanager
+def CompressOutput(request, enabled, min_size):
+  if enabled:
+    print("Vary: Accept-Encoding")
+  output = sys.stdout
+  if not enabled or not AcceptsGzip(request) or not isinstance(output, RequestOutput):
+    print("")
+    yield
+    return
+  output.flush()
+  previous = getattr(output.local, "response", None)
+  compressed = CompressedOutput(previous or output.stream.buffer, min_size)
+  output.local.response = compressed
+  try:
+    yield
+  finally:
+    output.local.response = previous
+    compressed.close()
+
+
+def RunApplication(handler, environ, start_response):
+  with output_lock:
+    if not isinstance(sys.stdout, RequestOutput):
+      sys.stdout = RequestOutput(sys.stdout)
+  response = Response()
+  sys.stdout.local.response = response
+  try:
+    handler(Request(environ))
+  finally:
+    sys.stdout.local.response = None
+  head, sep, body = response.data.getvalue().partition(b"\n\n")
+  status = "200 OK"
+  headers = []
+  for line in head.decode("UTF-8", "replace").split("\n"):
+    name, sep, value = line.partition(":")
+    if not sep: continue
+    if name.strip().lower() == "status":
+      status = value.strip()
+    else:
+      headers.append((name.strip(), value.strip()))
+  if re.search(r"^\d+$", status):
+    status = "{} {}".format(status, http.HTTPStatus(int(status)).phrase)
+  if response.file:
+    start_response(status, headers)
+    return FileBody(body, *response.file)
+  if "content-length" not in [x[0].lower() for x in headers]:
+    headers.append(("Content-Length", str(len(body))))
+  start_response(status, headers)
+  return [body]
+
+
+class FileBody:
+  def __init__(self, body, input_file, start, end):
+    self.body = body
+    self.input_file = input_file
+    self.start = start
+    self.end = end
+
+  def __iter__(self):
+    if self.body:
+      yield self.body
+    offset = self.start
+    self.input_file.seek(offset)
+    while offset < self.end:
+      buf = self.input_file.read(min(self.end - offset, SEND_BLOCK_SIZE))
+      if not buf: break
+      offset += len(buf)
+      yield buf
+
+  def close(self):
+    self.input_file.close()
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+
+
+def RunServer(address, base_dir, application):
+  host, sep, port = address.rpartition(":")
+  os.chdir(base_dir)
+  server = wsgiref.simple_server.make_server(
+    host or "127.0.0.1", int(port), application, server_class=ThreadingWSGIServer)
+  print("Serving on {}:{} for {}".format(host or "127.0.0.1", port, os.getcwd()),
+        file=sys.stderr)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+# END OF FILE
@@ -4,6 +4,7 @@ function main() {
   adjust_images();
   adjust_columns();
   check_comments();
+  check_site_toc_comments();
   render_comment_history();
 }
 
@@ -98,6 +99,7 @@ function update_tag_result(result_pane, resources) {
     tag_result_item.textContent = resource.title.length > 0 ?
       resource.title : resource.name;
     tag_result_item.href = "./" + encodeURI(resource.name) + ".xhtml";
+    tag_result_item.dataset.resource = resource.name;
     if (resource.is_self) {
       tag_result_item.classList.add("tags_result_item_self");
     } else {
@@ -105,6 +107,11 @@ function update_tag_result(result_pane, resources) {
     }
     result_pane.insertBefore(tag_result_item, null);
   }
+  const comment_url = result_pane.dataset.commentUrl;
+  if (comment_url) {
+    fetch_comment_counts(comment_url, result_pane.dataset.commentCountUrl,
+                         result_pane.getElementsByClassName("tags_result_item"));
+  }
 }
 
 function unescape_text(text) {
@@ -119,11 +126,17 @@ function check_comments() {
   const comment_url = area.dataset.commentUrl;
   const resource = area.dataset.resource;
   if (!comment_url || !resource) return;
+  const comment_count_url = area.dataset.commentCountUrl;
+  if (comment_count_url) {
+    check_comments_by_snapshot(comment_count_url, resource);
+    return;
+  }
   const request_url = comment_url + "?action=count-comments&resource=" + encodeURI(resource);
   const xhr = new XMLHttpRequest();
   xhr.onload = function() {
-    if (xhr.status == 200) {
-      const lines = xhr.responseText.split("\n");
+    const response_text = get_validated_response(xhr, request_url);
+    if (response_text != null) {
+      const lines = response_text.split("\n");
       if (lines.length >= 2) {
         const count = parseInt(lines[0]);
         const date = parseInt(lines[1]);
@@ -134,11 +147,126 @@ function check_comments() {
   xhr.onerror = function() {
     alert('networking error while counting comments');
   };
+  open_validated_request(xhr, request_url);
+  xhr.send();
+}
+
+function open_validated_request(xhr, request_url) {
   xhr.open("GET", request_url, true);
   xhr.setRequestHeader("Cache-Control", "no-cache");
+  try {
+    const cached = JSON.parse(sessionStorage.getItem("bbb:" + request_url));
+    if (cached && cached.etag) {
+      xhr.setRequestHeader("If-None-Match", cached.etag);
+    }
+  } catch (error) {
+  }
+}
+
+function get_validated_response(xhr, request_url) {
+  const key = "bbb:" + request_url;
+  try {
+    if (xhr.status == 304) {
+      const cached = JSON.parse(sessionStorage.getItem(key));
+      return cached ? cached.body : null;
+    }
+    if (xhr.status == 200) {
+      const etag = xhr.getResponseHeader("ETag");
+      if (etag) {
+        sessionStorage.setItem(key, JSON.stringify({etag: etag, body: xhr.responseText}));
+      }
+    }
+  } catch (error) {
+  }
+  return xhr.status == 200 ? xhr.responseText : null;
+}
+
+function check_comments_by_snapshot(comment_count_url, resource) {
+  const xhr = new XMLHttpRequest();
+  xhr.onload = function() {
+    let count = 0;
+    let date = -1;
+    if (xhr.status == 200) {
+      for (const line of xhr.responseText.split("\n")) {
+        const fields = line.split("\t");
+        if (fields.length >= 3 && fields[0] == resource) {
+          count = parseInt(fields[1]);
+          date = parseInt(fields[2]);
+          break;
+        }
+      }
+    }
+    update_comment_banner(count, date);
+  };
+  xhr.onerror = function() {
+    alert('networking error while counting comments');
+  };
+  xhr.open("GET", comment_count_url, true);
+  xhr.setRequestHeader("Cache-Control", "no-cache");
   xhr.send();
 }
 
+function check_site_toc_comments() {
+  for (const area of document.getElementsByClassName("site_toc_area")) {
+    const comment_url = area.dataset.commentUrl;
+    if (!comment_url) continue;
+    fetch_comment_counts(comment_url, area.dataset.commentCountUrl,
+                         area.getElementsByClassName("site_toc_item"));
+  }
+}
+
+function fetch_comment_counts(comment_url, comment_count_url, items) {
+  const item_map = new Map();
+  for (const item of items) {
+    const resource = item.dataset.resource;
+    if (!resource) continue;
+    if (!item_map.has(resource)) {
+      item_map.set(resource, []);
+    }
+    item_map.get(resource).push(item);
+  }
+  if (item_map.size == 0) return;
+  const xhr = new XMLHttpRequest();
+  xhr.onload = function() {
+    if (xhr.status == 200) {
+      for (const line of xhr.responseText.split("\n")) {
+        const fields = line.split("\t");
+        if (fields.length < 3) continue;
+        const count = parseInt(fields[1]);
+        if (count < 1) continue;
+        for (const item of item_map.get(fields[0]) || []) {
+          update_item_comment_count(item, count, parseInt(fields[2]));
+        }
+      }
+    }
+  };
+  xhr.onerror = function() {
+    alert('networking error while counting comments');
+  };
+  if (comment_count_url) {
+    xhr.open("GET", comment_count_url, true);
+    xhr.setRequestHeader("Cache-Control", "no-cache");
+    xhr.send();
+    return;
+  }
+  const resources = Array.from(item_map.keys()).join("\n");
+  const data = "action=batch-count-comments&resources=" + encodeURIComponent(resources);
+  xhr.open("POST", comment_url, true);
+  xhr.setRequestHeader("Content-Type", "application/x-www-form-urlencoded");
+  xhr.send(data);
+}
+
+function update_item_comment_count(item, count, date) {
+  const comment_count = document.createElement("span");
+  comment_count.className = "item_comment_count";
+  comment_count.textContent = "[" + count + "]";
+  const diff = new Date().getTime() / 1000 - date;
+  if (diff < 60 * 60 * 24 * 2) {
+    comment_count.classList.add("comment_recent");
+  }
+  item.insertBefore(comment_count, null);
+}
+
 function update_comment_banner(count, date) {
   const banner = document.getElementById("comment_banner");
   const comment_count = document.createElement("span");
@@ -166,9 +294,10 @@ function render_comments() {
   const request_url = comment_url + "?action=list-comments&resource=" + encodeURI(resource);
   const xhr = new XMLHttpRequest();
   xhr.onload = function() {
-    if (xhr.status == 200) {
+    const response_text = get_validated_response(xhr, request_url);
+    if (response_text != null) {
       const comments = [];
-      for (const line of xhr.responseText.split("\n")) {
+      for (const line of response_text.split("\n")) {
         const fields = line.split("\t");
         if (fields.length != 3) continue;
         const comment = {}
@@ -184,8 +313,7 @@ function render_comments() {
   xhr.onerror = function() {
     alert('networking error while getting comments');
   };
-  xhr.open("GET", request_url, true);
-  xhr.setRequestHeader("Cache-Control", "no-cache");
+  open_validated_request(xhr, request_url);
   xhr.send();
   const author_elem = document.getElementById("comment_author");
   if (author_elem.value.length == 0) {
@@ -351,9 +479,10 @@ function render_comment_history() {
     const request_url = comment_url + "?action=list-history&max=" + max;
     const xhr = new XMLHttpRequest();
     xhr.onload = function() {
-      if (xhr.status == 200) {
+      const response_text = get_validated_response(xhr, request_url);
+      if (response_text != null) {
         const comments = [];
-        const lines = xhr.responseText.split("\n");
+        const lines = response_text.split("\n");
         if (lines.length < 1) {
           return;
         }
@@ -376,8 +505,7 @@ function render_comment_history() {
     xhr.onerror = function() {
       alert('networking error while getting comment history');
     };
-    xhr.open("GET", request_url, true);
-    xhr.setRequestHeader("Cache-Control", "no-cache");
+    open_validated_request(xhr, request_url);
     xhr.send();
   }
 }
@@ -486,6 +614,10 @@ function search_fulltext(elem) {
   if (query.length == 0) {
     return;
   }
+  if (search_area.dataset.searchIndex) {
+    search_static(search_area, query, order, parseInt(max), result_area, perpage);
+    return;
+  }
   const request_url = search_url + "?query=" + encodeURI(query) +
         "&order=" + encodeURI(order) + "&max=" + max;
   const xhr = new XMLHttpRequest();
@@ -525,6 +657,236 @@ function search_fulltext(elem) {
   xhr.send();
 }
 
+function tokenize_static_text(text) {
+  const tokens = [];
+  for (const run of text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || []) {
+    for (const segment of run.match(/[\u3000-\uffff]+|[^\u3000-\uffff]+/gu)) {
+      const code = segment.codePointAt(0);
+      if (code >= 0x3000 && code <= 0xffff) {
+        if (segment.length == 1) {
+          tokens.push(segment);
+        }
+        for (let i = 0; i < segment.length - 1; i++) {
+          tokens.push(segment.substring(i, i + 2));
+        }
+      } else if (Array.from(segment).length <= 32) {
+        tokens.push(segment);
+      }
+    }
+  }
+  return tokens;
+}
+
+function fetch_static_file(url, use_cache) {
+  return fetch(url, {cache: use_cache ? "default" : "no-cache"}).then(function(response) {
+    if (!response.ok) {
+      throw new Error("fetching failed: " + url);
+    }
+    return response.arrayBuffer();
+  }).then(function(buffer) {
+    const bytes = new Uint8Array(buffer);
+    if (bytes.length > 1 && bytes[0] == 0x1f && bytes[1] == 0x8b) {
+      const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("gzip"));
+      return new Response(stream).text();
+    }
+    return new TextDecoder().decode(bytes);
+  });
+}
+
+function load_static_manifest(search_area) {
+  if (search_area.static_manifest) {
+    return search_area.static_manifest;
+  }
+  const index_url = new URL(search_area.dataset.searchIndex, document.location.href);
+  const manifest = {docs: [], shards: [], shard_cache: {}};
+  search_area.static_manifest = fetch_static_file(index_url, false).then(function(text) {
+    let docs_url = null;
+    for (const line of text.split("\n")) {
+      const fields = line.split("\t");
+      if (fields.length < 3) continue;
+      if (fields[0] == "docs") {
+        docs_url = new URL(fields[1], index_url);
+      } else if (fields[0] == "shard") {
+        manifest.shards.push({url: new URL(fields[1], index_url), first_term: fields[2]});
+      }
+    }
+    return fetch_static_file(docs_url, true);
+  }).then(function(text) {
+    for (const line of text.split("\n")) {
+      const fields = line.split("\t");
+      if (fields.length < 3) continue;
+      manifest.docs.push({name: fields[0], title: fields[1], date: fields[2]});
+    }
+    return manifest;
+  });
+  search_area.static_manifest.catch(function() {
+    search_area.static_manifest = null;
+  });
+  return search_area.static_manifest;
+}
+
+function load_static_postings(manifest, term) {
+  let low = 0;
+  let high = manifest.shards.length;
+  while (low < high) {
+    const middle = Math.floor((low + high) / 2);
+    if (manifest.shards[middle].first_term <= term) {
+      low = middle + 1;
+    } else {
+      high = middle;
+    }
+  }
+  const shard_index = low - 1;
+  if (shard_index < 0) {
+    return Promise.resolve(null);
+  }
+  if (!manifest.shard_cache[shard_index]) {
+    const shard_url = manifest.shards[shard_index].url;
+    manifest.shard_cache[shard_index] = fetch_static_file(shard_url, true).then(function(text) {
+      const postings = new Map();
+      for (const line of text.split("\n")) {
+        const fields = line.split("\t");
+        if (fields.length != 2) continue;
+        postings.set(fields[0], fields[1]);
+      }
+      return postings;
+    });
+  }
+  return manifest.shard_cache[shard_index].then(function(postings) {
+    return postings.get(term) || null;
+  });
+}
+
+function search_static(search_area, query, order, max, result_area, perpage) {
+  const terms = Array.from(new Set(tokenize_static_text(query)));
+  if (terms.length == 0) {
+    update_search_result(result_area, 0, [], perpage, 1);
+    return;
+  }
+  load_static_manifest(search_area).then(function(manifest) {
+    const requests = terms.map(function(term) {
+      return load_static_postings(manifest, term);
+    });
+    return Promise.all(requests).then(function(term_postings) {
+      let scores = null;
+      for (const postings of term_postings) {
+        if (!postings) {
+          scores = new Map();
+          break;
+        }
+        const entries = postings.split(",");
+        const idf = Math.log(1 + manifest.docs.length / entries.length);
+        const new_scores = new Map();
+        for (const entry of entries) {
+          const fields = entry.split(":");
+          const doc_id = parseInt(fields[0]);
+          const count = parseInt(fields[1]);
+          if (scores && !scores.has(doc_id)) continue;
+          const score = scores ? scores.get(doc_id) : 0;
+          new_scores.set(doc_id, score + (1 + Math.log(count)) * idf);
+        }
+        scores = new_scores;
+      }
+      let docs = [];
+      for (const [doc_id, score] of scores) {
+        const doc = manifest.docs[doc_id];
+        docs.push({name: doc.name, title: doc.title, date: doc.date,
+                   score: score, snippets: []});
+      }
+      sort_search_docs(docs, order);
+      const num_docs = docs.length;
+      if (max > 0 && docs.length > max) {
+        docs = docs.slice(0, max);
+      }
+      update_search_result(result_area, num_docs, docs, perpage, 1);
+    });
+  }).catch(function() {
+    alert('networking error while getting the search index');
+  });
+}
+
+function sort_search_docs(docs, order) {
+  function compare(a, b) {
+    return a < b ? -1 : (a > b ? 1 : 0);
+  }
+  const comparators = {
+    "name": function(a, b) { return compare(a.name, b.name); },
+    "title": function(a, b) { return compare(a.title, b.title) || compare(a.name, b.name); },
+    "date": function(a, b) { return compare(a.date, b.date) || compare(a.name, b.name); },
+  };
+  const base_order = order.replace(/_r$/, "");
+  const comparator = comparators[base_order] || function(a, b) {
+    return compare(b.score, a.score) || compare(a.name, b.name);
+  };
+  if (comparators[base_order] && order.endsWith("_r")) {
+    docs.sort(function(a, b) { return comparator(b, a); });
+  } else {
+    docs.sort(comparator);
+  }
+}
+
+function suggest_search(input_elem) {
+  if (input_elem.suggest_timer) {
+    clearTimeout(input_elem.suggest_timer);
+  }
+  input_elem.suggest_timer = setTimeout(function() {
+    input_elem.suggest_timer = null;
+    fetch_suggestions(input_elem);
+  }, 250);
+}
+
+function fetch_suggestions(input_elem) {
+  let search_area = input_elem;
+  while (search_area && search_area.className != "search_area") {
+    search_area = search_area.parentElement;
+  }
+  if (!search_area) return;
+  const search_url = search_area.dataset.searchUrl;
+  if (!search_url) return;
+  const match = input_elem.value.match(/^(.*?)(\S*)$/);
+  const head = match[1];
+  const prefix = match[2].replace(/^"/, "");
+  if (prefix.length < 1) return;
+  const request_url = search_url + "?action=suggest&prefix=" + encodeURIComponent(prefix);
+  const serial = (input_elem.suggest_serial || 0) + 1;
+  input_elem.suggest_serial = serial;
+  const xhr = new XMLHttpRequest();
+  xhr.onload = function() {
+    if (xhr.status != 200 || input_elem.suggest_serial != serial) return;
+    const values = [];
+    for (const line of xhr.responseText.split("\n")) {
+      const fields = line.split("\t");
+      if (fields.length < 3) continue;
+      let value = fields[0];
+      if (value.match(/\s/)) {
+        value = '"' + value + '"';
+      }
+      values.push(head + value);
+    }
+    update_suggestions(input_elem, values);
+  };
+  xhr.open("GET", request_url, true);
+  xhr.send();
+}
+
+function update_suggestions(input_elem, values) {
+  let datalist = input_elem.suggest_list;
+  if (!datalist) {
+    const serial = document.getElementsByTagName("datalist").length + 1;
+    datalist = document.createElement("datalist");
+    datalist.id = "search_suggest" + serial;
+    input_elem.parentElement.insertBefore(datalist, null);
+    input_elem.setAttribute("list", datalist.id);
+    input_elem.suggest_list = datalist;
+  }
+  datalist.innerHTML = "";
+  for (const value of values) {
+    const option = document.createElement("option");
+    option.value = value;
+    datalist.insertBefore(option, null);
+  }
+}
+
 function update_search_result(result_area, num_docs, docs, perpage, page) {
   result_area.style.display = "block";
   result_area.innerHTML = "";